@@ -55,6 +55,7 @@ function endsWith($haystack, $needle) {
 	$filter_vals        =  array("Y", "J", "H", "Ks", "F123M", "FeII", "BrG", "H2(1-0)", "H2(2-1)"); // Y, F123M, H10, H21 Added by LRP 
 	$grism_vals         =  array("J", "H", "K", "YJ", "HK");
 	$operation_vals     =  array("Photometry", "Spectroscopy");
+	$calculation_vals   =  array("Signal to noise", "Exposure time", "Number of frames", "Limiting magnitude");
 
 
 	// FIELDS CONFIGURATION
@@ -139,6 +140,15 @@ function endsWith($haystack, $needle) {
                                'info' => 'Number of on and off target images', 'depend' => "operation:$operation_vals[1]", 'nobr' => 1),
 		'spec_nf_sky'     => array('group' => 3, 'label' => 'Sky',                 'type' => "Text", 'value' => "1",    'unit' => "",
                                'depend' => "operation:$operation_vals[1]"),
+		'calculation'     => array('group' => 3, 'label' => 'Calculate',           'type' => "Select",
+		                           'values' => $calculation_vals, 'value' => "Signal to noise",  'unit' => "",
+                               'info' => 'Signal to noise: S/N for the given exp. time(s) and frames<br />Exposure time / Number of frames / Limiting magnitude: the value needed to reach the target S/N'),
+		'target_ston'     => array('group' => 3, 'label' => 'Target S/N',          'type' => "Number", 'value' => "10", 'unit' => "",
+                               'min' => 0, 'step' => '0.1', 'nobr' => 1),
+		'target_wvl'      => array('group' => 3, 'label' => 'at',                  'type' => "Text", 'value' => "", 'unit' => "microns",
+                               'info' => 'Spectroscopy only. Empty: median S/N over the spectrum (maximum for emission lines)'),
+		'magnitudes'      => array('group' => 3, 'label' => 'S/N for magnitudes',  'type' => "Text", 'value' => "", 'unit' => "",
+                               'info' => 'Limiting magnitude only. Comma separated list of magnitudes whose S/N is also given'),
 		'submit'     => array('group' => 3, 'label' => 'Calculate',                'type' => "Submit",'value' => "Calculate", "unit" => ""),
 	);
 
@@ -373,7 +383,9 @@ function endsWith($haystack, $needle) {
 
 		if ($data_sent) {
 			#$cmd = "/datos/ext/proyecto/emir/pages/observing-with-emir/observing-tools/etc_gui.py $fname";
-			$cmd = "(export LD_LIBRARY_PATH=/usr/pkg/python/Python-3.4.3/lib ; /usr/pkg/python/Python-3.4.3/bin/python3 ./etc_gui.py $fname)";
+			# The resident service (etc_server.py) keeps the instrument state warm;
+			# if it is not running, fall back to one python process per request
+			$cmd = "(export LD_LIBRARY_PATH=/usr/pkg/python/Python-3.4.3/lib ; /usr/pkg/python/Python-3.4.3/bin/python3 ./etc_client.py $fname || /usr/pkg/python/Python-3.4.3/bin/python3 ./etc_gui.py $fname)";
 			exec ($cmd, $cmd_out);
 
 			echo "<div id=\"code\">\n";
@@ -18,6 +18,16 @@ import os.path
 import xml.etree.ElementTree as ET
 from etc_config import get_models
 
+# Fields that older forms do not send, with the value used when absent
+OPTIONAL_INPUT = [
+    ['calculation', 'Signal to noise'],
+    ['target_ston', ''],
+    ['target_wvl', ''],
+    ['magnitudes', ''],
+]
+CALCULATIONS = ['Signal to noise', 'Exposure time', 'Number of frames',
+                'Limiting magnitude']
+
 
 def readxml(file):
     tree = ET.parse(file)
@@ -53,10 +63,16 @@ def errorxml(elem, text):
     ET.SubElement(elem, "error").text = text
 
 
-def check_inputs(ff, fname):
-    output = ET.Element('output')
+def validate_inputs(ff):
+    """
+    Check the fields of a request, filling in the optional ones.
+    Returns the list of error messages, empty if the request is valid
+    """
+    errors = []
 
-    error = False
+    for name, default in OPTIONAL_INPUT:
+        if ff.get(name) is None:
+            ff[name] = default
 
     if ff['template'] != 'Emission line':
         (val1, val2) = (None, None)
@@ -155,6 +171,7 @@ def check_inputs(ff, fname):
         ['spec_exp_time', 'Exp. time', 'range', None, 'Spectroscopy', 0, None],
         ['spec_nf_obj', '#Frames:obj', 'float', None, 'Spectroscopy', 0, None],
         ['spec_nf_sky', '#Frames:sky', 'float', None, 'Spectroscopy', 0, None],
+        ['calculation', 'Calculation', 'select', CALCULATIONS],
     ]
 
     for elems in DATA_INPUT:
@@ -178,9 +195,8 @@ def check_inputs(ff, fname):
 
         # int(val)
 
-                errorxml(output, 'Value of ' + elems[TITLE]
-                         + ' is not a valid number')
-                error = True
+                errors.append('Value of ' + elems[TITLE]
+                              + ' is not a valid number')
                 continue
 
       # Check range
@@ -191,16 +207,14 @@ def check_inputs(ff, fname):
 
           # print elems[MIN], elems[MAX], val
 
-                errorxml(output, 'Value of ' + elems[TITLE]
-                         + ' is out of range [' + str(elems[MIN]) + ', '
-                          + str(elems[MAX]) + ']')
-                error = True
+                errors.append('Value of ' + elems[TITLE]
+                              + ' is out of range [' + str(elems[MIN]) + ', '
+                              + str(elems[MAX]) + ']')
         elif elems[TYPE] == 'select':
 
             if not val in elems[VALUES]:
-                errorxml(output, 'Value of ' + elems[TITLE]
-                         + ' is not one of the elements in the list')
-                error = True
+                errors.append('Value of ' + elems[TITLE]
+                              + ' is not one of the elements in the list')
         elif elems[TYPE] == 'range':
 
             rval = val.split('-')
@@ -208,31 +222,62 @@ def check_inputs(ff, fname):
       # print str(rval)
 
             if len(rval) != 2:
-                errorxml(output, 'Value of ' + elems[TITLE]
-                         + ' is not a valid range ')
-                error = True
+                errors.append('Value of ' + elems[TITLE]
+                              + ' is not a valid range ')
                 continue
 
             try:
                 float(rval[0])
                 float(rval[1])
             except:
-                errorxml(output, 'Value(s) of ' + elems[TITLE]
-                         + ' are not valid numbers')
-                error = True
+                errors.append('Value(s) of ' + elems[TITLE]
+                              + ' are not valid numbers')
                 continue
 
             if float(rval[0]) > float(rval[1]):
-                errorxml(output, 'Min value of ' + elems[TITLE]
-                         + ' is greater than max value')
-                error = True
+                errors.append('Min value of ' + elems[TITLE]
+                              + ' is greater than max value')
+        else:
+
+            errors.append('Value of ' + elems[TITLE]
+                          + 'has not a valid type')
+
+    # Inverse calculations: the S/N is given and texp or nobj are solved for
+    if ff['calculation'] != 'Signal to noise':
+        try:
+            if float(ff['target_ston']) <= 0:
+                errors.append('Value of Target S/N must be positive')
+        except ValueError:
+            errors.append('Value of Target S/N is not a valid number')
+        if ff['target_wvl'] != '':
+            try:
+                float(ff['target_wvl'])
+            except ValueError:
+                errors.append('Value of Target wavelength is not a '
+                              'valid number')
+        if ff['operation'] == 'Photometry':
+            exp_time = ff['photo_exp_time']
         else:
+            exp_time = ff['spec_exp_time']
+        if ff['calculation'] != 'Exposure time' and '-' in exp_time:
+            errors.append('A single Exp. time is needed to solve for '
+                          'the ' + ff['calculation'].lower())
+        if ff['magnitudes'] != '':
+            try:
+                [float(i) for i in ff['magnitudes'].split(',')]
+            except ValueError:
+                errors.append('Value(s) of Magnitudes are not valid '
+                              'numbers')
 
-            errorxml(output, 'Value of ' + elems[TITLE]
-                     + 'has not a valid type')
-            error = True
+    return errors
 
-    if error:
+
+def check_inputs(ff, fname):
+    errors = validate_inputs(ff)
+    if errors:
+        output = ET.Element('output')
+        for text in errors:
+            errorxml(output, text)
         indent(output)
         tree = ET.ElementTree(output)
         tree.write(fname + '_out.xml')
@@ -400,6 +445,15 @@ def model_error(model, fname):
     exit()
 
 
+def solution_error(text, fname):
+    output = ET.Element("output")
+    errorxml(output, text)
+    indent(output)
+    tree = ET.ElementTree(output)
+    tree.write(fname+"_out.xml")
+    exit()
+
+
 def generic_error(fname):
     output = ET.Element("output")
     errorxml(output, "There is something wrong. Error triggered: emir_guy.generic_error Please, check that all input data are correct. See <a href=\"http://www.iac.es/proyecto/emir/pages/observing-with-emir/observing-tools.php\" target=\"_blank\">here</a> for more info. If the problem remains unsolved, please contact Lee Patrick (lpatrick [at] iac es).")
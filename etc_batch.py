@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""
+Date: 17-10-2026
+Description:
+Batch mode of the EMIR ETC: many requests evaluated in one process.
+
+The requests have the fields of the input XML of the web form and are
+validated as for it (emir_guy.validate_inputs). They are read from
+
+    .xml    one document with a request per element, i.e. <data><c>...</c>
+            <c>...</c></data> (a single request file is a batch of one)
+    .jsonl  one JSON object per line
+    .csv    a header row with the field names, one request per row,
+            empty cells for the fields not given
+
+and evaluated by a single etc_engine.Engine, so the instrument state and
+the memoized stages (etc_engine.STAGES) are shared by all of them. One JSON
+line is written per request as soon as it is done, in input order:
+
+    {"index": 0, "status": "ok", "result": {"ston": [...], ...}}
+    {"index": 1, "status": "error", "errors": ["Value of Seeing ..."]}
+
+An optional 'id' field is copied to its record. Errors only affect their
+own record. With -j the requests are shared by a pool of processes
+(etc_pool.py); the records keep the input order.
+
+    python3 etc_batch.py requests.jsonl -o results.jsonl -j 8
+"""
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import xml.etree.ElementTree as ET
+from optparse import OptionParser
+
+import numpy as np
+
+import emir_guy
+import etc_engine
+import etc_pool
+
+description = ">> Batch mode of the EMIR ETC"
+usage = "%prog [options] requests.(xml|jsonl|csv)"
+
+FORMATS = ['xml', 'jsonl', 'csv']
+
+# Attributes of the Results written to the records
+SUMMARY_FIELDS = ['texp', 'ston', 'signal_obj', 'signal_sky', 'saturated',
+                  'nobj', 'nsky', 'mag', 'mag_sky', 'timerange', 'solution']
+SPEC_FIELDS = ['cenwl', 'dpx', 'res_ele', 'slitloss']
+# Spectra per detector pixel, only written with --spectra
+SPECTRA_FIELDS = ['ldo_px', 'ston_px', 'obj_px', 'sky_px', 'sp']
+
+
+def read_configs(fil, fmt=None):
+    """Yield the requests of a file, as dicts of fields"""
+    if fmt is None:
+        fmt = os.path.splitext(fil)[1][1:].lower()
+        if fmt == 'json':
+            fmt = 'jsonl'
+    if fmt == 'xml':
+        for child in ET.parse(fil).getroot():
+            yield dict((field.tag, field.text) for field in child)
+    elif fmt == 'jsonl':
+        with open(fil) as arch:
+            for line in arch:
+                if line.strip():
+                    yield json.loads(line)
+    elif fmt == 'csv':
+        with open(fil) as arch:
+            for row in csv.DictReader(arch):
+                # Empty cells are fields the request does not give
+                yield dict((name, value) for name, value in row.items()
+                           if value != '')
+    else:
+        raise ValueError("Unknown format '{0}' of {1}".format(fmt, fil))
+
+
+def resolve_files(configs, directory):
+    """Yield the requests with their model files relative to directory"""
+    for config in configs:
+        if config.get('model_file'):
+            config['model_file'] = os.path.join(directory,
+                                                config['model_file'])
+        yield config
+
+
+def plain(value):
+    """value with the NumPy arrays and scalars as JSON types"""
+    if isinstance(value, dict):
+        return dict((name, plain(i)) for name, i in value.items())
+    if isinstance(value, (list, tuple)):
+        return [plain(i) for i in value]
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return value
+
+
+def evaluate(engine, config, spectra=False):
+    """Record of one request"""
+    record = compute(engine, config, spectra)
+    if 'id' in config:
+        record['id'] = config['id']
+    return record
+
+
+def compute(engine, config, spectra=False):
+    """Status and result, or errors, of one request"""
+    ff = dict((name, value if value is None or isinstance(value, str)
+               else str(value)) for name, value in config.items())
+    try:
+        errors = emir_guy.validate_inputs(ff)
+    except KeyError as err:
+        errors = ['Field {0} is missing'.format(err)]
+    if errors:
+        return {'status': 'error', 'errors': errors}
+    # The products only needed for display are only made for the spectra
+    engine.display = spectra
+    try:
+        if ff['operation'] == 'Photometry':
+            res = engine.photometry(ff)
+            fields = SUMMARY_FIELDS
+        else:
+            res = engine.spectroscopy(ff)
+            fields = SUMMARY_FIELDS + SPEC_FIELDS
+            if spectra:
+                fields = fields + SPECTRA_FIELDS
+    except etc_engine.EtcError as err:
+        return {'status': 'error', 'errors': [str(err)]}
+    except Exception as err:
+        return {'status': 'error',
+                'errors': ['{0}: {1}'.format(type(err).__name__, err)]}
+    return {'status': 'ok',
+            'result': dict((name, plain(getattr(res, name)))
+                           for name in fields)}
+
+
+def run_batch(configs, out, engine=None, spectra=False, processes=1):
+    """
+    Evaluate the requests of the iterable configs, writing a JSON line per
+    request to the file object out. Returns the number of errors.
+    With processes > 1 they are shared by an etc_pool.EnginePool
+    """
+    if processes > 1:
+        pool = etc_pool.EnginePool(processes, engine)
+        records = pool.batch(configs, spectra)
+    else:
+        if engine is None:
+            engine = etc_engine.Engine()
+        records = (evaluate(engine, config, spectra) for config in configs)
+    nerrors = 0
+    for index, result in enumerate(records):
+        record = {'index': index}
+        record.update(result)
+        if record['status'] != 'ok':
+            nerrors += 1
+        out.write(json.dumps(record, sort_keys=True) + '\n')
+        out.flush()
+    if processes > 1:
+        pool.close()
+    return nerrors
+
+
+def main():
+    """Command line entry point"""
+    parser = OptionParser(usage=usage, description=description)
+    parser.add_option("-o", "--output", dest="output", default='-',
+                      help='File of results, - for stdout [%default]')
+    parser.add_option("-f", "--format", dest="format", default=None,
+                      choices=FORMATS,
+                      help='Format of the requests, {0} [from the extension]'
+                      .format(', '.join(FORMATS)))
+    parser.add_option("--spectra", dest="spectra", action="store_true",
+                      default=False,
+                      help='Add the spectra per pixel to the records')
+    parser.add_option("-j", "--processes", dest="processes", type="int",
+                      default=1,
+                      help='Worker processes, 0 for one per core [%default]')
+    option, args = parser.parse_args()
+    if len(args) == 0:
+        parser.print_help()
+        sys.exit(1)
+    if option.processes < 0:
+        parser.error("the number of processes can not be negative")
+    processes = option.processes or multiprocessing.cpu_count()
+
+    # Paths are given relative to the current directory, but data files
+    # relative to the ETC directory
+    fil = os.path.abspath(args[0])
+    output = option.output
+    if output != '-':
+        output = os.path.abspath(output)
+    configs = resolve_files(read_configs(fil, option.format), os.getcwd())
+    os.chdir(os.path.dirname(os.path.abspath(etc_engine.__file__)))
+    if output == '-':
+        nerrors = run_batch(configs, sys.stdout, spectra=option.spectra,
+                            processes=processes)
+    else:
+        with open(output, 'w') as out:
+            nerrors = run_batch(configs, out, spectra=option.spectra,
+                                processes=processes)
+    if nerrors:
+        sys.stderr.write("{0:d} request(s) with errors\n".format(nerrors))
+
+
+if __name__ == '__main__':
+    main()
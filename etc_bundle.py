@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""
+Date: 17-10-2026
+Description:
+Precompiled instrument bundle for the ETC.
+
+Parsing the ASCII curves (etc_modules.getdata) and resampling them with
+SpecCurve.interpolate is done for every component, filter, grism and
+template on every request. This module does it once, at build time, for
+every curve the ETC knows about:
+
+    python3 etc_bundle.py
+
+writes bundle/index.json plus one .npy file per curve, already resampled
+onto the high resolution grid of etc_config.get_grid(). It also packs the
+SkyCalc tables into the sky cube read by etc_modules.load_skycube.
+
+The index also holds the Vega normalization integrals (etc_modules.vega)
+of every library model under every filter, alone and times the instrument
+transmission, so scaling a model to a magnitude is a lookup (vega_scales).
+
+At run time load_curve() memory-maps the stored array when the bundle was
+built for the same grid and the source file has not changed since (same size
+and mtime, or same sha1). Anything else falls back to the ASCII path, so a
+stale or missing bundle only costs speed.
+
+Parsed curves (read_curve) and resampled arrays (load_curve) are also kept
+in memory by curve_cache, an LRU bounded in bytes and keyed by file, size,
+mtime and grid, so a long-lived process does each of them once.
+"""
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import etc_config as con
+import etc_modules as mod
+from etc_classes import SpecCurve
+
+BUNDLE_DIR = 'bundle'
+BUNDLE_VERSION = 2
+
+# Memory used by the in-process curve cache
+CURVE_CACHE_BYTES = 256*2**20
+
+_index = {'key': None, 'data': None}
+
+
+class CurveCache(object):
+    """
+    LRU cache bounded by the bytes of the arrays it holds.
+    Memory-mapped arrays are not counted, their pages belong to the files.
+    Hits and misses are counted per kind of entry, the first element of
+    the keys: a resampled array missing from the cache is looked up again
+    as a parsed curve, which is only a miss if the file is parsed
+    """
+
+    def __init__(self, max_bytes=CURVE_CACHE_BYTES):
+        """Initialise"""
+        super(CurveCache, self).__init__()
+        self.max_bytes = max_bytes
+        self.data = OrderedDict()
+        self.nbytes = 0
+        self.hits = {}
+        self.misses = {}
+
+    def get(self, key):
+        """Cached value for key, or None"""
+        counts = self.hits if key in self.data else self.misses
+        counts[key[0]] = counts.get(key[0], 0) + 1
+        if key in self.data:
+            self.data.move_to_end(key)
+            return self.data[key][0]
+        return None
+
+    def put(self, key, value, nbytes):
+        """Store value, evicting the least recently used entries"""
+        if nbytes > self.max_bytes:
+            return
+        if key in self.data:
+            self.nbytes -= self.data.pop(key)[1]
+        self.data[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self.data.popitem(last=False)[1][1]
+
+    def clear(self):
+        """Drop every entry, counters are kept"""
+        self.data.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """Counters to size the cache, hits and misses per kind of entry"""
+        return {'hits': dict(self.hits), 'misses': dict(self.misses),
+                'entries': len(self.data), 'bytes': self.nbytes,
+                'max_bytes': self.max_bytes}
+
+
+curve_cache = CurveCache()
+
+
+def _array_bytes(data):
+    """Memory held by an array, zero for memory-mapped ones"""
+    if isinstance(data, np.memmap):
+        return 0
+    return data.nbytes
+
+
+def _file_key(fil):
+    """Identity of the current contents of a file"""
+    stat = os.stat(fil)
+    return (os.path.normpath(fil), stat.st_size, stat.st_mtime)
+
+
+def grid_key(wvl):
+    """A short string identifying a wavelength grid"""
+    return '{0!r}:{1!r}:{2:d}'.format(float(wvl[0]), float(wvl[-1]), len(wvl))
+
+
+def file_hash(fil):
+    """sha1 of the contents of a file"""
+    with open(fil, 'rb') as arch:
+        return hashlib.sha1(arch.read()).hexdigest()
+
+
+def bundle_files():
+    """All the curves used by the ETC: components, filters, grisms and models"""
+    config_files = con.get_config()
+    files = [config_files['qe'], config_files['optics'],
+             config_files['telescope'], config_files['vega']]
+    files += [con.get_filter_file(filt) for filt in con.FILTERS]
+    files += [con.get_grism_files(grism)[1] for grism in con.GRISMS]
+    models, order = con.get_models()
+    files += ['libs/' + models[i] for i in order]
+    # Keep the order, drop repeated entries
+    return [fil for i, fil in enumerate(files) if fil not in files[:i]]
+
+
+def build_bundle(directory=BUNDLE_DIR, wvl=None):
+    """Resample every curve onto wvl and store it in directory"""
+    if wvl is None:
+        wvl = con.get_grid()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    curves = {}
+    for fil in bundle_files():
+        sha1 = file_hash(fil)
+        curve = SpecCurve(fil)
+        np.save(os.path.join(directory, sha1 + '.npy'), curve.interpolate(wvl))
+        stat = os.stat(fil)
+        curves[fil] = {'sha1': sha1, 'size': stat.st_size,
+                       'mtime': stat.st_mtime, 'unity': curve.unity}
+
+    index = {'version': BUNDLE_VERSION, 'grid': grid_key(wvl),
+             'curves': curves}
+    index['vega_table'] = build_vega_table(
+        lambda fil: np.load(os.path.join(directory,
+                                         curves[fil]['sha1'] + '.npy'),
+                            mmap_mode='r'))
+    # Written last, and atomically, so readers never see a partial bundle
+    temp = os.path.join(directory, 'index.json.tmp')
+    with open(temp, 'w') as arch:
+        json.dump(index, arch, indent=1, sort_keys=True)
+    os.replace(temp, os.path.join(directory, 'index.json'))
+
+    # Arrays of curves that are no longer referenced
+    valid = set(i['sha1'] + '.npy' for i in curves.values())
+    for fil in os.listdir(directory):
+        if fil.endswith('.npy') and fil not in valid:
+            os.remove(os.path.join(directory, fil))
+    return index
+
+
+def build_vega_table(get_array):
+    """
+    Photons of Vega and of every library model under every filter, with the
+    filter alone [0] and times the instrument transmission [1].
+    get_array(fil) returns the resampled curve of a file
+    """
+    config_files = con.get_config()
+    trans = get_array(config_files['qe'])*get_array(config_files['optics'])*\
+        get_array(config_files['telescope'])
+    weights = {}
+    for filt in con.FILTERS:
+        fil = con.get_filter_file(filt)
+        weights[fil] = np.array([get_array(fil), get_array(fil)*trans])
+
+    def photons(curve):
+        """Integrals of curve under every filter"""
+        return dict((fil, list(weights[fil].dot(curve))) for fil in weights)
+
+    models, order = con.get_models()
+    return {'vega': photons(get_array(config_files['vega'])),
+            'models': dict(('libs/' + models[i],
+                            photons(get_array('libs/' + models[i])))
+                           for i in order)}
+
+
+def load_index(directory=BUNDLE_DIR):
+    """Return the bundle index, or None if there is no valid bundle"""
+    fil = os.path.join(directory, 'index.json')
+    try:
+        stat = os.stat(fil)
+    except OSError:
+        return None
+    key = (fil, stat.st_mtime, stat.st_size)
+    if _index['key'] != key:
+        with open(fil) as arch:
+            index = json.load(arch)
+        if index.get('version') != BUNDLE_VERSION:
+            index = None
+        _index['key'] = key
+        _index['data'] = index
+    return _index['data']
+
+
+def _fresh(index, fil):
+    """Index entry of a file if it has not changed since the build"""
+    entry = index['curves'].get(os.path.normpath(fil))
+    if entry is None:
+        return None
+    try:
+        stat = os.stat(fil)
+    except OSError:
+        return None
+    if stat.st_size != entry['size'] or (stat.st_mtime != entry['mtime'] and
+                                         file_hash(fil) != entry['sha1']):
+        return None
+    return entry
+
+
+def _bundled(fil, wvl, directory):
+    """Memory-mapped resampled curve and its units, None if not valid"""
+    index = load_index(directory)
+    if index is None or index['grid'] != grid_key(wvl):
+        return None
+    entry = _fresh(index, fil)
+    if entry is None:
+        return None
+    try:
+        data = np.load(os.path.join(directory, entry['sha1'] + '.npy'),
+                       mmap_mode='r')
+    except (IOError, ValueError):
+        return None
+    return data, entry['unity']
+
+
+def vega_scales(models, filt, trans=False, wvl=None, directory=BUNDLE_DIR):
+    """
+    Factors that scale each of the library models (file names) to magnitude
+    zero under the filter file filt, times the instrument transmission when
+    trans (see etc_modules.vega), from the table of the bundle.
+    nan for the models without a valid entry, e.g. if any of the curves
+    involved changed after the bundle was built
+    """
+    if wvl is None:
+        wvl = con.get_grid()
+    scales = np.nan*np.ones(len(models))
+    index = load_index(directory)
+    if index is None or index['grid'] != grid_key(wvl):
+        return scales
+    config_files = con.get_config()
+    needed = [filt, config_files['vega']]
+    if trans:
+        needed += [config_files['qe'], config_files['optics'],
+                   config_files['telescope']]
+    filt = os.path.normpath(filt)
+    if any(_fresh(index, fil) is None for fil in needed) or \
+            filt not in index['vega_table']['vega']:
+        return scales
+    vega_photons = index['vega_table']['vega'][filt][int(trans)]
+    for i, model in enumerate(models):
+        model = os.path.normpath(model)
+        if model in index['vega_table']['models'] and \
+                _fresh(index, model) is not None:
+            scales[i] = vega_photons/\
+                index['vega_table']['models'][model][filt][int(trans)]
+    return scales
+
+
+def read_curve(fil):
+    """
+    Return the SpecCurve of a file, parsed once while the file does not
+    change. The object is shared: do not modify it
+    """
+    key = ('curve',) + _file_key(fil)
+    curve = curve_cache.get(key)
+    if curve is None:
+        curve = SpecCurve(fil)
+        curve_cache.put(key, curve, curve.wvl.nbytes + curve.fl.nbytes +
+                        curve.wvl0.nbytes + curve.fl0.nbytes)
+    return curve
+
+
+def load_curve(fil, wvl, directory=BUNDLE_DIR):
+    """
+    Return a curve file interpolated onto wvl, and its units (see SpecCurve).
+    Taken from the bundle when possible. The array is read-only, as it is
+    shared through curve_cache
+    """
+    key = ('array', grid_key(wvl)) + _file_key(fil)
+    found = curve_cache.get(key)
+    if found is not None:
+        return found
+    found = _bundled(fil, wvl, directory)
+    if found is None:
+        curve = read_curve(fil)
+        found = curve.interpolate(wvl), curve.unity
+        found[0].flags.writeable = False
+    curve_cache.put(key, found, _array_bytes(found[0]))
+    return found
+
+
+if __name__ == '__main__':
+    index = build_bundle()
+    print("{0:d} curves written to {1:s}/".format(len(index['curves']),
+                                                   BUNDLE_DIR))
+    try:
+        mod.pack_skytables()
+        print("Sky cube written to sky/")
+    except IOError as err:
+        print("Sky cube not written: {0}".format(err))
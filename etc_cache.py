@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+Date: 17-10-2026
+Description:
+Content-addressed cache of ETC results.
+
+Many requests only differ in the random name given to them by
+body_emir.php. A request is identified here by a hash of its validated
+input fields (emir_guy.check_inputs), of the instrument data files and of
+the code of the ETC, so identical requests share one entry:
+
+    cache/<sha1>/out.xml        the output XML, with the request name
+                                replaced by a placeholder where it names
+                                files (the figures, an uploaded model)
+    cache/<sha1>/<suffix>.png   the figures
+
+On a hit, EmirGui.run copies the entry to the names of the new request
+instead of computing it again. Entries are written to a temporary
+directory and renamed into place, so concurrent workers never see partial
+entries. The store is kept below RESULT_CACHE_BYTES and RESULT_CACHE_AGE
+by prune(), least recently used entries first, run by store() at most once
+per PRUNE_INTERVAL.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+import xml.etree.ElementTree as ET
+
+import etc_bundle
+
+RESULT_CACHE_DIR = 'cache'
+RESULT_CACHE_BYTES = 512*2**20
+RESULT_CACHE_AGE = 30*24*3600.  # s
+# Minimum time between two prune() of the store by store()
+PRUNE_INTERVAL = 600.  # s
+# File of the store whose time is that of the last prune()
+PRUNE_MARK = '.pruned'
+
+# Outputs of a request besides fname_out.xml
+FIGURE_SUFFIXES = ['_photo.png', '_spec.png']
+
+# Modules whose code determines the results
+CODE_MODULES = ['emir_guy', 'etc_bundle', 'etc_cache', 'etc_classes',
+                'etc_config', 'etc_engine', 'etc_gui', 'etc_modules',
+                'etc_plot']
+
+PLACEHOLDER = '@FNAME@'
+# Elements of the output XML whose text names a file after the request,
+# with the text before the name
+NAMED_ELEMENTS = {'fig': '', 'text': 'Model file = '}
+
+_hashes = {}
+_code = {'version': None}
+
+
+def cached_hash(fil):
+    """sha1 of a file, computed again only when its size or mtime change"""
+    stat = os.stat(fil)
+    key = (os.path.normpath(fil), stat.st_size, stat.st_mtime)
+    if key not in _hashes:
+        _hashes[key] = etc_bundle.file_hash(fil)
+    return _hashes[key]
+
+
+def data_version():
+    """Hash of the instrument data: every curve plus the sky tables"""
+    files = etc_bundle.bundle_files()
+    if os.path.isdir('sky'):
+        # The sky cube is only used while it matches the tables
+        # (etc_modules.skycube_fresh), which are enough
+        files += sorted(os.path.join('sky', i) for i in os.listdir('sky')
+                        if not i.startswith('skycube_'))
+    sha1 = hashlib.sha1()
+    for fil in files:
+        sha1.update('{0:s} {1:s}\n'.format(fil, cached_hash(fil))
+                    .encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def code_version():
+    """Hash of the source of the modules in use, done once per process"""
+    if _code['version'] is None:
+        sha1 = hashlib.sha1()
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in CODE_MODULES:
+            with open(os.path.join(here, name + '.py'), 'rb') as arch:
+                sha1.update(arch.read())
+        _code['version'] = sha1.hexdigest()
+    return _code['version']
+
+
+def request_key(ff):
+    """
+    Key of a validated request. The uploaded model file counts by its
+    contents, and not at all when the template does not use it
+    """
+    fields = dict((name, (value or '').strip()) for name, value in ff.items())
+    fields.pop('model_file', None)
+    if ff.get('template') == 'Model file':
+        try:
+            fields['model_file'] = cached_hash(ff['model_file'])
+        except (OSError, TypeError):
+            return None
+    payload = json.dumps({'request': fields, 'data': data_version(),
+                          'code': code_version()}, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def rename(tree, old, new):
+    """
+    Change the request name old to new in the output XML tree, where it
+    names files (NAMED_ELEMENTS)
+    """
+    for elem in tree.getroot():
+        prefix = NAMED_ELEMENTS.get(elem.tag)
+        if prefix is not None and elem.text and \
+                elem.text.startswith(prefix + old):
+            elem.text = prefix + new + elem.text[len(prefix + old):]
+    # Not kept by the parser (emir_guy.indent)
+    tree.getroot().tail = '\n'
+    return tree
+
+
+def fetch(key, fname, directory=RESULT_CACHE_DIR):
+    """
+    Write the outputs of the entry key under the name fname.
+    Returns False if there is no such entry
+    """
+    entry = os.path.join(directory, key)
+    try:
+        tree = ET.parse(os.path.join(entry, 'out.xml'))
+        for suffix in FIGURE_SUFFIXES:
+            fig = os.path.join(entry, suffix[1:])
+            if os.path.exists(fig):
+                shutil.copyfile(fig, fname + suffix)
+        # Most recently used, for prune()
+        os.utime(entry, None)
+    except (IOError, OSError, ET.ParseError):
+        # Missing, or removed by prune() in another process meanwhile
+        return False
+    rename(tree, PLACEHOLDER, fname).write(fname + '_out.xml')
+    return True
+
+
+def store(key, fname, directory=RESULT_CACHE_DIR):
+    """Save the outputs of the request fname as the entry key"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp = os.path.join(directory, 'tmp-{0:d}-{1:s}'.format(os.getpid(),
+                                                            key))
+    os.mkdir(temp)
+    try:
+        rename(ET.parse(fname + '_out.xml'), fname, PLACEHOLDER).write(
+            os.path.join(temp, 'out.xml'))
+        for suffix in FIGURE_SUFFIXES:
+            if os.path.exists(fname + suffix):
+                shutil.copyfile(fname + suffix,
+                                os.path.join(temp, suffix[1:]))
+        os.rename(temp, os.path.join(directory, key))
+    except OSError:
+        # Stored meanwhile by another worker
+        pass
+    finally:
+        if os.path.exists(temp):
+            shutil.rmtree(temp, ignore_errors=True)
+    if prune_due(directory):
+        prune(directory)
+
+
+def prune_due(directory=RESULT_CACHE_DIR, interval=PRUNE_INTERVAL):
+    """
+    Whether the store was not pruned for interval seconds, by any process.
+    If so it is marked as pruned now
+    """
+    mark = os.path.join(directory, PRUNE_MARK)
+    try:
+        if time.time() - os.stat(mark).st_mtime < interval:
+            return False
+        os.utime(mark, None)
+    except OSError:
+        open(mark, 'a').close()
+    return True
+
+
+def remove(entry):
+    """Remove an entry directory without exposing a partial one"""
+    temp = os.path.join(os.path.dirname(entry),
+                        'tmp-{0:d}-rm'.format(os.getpid()))
+    try:
+        os.rename(entry, temp)
+    except OSError:
+        return
+    shutil.rmtree(temp, ignore_errors=True)
+
+
+def prune(directory=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_BYTES,
+          max_age=RESULT_CACHE_AGE):
+    """
+    Remove the entries not used for max_age seconds, then the least
+    recently used ones until the store takes max_bytes at most
+    """
+    now = time.time()
+    entries = []
+    for name in os.listdir(directory):
+        entry = os.path.join(directory, name)
+        if name == PRUNE_MARK:
+            continue
+        if name.startswith('tmp-'):
+            # Left by a killed process
+            try:
+                if now - os.stat(entry).st_mtime > 3600:
+                    shutil.rmtree(entry, ignore_errors=True)
+            except OSError:
+                pass
+            continue
+        try:
+            used = os.stat(entry).st_mtime
+            size = sum(os.path.getsize(os.path.join(entry, i))
+                       for i in os.listdir(entry))
+        except OSError:
+            continue
+        if now - used > max_age:
+            remove(entry)
+        else:
+            entries.append((used, size, entry))
+    total = sum(i[1] for i in entries)
+    for used, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        remove(entry)
+        total -= size
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Date: 17-10-2026
+Description:
+Minimal client for the resident ETC service (etc_server.py). It only uses
+the standard library, so it starts in a few milliseconds. The request is the
+same fname given to etc_gui.py: fname.xml is read and fname_out.xml plus the
+figures are written next to it by the service.
+
+    python3 etc_client.py fname
+
+Exit status is 0 when the request was processed. Any other value means that
+the service could not be used and the caller (body_emir.php) should fall back
+to running etc_gui.py directly.
+"""
+import os
+import socket
+import sys
+from optparse import OptionParser
+
+SOCKET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'etc_server.sock')
+TIMEOUT = 300.  # s
+
+
+def request(fname, socket_file=SOCKET_FILE, timeout=TIMEOUT):
+    """
+    Send one request to the service and return its reply,
+    'OK' or 'ERROR <message>'. Raises socket.error if it can not be reached.
+    fname 'STATS' asks for the cache counters of a worker
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_file)
+        # The service runs from its own directory
+        if fname != 'STATS':
+            fname = os.path.abspath(fname)
+        sock.sendall((fname + '\n').encode('utf-8'))
+        reply = b''
+        while not reply.endswith(b'\n'):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+    finally:
+        sock.close()
+    return reply.decode('utf-8').strip()
+
+
+def main():
+    """Command line entry point"""
+    parser = OptionParser(usage="%prog [options] fname",
+                          description=">> Client for the EMIR ETC service")
+    parser.add_option("-s", "--socket", dest="socket", default=SOCKET_FILE,
+                      help='Unix socket of etc_server.py \n  [%default]')
+    parser.add_option("-t", "--timeout", dest="timeout", type="float",
+                      default=TIMEOUT, help='Timeout in seconds [%default]')
+    parser.add_option("--stats", dest="stats", action="store_true",
+                      default=False,
+                      help='Print the cache counters of one worker')
+    option, args = parser.parse_args()
+    if option.stats:
+        args = ['STATS']
+    if len(args) == 0:
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        reply = request(args[0], option.socket, option.timeout)
+    except (socket.error, OSError) as err:
+        sys.stderr.write("ETC service unavailable: {0}\n".format(err))
+        sys.exit(2)
+    if not reply.startswith('OK'):
+        sys.stderr.write("ETC service: {0}\n".format(reply))
+        sys.exit(1)
+    if option.stats:
+        print(reply[3:])
+
+
+if __name__ == '__main__':
+    main()
@@ -57,10 +57,33 @@ def get_models():
     return models, order
 
 
+def get_grid():
+    """
+    High resolution wavelength grid (microns) on which all the curves are
+    evaluated
+    """
+    import numpy as np
+    # Changed to 80000 by LRP on 04-04-2017
+    return (8000 + np.arange(100001)*0.2)*1e-4
+
+
+# Names accepted by get_filter and get_grism
+FILTERS = ['Y', 'J', 'H', 'Ks', 'FeII', 'BrG', 'H2(1-0)', 'H2(2-1)', 'F123M',
+           'Kspec', 'YJ', 'HK']
+GRISMS = ['K', 'H', 'J', 'YJ', 'HK']
+
+
 def get_filter(filt='Ks'):
-    """Get the proper filter and returns it as a speccurve object"""
-    from etc_classes import SpecCurve
+    """
+    Get the proper filter and returns it as a speccurve object.
+    Shared through etc_bundle.curve_cache: do not modify it
+    """
+    from etc_bundle import read_curve
+    return read_curve(get_filter_file(filt))
 
+
+def get_filter_file(filt='Ks'):
+    """Get the transmission file of a filter"""
     # Broad Band Photometry:
     if (filt == 'Y'):
         filter_file = 'filters/Y_trans.dat'
@@ -93,45 +116,55 @@ def get_filter(filt='Ks'):
     elif (filt == 'HK'):
         filter_file = 'filters/HK_paco.dat'
 
-    return SpecCurve(filter_file)
+    return filter_file
 
 
 def get_grism(grism='K'):
     """
     Get the proper grism and returns it as a
     speccurve object, along with the associated filter
+    (both shared through etc_bundle.curve_cache)
+    """
+    from etc_bundle import read_curve
+
+    res, grism_file, filt = get_grism_files(grism)
+    return res, read_curve(grism_file), get_filter(filt)
+
+
+def get_grism_files(grism='K'):
+    """
+    Get the resolution, the transmission file and the name of the
+    associated filter of a grism
 
     MBC 2016-10-29 increase 'res' values so spectral dispersion is as
     measured in commissioning (Nicolas lambda cal with sky lines)
     NB the safer way is to get 'res' from commissioning data,
     and adjust the number of pixels per resolution element where required.
     """
-    from etc_classes import SpecCurve
-
     if (grism == 'K'):
         grism_file = 'grisms/grism_k.dat'
-        filter_curve = get_filter('Kspec')
+        filt = 'Kspec'
         res = 4000.*1.067485  # up by 6.7485%
     elif (grism == 'H'):
         grism_file = 'grisms/grism_h.dat'
-        filter_curve = get_filter('H')
+        filt = 'H'
         res = 4250.*1.052066  # up by 5.2%
     elif (grism == 'J'):
         grism_file = 'grisms/grism_j.dat'
-        filter_curve = get_filter('J')
+        filt = 'J'
         res = 5000.*1.085924  # up by 8.5924%
 
     # Low Resolution Grisms:
 
     elif (grism == 'YJ'):
         grism_file = 'grisms/grism_yj.dat'
-        filter_curve = get_filter('YJ')
+        filt = 'YJ'
         res = 987.
     elif (grism == 'HK'):
         grism_file = 'grisms/grism_hk.dat'
-        filter_curve = get_filter('HK')
+        filt = 'HK'
         res = 987.
-    return res, SpecCurve(grism_file), filter_curve
+    return res, grism_file, filt
 
 
 def get_skymag(filt):
@@ -199,6 +232,19 @@ def get_skymag(filt):
     # return skymag_dict[filt]
 
 
+def get_sky_segments(grism='K'):
+    """
+    Wavelength segments (micron, [lo, hi)) in which the sky spectrum of a
+    grism is normalized to the sky brightness of a band: (band, lo, hi).
+    By default the whole range is scaled to the grism's own sky magnitude.
+    The HK grism spans two bands: the blue part is scaled to H and the red
+    part to K (see get_skymag)
+    """
+    segments = {
+        "HK": [("H", 1.2, 1.9), ("K", 1.9, 2.7)]}
+    return segments.get(grism, [(grism, 0., float('inf'))])
+
+
 def get_params():
     """
     Load the fixed parameters of the system (RON, DC, Seeing, etc.)
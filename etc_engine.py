@@ -0,0 +1,1105 @@
+#!/usr/bin/env python
+"""
+Date: 17-10-2026
+Description:
+Computational core of the EMIR ETC, without XML, files or figures.
+
+Engine holds the instrument state (the high resolution grid and the QE,
+optics, telescope and Vega curves) and evaluates any number of requests:
+
+    import etc_engine
+    engine = etc_engine.Engine()
+    res = engine.photometry({'magnitude': 18, 'source_type': 'Point',
+                             'template': 'Black body', 'body_temp': 5000,
+                             'airmass': 1.2, 'seeing': 0.7,
+                             'photo_filter': 'Ks', 'photo_exp_time': '10',
+                             'photo_nf_obj': 10, 'photo_nf_sky': 10})
+    res.ston
+
+The config holds the fields of the input XML of the web form (see
+emir_guy.check_inputs, which validates them); values may be given as
+numbers. photometry() and spectroscopy() return a Result, whose arrays are
+written as XML and figures by etc_gui.EmirGui. Requests that can not be
+solved raise EtcError.
+
+An Engine is not meant to be shared between threads: a request keeps its
+intermediate products in the instance.
+"""
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import etc_cache
+import etc_config as con
+import etc_modules as mod
+from etc_bundle import load_curve, vega_scales
+
+# Fields that may be absent from a config, with the value used instead
+OPTIONAL_CONFIG = {'calculation': 'Signal to noise', 'target_ston': '',
+                   'target_wvl': '', 'magnitudes': ''}
+
+# Exposure times sampled in photometry 'Range' mode. getPhotSton evaluates
+# all of them in one array expression, so denser curves are cheap
+NTEXP_PHOT = 100
+
+# Exposure times sampled in spectroscopy 'Range' mode
+NTEXP_SPEC = 10
+
+# Parameters that sweep() can take as axes, in the order it loops over them
+SWEEP_AXES = ['airmass', 'seeing', 'magnitude', 'texp']
+# Range of the values of the sweep axes, as in emir_guy.validate_inputs
+SWEEP_RANGES = {'airmass': (1.0, 2.0)}
+# Sweep axes whose values must be positive
+SWEEP_POSITIVE = ['seeing', 'texp']
+# Memory for the arrays of a chunk of sweep points
+SWEEP_CHUNK_BYTES = 64*2**20
+# Temporary arrays of the noise computation, per image pixel
+SWEEP_TEMPORARIES = 8
+
+# Memoized stages of the pipeline (see runStage): the request fields each
+# one depends on and the stages it is built upon. A change of parameters
+# only recomputes the stages that use them; the noise for the exposure time
+# and number of frames (getPhotNoise, getSpecNoise) is cheap and always
+# computed. The sky curves are memoized by mod.interpolatesky
+STAGES = {
+    'obj': ([], []),
+    'phot_rates': (['magnitude', 'airmass', 'photo_filter'], ['obj']),
+    'spec_rates': (['magnitude', 'airmass', 'seeing', 'spec_slit_width',
+                    'spec_grism', 'source_type'], ['obj']),
+}
+
+# Fields of each template used by buildObj
+TEMPLATE_INPUTS = {'Model library': ['model'], 'Black body': ['body_temp'],
+                   'Model file': ['model_file'],
+                   'Emission line': ['line_center', 'line_fwhm', 'line_peakf']}
+
+# Attributes set by the stages, restored when they are taken from the cache
+OBJ_ATTRS = ['obj', 'obj_units', 'model_file', 'bbteff', 'lcenter',
+             'lwidth', 'lflux']
+RATES_ATTRS = ['obj_units', 'mag_sky']
+
+# Results kept per stage
+STAGE_CACHE_SIZE = 16
+_stages = {}
+
+# Threads running the independent stages of a spectroscopy request (object
+# and sky segments, see Engine.runConcurrently); 1 runs
+# them in turn. They are mostly NumPy/SciPy work that releases the GIL
+SPEC_THREADS = 4
+# Pool of those threads, made again in forked processes
+_executor = {'pid': None, 'threads': None, 'pool': None}
+
+
+class EtcError(Exception):
+    """A request that can not be solved, e.g. an unreachable target S/N"""
+    pass
+
+
+def once(compute):
+    """Function returning compute(), which is only called the first time"""
+    value = []
+
+    def get():
+        if not value:
+            value.append(compute())
+        return value[0]
+    return get
+
+
+def sweep_range(name):
+    """Description of the values allowed for the sweep axis name"""
+    if name in SWEEP_POSITIVE:
+        return 'positive'
+    if name in SWEEP_RANGES:
+        return 'in [{0}, {1}]'.format(*SWEEP_RANGES[name])
+    return 'finite numbers'
+
+
+class Result(object):
+    """
+    Outcome of a request: the config, the parameters used (possibly solved
+    for, as texp or nobj in inverse calculations) and the arrays computed.
+    Attributes are set from the keywords; those of lazy (a dict of
+    functions) are computed when first read, e.g. the products only needed
+    for the figures
+    """
+
+    def __init__(self, lazy=None, **kwargs):
+        """Initialise"""
+        super(Result, self).__init__()
+        self.__dict__.update(kwargs)
+        self._lazy = dict(lazy or {})
+
+    def __getattr__(self, name):
+        # Only reached for the attributes not set yet
+        lazy = self.__dict__.get('_lazy', {})
+        if name not in lazy:
+            raise AttributeError(name)
+        value = lazy.pop(name)()
+        setattr(self, name, value)
+        return value
+
+
+class Engine(object):
+    """Instrument state and computations of the ETC"""
+
+    def __init__(self):
+        """
+        Initialise
+
+        Only the instrument state is built here; each request is evaluated
+        by photometry() or spectroscopy()
+        """
+        # When the application is loaded, all the fixed elements of the system
+        # (optics, etc.) plus the sky curves are loaded
+        config_files = con.get_config()
+        # Curves over the full EMIR range. Each request works on the window
+        # of them needed by its filter or grism (see setWindow)
+        self.full = {'ldo_hr': con.get_grid()}
+        ldo_hr = self.full['ldo_hr']
+
+        # Fixed elements of the system
+        # Curves come from the precompiled bundle when it is up to date
+        # (see etc_bundle.py)
+
+        # Addition from MCB's ETC by LRP
+        self.full['qe_hr'] = load_curve(config_files['qe'], ldo_hr)[0]
+        self.full['optics_hr'] = load_curve(config_files['optics'], ldo_hr)[0]
+        self.full['tel_hr'] = load_curve(config_files['telescope'], ldo_hr)[0]
+        self.full['trans'] = self.full['qe_hr']*self.full['optics_hr']*\
+            self.full['tel_hr']
+        # End addition
+
+        # Vega spectrum for normalizations
+        self.full['vega'] = load_curve(config_files['vega'], ldo_hr)[0]
+        self.setWindow(slice(None))
+        self.available = con.get_models()[0]
+        self.threads = SPEC_THREADS
+        # Whether the Results have the products only needed for display
+        # (the normalized source spectrum and the efficiency curves)
+        self.display = True
+
+    def setWindow(self, window):
+        """
+        Restrict the working grid (ldo_hr) and the instrument curves to the
+        slice window of the full range. Products of curves that are zero
+        outside of the window (filters) are the same, for far fewer samples
+        """
+        self.window = window
+        for name in self.full:
+            setattr(self, name, self.full[name][window])
+
+    def readConfig(self, config, operation):
+        """
+        The request fields as etc_gui reads them from the input XML: strings,
+        with the optional ones filled in
+        """
+        ff = dict(OPTIONAL_CONFIG)
+        for name, value in config.items():
+            if value is not None and not isinstance(value, str):
+                value = str(value)
+            ff[name] = value
+        ff['operation'] = operation
+        return ff
+
+    def getResult(self, lazy=None, **arrays):
+        """
+        Result of the current request, with the arrays given and, if
+        self.display, the lazy ones
+        """
+        if self.mode_oper == 'ph':
+            setup = {'filtname': self.filtname}
+        else:
+            setup = {'grismname': self.grismname, 'slitwidth': self.slitwidth,
+                     'slitloss': self.slitloss, 'specres': self.specres,
+                     'cenwl': self.cenwl, 'dpx': self.dpx,
+                     'res_ele': self.res_ele, 'ldo_px': self.ldo_px,
+                     'target_wvl': self.target_wvl}
+        return Result(config=self.ff, operation=self.ff['operation'],
+                      mag=self.mag, mag_sky=self.mag_sky, seeing=self.seeing,
+                      airmass=self.airmass, nobj=self.nobj, nsky=self.nsky,
+                      timerange=self.timerange, solution=self.solution,
+                      lazy=lazy if self.display else None,
+                      **dict(setup, **arrays))
+
+    def getExposures(self, field, nrange):
+        """Exposure times of the field, 'texp' or 'tmin-tmax' sampled nrange"""
+        # We have to break the texp into its bits
+        temp = self.ff[field].split('-')
+        if len(temp) == 1:
+            # This creates a one length array, so that len(texp) doesn't crash
+            self.texp = np.array([float(temp[0])])
+            self.timerange = 'Single'
+        else:
+            tmin = float(temp[0])
+            tmax = float(temp[1])
+            self.texp = tmin + (tmax - tmin)*np.arange(nrange)/(nrange - 1.)
+            self.timerange = 'Range'
+
+    def photometry(self, config):
+        """
+        Photometry request. The Result holds, for each exposure time texp,
+        the S/N (ston), the counts from object and sky (signal_obj,
+        signal_sky) and whether any pixel is saturated
+        """
+        # Fluxes are computed once, only the noise depends on the exposure
+        rates = self.preparePhotometry(config)
+        if self.ff['calculation'] in ['Exposure time', 'Number of frames']:
+            self.solveTarget(lambda texp, nobj, nsky: self.getPhotNoise(
+                rates, np.array([texp]), nobj, nsky)[0][0])
+        elif self.ff['calculation'] == 'Limiting magnitude':
+            scale = self.solveMagnitude(lambda k: self.getPhotNoise(
+                dict(rates, obj=k*rates['obj']), self.texp, self.nobj,
+                self.nsky)[0][0])
+            rates['obj'] = scale*rates['obj']
+
+        # Calling the function that calculates the STON
+        ston, signal_obj, signal_sky, saturated,\
+            params = self.getPhotNoise(rates, self.texp, self.nobj, self.nsky)
+        return self.getResult(texp=self.texp, ston=ston,
+                              signal_obj=signal_obj, signal_sky=signal_sky,
+                              saturated=saturated, params=params)
+
+    def spectroscopy(self, config):
+        """
+        Spectroscopy request. The Result holds, for each exposure time
+        texp, the S/N and the counts from object and sky (median over the
+        spectrum, or maximum for emission lines in 'Single' mode) and
+        whether any pixel is saturated (a bool array, as in photometry);
+        and for the last exposure time the spectra in the
+        detector pixels ldo_px: S/N (ston_px), counts (obj_px, sky_px) and the
+        normalized source (sp). efficiency holds the throughput curves over
+        wvl_full. sp and efficiency are only computed if read, and not at
+        all without self.display
+        """
+        #
+        #    Calling the function that calculates the STON
+        #
+        # Convolutions and projections are done once, only the noise
+        # depends on the exposure time and number of frames
+        rates = self.prepareSpectroscopy(config)
+
+        # Addition from MCB's ETC by LRP
+        # For display, over the full range
+        full, grism_full, filt_full = self.full, self.grism_full, \
+            self.filt_full
+
+        def efficiency():
+            return {'qe': full['qe_hr'], 'grism': grism_full,
+                    'filter': filt_full, 'optics': full['optics_hr'],
+                    'tel': full['tel_hr'],
+                    'total': full['tel_hr']*full['optics_hr']*
+                    filt_full*grism_full*full['qe_hr']}
+        if self.ff['calculation'] != 'Signal to noise' and \
+                self.ff['target_wvl'] != '':
+            self.target_wvl = float(self.ff['target_wvl'])
+            if not self.ldo_px[0] <= self.target_wvl <= self.ldo_px[-1]:
+                raise EtcError(
+                    'Target wavelength is outside of the wavelength '
+                    'coverage {0:.2f} - {1:.2f} micron'
+                    .format(self.ldo_px[0], self.ldo_px[-1]))
+        if self.ff['calculation'] in ['Exposure time', 'Number of frames']:
+            self.solveTarget(lambda texp, nobj, nsky: self.getSpecStat(
+                self.getSpecNoise(rates, texp, nobj, nsky)[0]))
+        elif self.ff['calculation'] == 'Limiting magnitude':
+            scale = self.solveMagnitude(lambda k: self.getSpecStat(
+                self.getSpecNoise(dict(rates, obj=k*rates['obj']),
+                                  self.texp[0], self.nobj, self.nsky)[0]))
+            rates['obj'] = scale*rates['obj']
+
+        if self.timerange == 'Single':
+            ston_px, obj_px, sky_px, satur\
+                = self.getSpecNoise(rates, self.texp, self.nobj, self.nsky)
+            saturated = np.array([satur], dtype=bool)
+            signal_sky = np.array([np.median(sky_px[np.nonzero(sky_px)])])
+            if self.ff['template'] == 'Emission line':
+                signal_obj = np.array([np.max(obj_px)])
+                ston = np.array([np.max(ston_px)])
+            else:
+                signal_obj = np.array([np.median(obj_px[np.nonzero(obj_px)])])
+                ston = np.array([np.median(ston_px[np.nonzero(ston_px)])])
+        else:
+            ston = np.zeros_like(self.texp)
+            saturated = np.zeros(len(self.texp), dtype=bool)
+            signal_obj = np.zeros_like(self.texp)
+            signal_sky = np.zeros_like(self.texp)
+            for i in range(len(self.texp)):
+                ston_px, obj_px, sky_px, satur\
+                    = self.getSpecNoise(rates, self.texp[i], self.nobj,
+                                        self.nsky)
+                ston[i] = np.median(ston_px[np.nonzero(ston_px)])
+                saturated[i] = satur
+                signal_obj[i] = np.median(obj_px[np.nonzero(obj_px)])
+                signal_sky[i] = np.median(sky_px[np.nonzero(sky_px)])
+        return self.getResult(texp=self.texp, ston=ston,
+                              signal_obj=signal_obj, signal_sky=signal_sky,
+                              saturated=saturated, params=rates['params'],
+                              ston_px=ston_px, obj_px=obj_px, sky_px=sky_px,
+                              wvl_full=full['ldo_hr'],
+                              lazy={'sp': rates['sp_0'],
+                                    'efficiency': efficiency})
+
+    def sweep(self, config, axes):
+        """
+        S/N over a grid of parameters. axes is a list of (name, values) with
+        names in SWEEP_AXES; the other parameters are those of config, with
+        a single exposure time if texp is not an axis. Returns a Result with
+        the axes and the arrays ston, signal_obj, signal_sky and saturated,
+        with one dimension per axis in the order given. In spectroscopy they
+        are the statistics over the spectrum of the 'Single' mode.
+
+        The physics separates: the rates are computed once per airmass, the
+        seeing changes the PSF and (spectroscopy) scales the object by the
+        slit loss, and the object rates are linear in 10**(-mag/2.5) and the
+        counts in texp. Magnitudes and exposure times are thus broadcast,
+        in chunks of at most SWEEP_CHUNK_BYTES
+        """
+        names = [name for name, values in axes]
+        if len(set(names)) != len(names) or \
+                any(name not in SWEEP_AXES for name in names):
+            raise EtcError('The sweep axes must be different elements of '
+                           '{0}'.format(', '.join(SWEEP_AXES)))
+        grid = dict((name, np.atleast_1d(np.asarray(values, dtype=float)))
+                    for name, values in axes)
+        for name in names:
+            values = grid[name]
+            low, high = SWEEP_RANGES.get(name, (None, None))
+            if len(values) == 0 or not np.isfinite(values).all() or \
+                    low is not None and values.min() < low or \
+                    high is not None and values.max() > high or \
+                    name in SWEEP_POSITIVE and values.min() <= 0:
+                raise EtcError('The values of the sweep axis {0} must be {1}'
+                               .format(name, sweep_range(name)))
+        config = dict(config, calculation='Signal to noise')
+        spectro = config['operation'] == 'Spectroscopy'
+        if spectro:
+            prepare = self.prepareSpectroscopy
+        else:
+            prepare = self.preparePhotometry
+
+        shape = None
+        for i, airmass in enumerate(grid.get('airmass', [None])):
+            if airmass is not None:
+                config['airmass'] = airmass
+            rates = prepare(config)
+            if shape is None:
+                mag0, seeing0 = self.mag, self.seeing
+                if 'texp' not in grid and len(self.texp) != 1:
+                    raise EtcError('A single Exp. time is needed if it is '
+                                   'not an axis of the sweep')
+                texp = grid.get('texp', self.texp)
+                mags = grid.get('magnitude', np.array([mag0]))
+                seeings = grid.get('seeing', np.array([seeing0]))
+                shape = (len(grid.get('airmass', [None])), len(seeings),
+                         len(mags), len(texp))
+                out = dict((name, np.zeros(shape)) for name in
+                           ['ston', 'signal_obj', 'signal_sky'])
+                out['saturated'] = np.zeros(shape, dtype=bool)
+                if not self.normalized():
+                    if 'magnitude' in grid:
+                        raise EtcError(
+                            'A magnitude axis needs a template normalized '
+                            'to the input magnitude')
+                    scale = np.ones_like(mags)
+                else:
+                    scale = 10**(-(mags - mag0)/2.5)
+                # Magnitude x exposure time points, flattened
+                scale = np.repeat(scale, len(texp))
+                texp = np.tile(texp, len(mags))
+            slitloss0 = getattr(self, 'slitloss', None)
+            for j, seeing in enumerate(seeings):
+                self.seeing = seeing
+                obj = rates['obj']
+                if spectro:
+                    self.slitloss = mod.slitpercent(seeing, self.slitwidth)
+                    obj = obj*(self.slitloss/slitloss0)
+                step = self.getSweepChunk(rates['params'])
+                for k in range(0, len(texp), step):
+                    chunk = slice(k, k + step)
+                    if spectro:
+                        ston_px, obj_px, sky_px, saturated = \
+                            self.getSpecNoise(
+                                dict(rates, obj=scale[chunk, None]*obj),
+                                texp[chunk, None], self.nobj, self.nsky)
+                        ston, signal_obj, signal_sky = \
+                            self.getSpecSummary(ston_px, obj_px, sky_px)
+                    else:
+                        ston, signal_obj, signal_sky, saturated, params = \
+                            self.getPhotNoise(dict(rates,
+                                                   obj=scale[chunk]*obj),
+                                              texp[chunk], self.nobj,
+                                              self.nsky)
+                    for name, value in [('ston', ston),
+                                        ('signal_obj', signal_obj),
+                                        ('signal_sky', signal_sky),
+                                        ('saturated', saturated)]:
+                        out[name][i, j].flat[chunk] = value
+
+        # Axes in the order given, without the ones not swept
+        perm = [SWEEP_AXES.index(name) for name in names] + \
+            [n for n, name in enumerate(SWEEP_AXES) if name not in grid]
+        for name in out:
+            out[name] = out[name].transpose(perm).reshape(
+                [len(grid[i]) for i in names])
+        return Result(config=self.ff, operation=self.ff['operation'],
+                      axes=[(name, grid[name]) for name in names],
+                      nobj=self.nobj, nsky=self.nsky, params=rates['params'],
+                      **out)
+
+    def getSweepChunk(self, params):
+        """Number of sweep points evaluated at once, from their memory"""
+        if self.mode_oper == 'sp':
+            npix = len(self.ldo_px)
+        else:
+            npix = 1 + len(mod.getaperture(
+                0.5*1.2*self.seeing/params['scale'])[0])
+        return max(1, int(SWEEP_CHUNK_BYTES//(8*SWEEP_TEMPORARIES*npix)))
+
+    def getSpecSummary(self, ston_px, obj_px, sky_px):
+        """
+        S/N and counts of the spectra along the last axis, as reported in
+        'Single' mode: the maximum for emission lines, else the median over
+        the non-zero pixels (the sky always)
+        """
+        def median(values):
+            values = values.reshape(-1, values.shape[-1])
+            nonzero = values != 0
+            # The zero pixels usually are the same in all the spectra
+            if (nonzero == nonzero[0]).all():
+                return np.median(values[:, nonzero[0]], axis=-1)
+            return np.nanmedian(np.where(nonzero, values, np.nan), axis=-1)
+        if self.ff['template'] == 'Emission line':
+            return np.max(ston_px, -1), np.max(obj_px, -1), median(sky_px)
+        return median(ston_px), median(obj_px), median(sky_px)
+
+    def preparePhotometry(self, config):
+        """
+        Set up a photometry request and return its rates: object and sky
+        photons per second through the filter (see getPhotRates)
+        """
+        self.ff = self.readConfig(config, 'Photometry')
+        self.mode_oper = 'ph'
+        self.solution = None
+
+        # Obtaining configuration parameters
+        self.mag = float(self.ff['magnitude'])
+        self.seeing = float(self.ff['seeing'])
+        self.airmass = float(self.ff['airmass'])
+        self.filtname = self.ff['photo_filter']
+
+        # Filter transmission curve. Everything is weighted by it, so only
+        # its support is needed
+        self.filt_file = con.get_filter_file(self.filtname)
+        filt_full = load_curve(self.filt_file, self.full['ldo_hr'])[0]
+        self.setWindow(mod.getwindow(self.full['ldo_hr'],
+                                     *mod.getsupport(self.full['ldo_hr'],
+                                                     filt_full)))
+        self.filt_hr = filt_full[self.window]
+
+        self.getExposures('photo_exp_time', NTEXP_PHOT)
+
+        # Number of frames
+        self.nobj = float(self.ff['photo_nf_obj'])
+        self.nsky = float(self.ff['photo_nf_sky'])
+
+        return self.getRates('phot_rates', self.getPhotRates)
+
+    def prepareSpectroscopy(self, config):
+        """
+        Set up a spectroscopy request and return its rates: object and sky
+        photons per second in each detector pixel (see getSpecRates)
+        """
+        self.ff = self.readConfig(config, 'Spectroscopy')
+        self.mode_oper = 'sp'
+        self.solution = None
+
+        # Obtaining configuration parameters
+        self.mag = float(self.ff['magnitude'])
+        self.seeing = float(self.ff['seeing'])
+        self.airmass = float(self.ff['airmass'])
+        self.slitwidth = float(self.ff['spec_slit_width'])
+        self.slitloss = mod.slitpercent(self.seeing, self.slitwidth)
+        self.grismname = self.ff['spec_grism']
+        self.target_wvl = None
+
+        # The filter transmission curve
+        #
+        self.specres, grism_file, filtname = \
+            con.get_grism_files(self.grismname)
+        self.setWindow(slice(None))
+        self.filt_file = con.get_filter_file(filtname)
+        self.filt_full = load_curve(self.filt_file, self.ldo_hr)[0]
+        self.grism_full = load_curve(grism_file, self.ldo_hr)[0]
+        self.filt_hr = self.filt_full
+        self.dispersive = self.filt_full*self.grism_full
+        # Only the support of the filter and the wavelengths seen by the
+        # detector are needed, plus room for the convolutions
+        self.getDispersion()
+        margin = 5*max(self.res_ele, self.dpx)
+        filt_lo, filt_hi = mod.getsupport(self.ldo_hr, self.filt_full)
+        self.setWindow(mod.getwindow(
+            self.ldo_hr, min(filt_lo, self.ldo_px[0]) - margin,
+            max(filt_hi, self.ldo_px[-1]) + margin))
+        self.filt_hr = self.filt_full[self.window]
+        self.grism_hr = self.grism_full[self.window]
+        self.dispersive = self.filt_hr*self.grism_hr
+        # As getSpecRates, which is skipped when its stage is memoized
+        self.getDispersion()
+
+        self.getExposures('spec_exp_time', NTEXP_SPEC)
+
+        # Number of frames
+        self.nobj = float(self.ff['spec_nf_obj'])
+        self.nsky = float(self.ff['spec_nf_sky'])
+
+        return self.getRates('spec_rates', self.getSpecRates)
+
+    def runStage(self, name, key, compute, attrs=()):
+        """
+        Memoized stage of the pipeline: the result of compute() is kept under
+        key, with the attributes attrs it sets, which are restored on hits
+        """
+        cache = _stages.setdefault(name, OrderedDict())
+        if key in cache:
+            cache.move_to_end(key)
+            value, state = cache[key]
+            self.__dict__.update(state)
+            return value
+        value = compute()
+        cache[key] = (value, dict((i, getattr(self, i)) for i in attrs
+                                  if hasattr(self, i)))
+        if len(cache) > STAGE_CACHE_SIZE:
+            cache.popitem(last=False)
+        return value
+
+    def stageKey(self, name):
+        """
+        Key of a stage of STAGES for the current request: the fields it uses,
+        the keys of the stages it is built upon, and the working window
+        """
+        fields, upstream = STAGES[name]
+        if name == 'obj':
+            fields = ['template'] + TEMPLATE_INPUTS.get(self.ff['template'],
+                                                        [])
+        values = []
+        for field in fields:
+            if field == 'model_file':
+                # The uploaded file counts by its contents
+                values.append(etc_cache.cached_hash(self.ff[field]))
+            else:
+                values.append(self.ff[field].strip())
+        return (self.window.start, self.window.stop) + tuple(values) + \
+            tuple(self.stageKey(i) for i in upstream)
+
+    def runConcurrently(self, tasks, wait=True):
+        """
+        Run the functions of the list tasks in a pool of self.threads
+        threads, or in turn if it is 1. Returns their results in the order
+        of tasks or, with wait=False, functions returning them once done,
+        so that the caller works meanwhile. The tasks only read the state
+        and make their own arrays, so the results are the same either way
+        """
+        if self.threads <= 1 or len(tasks) < 2 and wait:
+            results = [task() for task in tasks]
+            if wait:
+                return results
+            return [lambda value=value: value for value in results]
+        if (_executor['pid'], _executor['threads']) != (os.getpid(),
+                                                         self.threads):
+            if _executor['pid'] == os.getpid():
+                _executor['pool'].shutdown(wait=False)
+            _executor.update(pid=os.getpid(), threads=self.threads,
+                             pool=ThreadPoolExecutor(self.threads))
+        futures = [_executor['pool'].submit(task) for task in tasks]
+        if wait:
+            return [future.result() for future in futures]
+        return [future.result for future in futures]
+
+    def getRates(self, name, rates):
+        """
+        Rates of the stage name, computed by rates() from the sky and the
+        object only when any of the inputs of the stage changed. A copy is
+        returned, so the caller can rescale it
+        """
+        def compute():
+            self.sky_t, self.sky_e = mod.interpolatesky(self.airmass,
+                                                        self.ldo_hr)
+            self.runStage('obj', self.stageKey('obj'), self.buildObj,
+                          OBJ_ATTRS)
+            return rates()
+        return dict(self.runStage(name, self.stageKey(name), compute,
+                                  RATES_ATTRS))
+
+    def solveTarget(self, ston_at):
+        """
+        Inverse calculation: find the exposure time per frame, or the number
+        of frames, at which ston_at(texp, nobj, nsky) reaches the target S/N.
+        The solution replaces texp, nobj and nsky, so that the rest of the
+        run reports what is achieved with it
+        """
+        target = float(self.ff['target_ston'])
+        if self.ff['calculation'] == 'Exposure time':
+            texp = mod.solvetarget(
+                lambda t: ston_at(t, self.nobj, self.nsky), target)
+            solved = texp is not None
+            if solved:
+                # Round up to what is reported, so the target is still met:
+                # 0.1 s, or 3 significant digits for shorter times
+                step = min(0.1, 10**(np.floor(np.log10(texp)) - 2))
+                self.texp = np.array([np.ceil(texp/step)*step])
+        else:
+            # The sky frames keep their proportion to the object frames
+            ratio = self.nsky/self.nobj if self.nobj > 0 else 1.
+            texp = self.texp[0]
+            nobj = mod.solvetarget(
+                lambda n: ston_at(texp, n, ratio*n), target, xmax=1e5)
+            solved = nobj is not None
+            if solved:
+                self.nobj = max(1., np.ceil(nobj))
+                self.nsky = np.ceil(ratio*self.nobj)
+        if not solved:
+            raise EtcError(
+                'The target S/N = {0:.1f} can not be reached: the {1:s} '
+                'needed is out of range'
+                .format(target, self.ff['calculation'].lower()))
+        self.timerange = 'Single'
+        self.solution = {'target': target,
+                         'ston': ston_at(self.texp[0], self.nobj, self.nsky)}
+
+    def solveMagnitude(self, ston_at):
+        """
+        Limiting magnitude: the object rates scale as 10**(-mag/2.5), so
+        ston_at(k) gives the S/N of the object with its rates multiplied by k
+        without computing them again. Returns the factor that reaches the
+        target S/N and sets self.mag to the limiting magnitude. The S/N of
+        the optional list of magnitudes comes from the same relation
+        """
+        if not self.normalized():
+            raise EtcError(
+                'The limiting magnitude needs a template normalized to the '
+                'input magnitude')
+        target = float(self.ff['target_ston'])
+        scale = mod.solvetarget(ston_at, target, xmin=1e-12, xmax=1e12)
+        if scale is None:
+            raise EtcError(
+                'The target S/N = {0:.1f} can not be reached'.format(target))
+        mags = []
+        if self.ff['magnitudes'] != '':
+            mags = [float(i) for i in self.ff['magnitudes'].split(',')]
+        self.solution = {
+            'target': target, 'ston': ston_at(scale), 'magnitudes': mags,
+            'ston_mags': [ston_at(10**(-(i - self.mag)/2.5)) for i in mags]}
+        self.mag = self.mag - 2.5*np.log10(scale)
+        return scale
+
+    def normalized(self):
+        """
+        Whether the object rates scale with the input magnitude, i.e. the
+        template is normalized to it (not emission lines nor model files in
+        absolute units)
+        """
+        return not (self.ff['template'] == 'Emission line' or
+                    self.ff['template'] == 'Model file' and
+                    self.obj_units != 'normal_photon')
+
+    def getSpecStat(self, ston):
+        """
+        The S/N figure of a spectrum: at the target wavelength if any,
+        the maximum for emission lines or the median over the spectrum
+        """
+        if self.target_wvl is not None:
+            return np.interp(self.target_wvl, self.ldo_px, ston)
+        if self.ff['template'] == 'Emission line':
+            return np.max(ston)
+        return np.median(ston[np.nonzero(ston)])
+
+    def getSpecSton(self, texp=1, nobj=1, nsky=1):
+        """For Spectroscopy Get SignaltoNoise (Ston)"""
+        rates = self.getSpecRates()
+        ston_sp, obj_cnts, sky_cnts, satur = self.getSpecNoise(rates, texp,
+                                                               nobj, nsky)
+        return ston_sp, obj_cnts, sky_cnts, rates['sp_0'](), satur, \
+            rates['params']
+
+    def getSpecRates(self):
+        """
+        Exposure time independent part of getSpecSton: object and sky
+        photons per second in each detector pixel, and the normalized source
+        spectrum for display. Everything up to here is linear in texp, so
+        it is computed once for any number of exposure times (getSpecNoise)
+        """
+        params = con.get_params()
+
+        # The skymagnitude works because the catchall is Ks, and
+        # the other grisms have the same name as their respective filters
+        self.mag_sky = con.get_skymag(self.grismname)
+
+        # 1.- Calculate the wavelengths visible in the detector
+        self.getDispersion()
+
+        # 2.- Scale object & sky with Vega. Note: the per angstrom dependence
+        # of the SED is removed later, when the ldo per pixel is calculated
+
+        # In case of an emission line, there is no need to re-normalize
+
+        # CGF 02/12/16
+        if self.ff['template'] == 'Emission line':
+            no = self.obj*params['area']
+        elif (self.ff['template'] == 'Model file') & \
+                (self.obj_units != 'normal_photon'):
+            no = self.obj*params['area']
+        else:
+            no = (10**(-1*self.mag/2.5))*\
+                self.scaleToVega(self.filt_hr, False)*params['area']
+
+        # 3.- Convolve the SEDs with the proper resolution
+        #     Delta(lambda) is evaluated at the central wavelength
+
+        def obj_rates():
+            obj_hr = self.slitloss*(no*self.dispersive*self.trans*self.sky_t)
+            con_obj = mod.convolres(self.ldo_hr, obj_hr, self.res_ele)
+
+            #    4.- Integrate SEDs over the detector pixels
+            #    and estimate the Signal to Noise (STON)
+
+            if self.ff['source_type'] == 'Point':
+                return mod.pixel_int(self.ldo_hr, con_obj, self.ldo_px)
+            elif self.ff['source_type'] == 'Extended':
+                return mod.pixel_int(self.ldo_hr,
+                                     con_obj*params['scale']**2, self.ldo_px)
+
+        # Calculate original spectrum for display. Only when it is first
+        # asked for (see Result), with the state of this request
+        ldo_hr, ldo_px, slitloss, dpx = self.ldo_hr, self.ldo_px, \
+            self.slitloss, self.dpx
+        source_type = self.ff['source_type']
+
+        def display():
+            con_0 = mod.convolres(ldo_hr, slitloss*no, dpx)
+            # con_0 = mod.convolres(self.ldo_hr, self.slitloss*texp*no,
+            #                       self.cenwl/self.specres)
+            if source_type == 'Point':
+                sp_0 = mod.pixel_int(ldo_hr, con_0, ldo_px)
+
+            elif source_type == 'Extended':
+                sp_0 = mod.pixel_int(ldo_hr, con_0*params['scale']**2, ldo_px)
+            return sp_0/sp_0.max()
+
+        # The sky does not depend on the source (see getSkyRates). It runs
+        # in this thread, its segments alongside the object
+        obj_task, = self.runConcurrently([obj_rates], wait=False)
+        sp_sky = self.getSkyRates(params)
+        sp_obj = obj_task()
+        # Update by LRP from MBC, this function now returns more parameters
+        # MB 2016-09-29 return source counts as well
+        # return ston_sp, sp_0/sp_0.max(), satur
+
+        return {'obj': sp_obj, 'sky': sp_sky, 'sp_0': once(display),
+                'params': params}
+
+    def getSkyRates(self, params):
+        """
+        Sky photons per second in each detector pixel. The sky of each of the
+        segments given by con.get_sky_segments (e.g. H and K for the HK
+        grism) is scaled to the sky brightness of its band, convolved and
+        integrated over the pixels on its own. It only depends on grism,
+        airmass and slit, so it is kept for the following requests
+        """
+        key = (self.grismname, self.airmass, self.slitwidth,
+               self.window.start, self.window.stop)
+        return self.runStage('sky_rates', key,
+                             lambda: self.computeSkyRates(params))
+
+    def computeSkyRates(self, params):
+        """The sky rates of getSkyRates, without the cache"""
+        step = self.ldo_hr[1] - self.ldo_hr[0]
+        segments = []
+        for band, lo, hi in con.get_sky_segments(self.grismname):
+            # Half a sample of tolerance for the rounding of the grid
+            seg = (self.ldo_hr >= lo - 0.5*step) & (self.ldo_hr < hi - 0.5*step)
+            if self.filt_hr[seg].any():
+                segments.append((band, seg))
+        # Added in the order of the segments, whichever ends first
+        sp_sky = np.zeros_like(self.ldo_px)
+        for rates in self.runConcurrently(
+                [lambda i=i: self.getSegmentRates(params, *i)
+                 for i in segments]):
+            sp_sky += rates
+
+        sp_sky.flags.writeable = False
+        return sp_sky
+
+    def getSegmentRates(self, params, band, seg):
+        """Sky photons per second in each detector pixel from one segment"""
+        ldo_seg = self.ldo_hr[seg]
+        # Calculate ns -- sky spectrum for each segment scaled to vega
+        ns = (10**(-1*con.get_skymag(band)/2.5))*\
+            mod.vega(self.sky_e[seg], self.vega[seg], self.filt_hr[seg])*\
+            params['area']
+        # Sky spectrum scaled by the optics, filter and grism
+        # (time exposed in getSpecNoise), at the correct resolution
+        con_sky = mod.convolres(ldo_seg,
+                                ns*self.dispersive[seg]*self.trans[seg],
+                                self.res_ele)
+        # Each segment only adds flux to the pixels it covers
+        return mod.pixel_int(ldo_seg, con_sky*params['scale']**2,
+                             self.ldo_px)
+
+    def getDispersion(self):
+        """Central wavelength, dispersion, resolution element and pixels"""
+        params = con.get_params()
+        self.cenwl = (self.ldo_hr*self.dispersive).sum()/(self.dispersive).sum()
+        self.dpx = (self.cenwl/self.specres)/3.
+        self.res_ele = self.dpx*(self.slitwidth/(params['scale']))
+        self.ldo_px = (np.arange(2048) - 1024)*self.dpx + self.cenwl
+
+    def getSpecNoise(self, rates, texp=1, nobj=1, nsky=1):
+        """
+        Exposure time dependent part of getSpecSton: S/N, counts and
+        saturation for the rates given by getSpecRates.
+        Spectra are along the last axis: texp and the object rates may have
+        leading axes (e.g. texp of shape (n, 1)), which are broadcast and
+        give one spectrum and saturation flag per position
+        """
+        params = rates['params']
+        sp_obj = texp*rates['obj']
+        sp_sky = texp*rates['sky']
+
+        if self.ff['source_type'] == 'Point':
+            # No sky frame implies that reduction is as good
+            # as taking one single sky frame
+
+            if nsky == 0:
+                nsky_t = 1
+            else:
+                nsky_t = nsky
+
+            r = np.abs(np.arange(100) - 50)
+            # Receta de Peter
+            ind = np.where(r <= 1.2*self.seeing/params['scale'])[0]
+
+            # The (wavelength x spatial) image is the seeing profile times
+            # the spectrum plus the sky. The squared noise of a pixel is
+            # RON**2 + DC*texp + signal, so its sum over the aperture is
+            # that of the mean signal times the number of pixels, and the
+            # image itself is not needed
+            profile = mod.getprofile(self.seeing, 0)[ind]
+            signal = sp_obj*profile.sum()
+            spec_noise2 = len(ind)*mod.getnoise(signal/len(ind) + sp_sky,
+                                                texp)**2/nobj
+            sky_noise = mod.getnoise(sp_sky, texp)/np.sqrt(nsky_t)
+
+            # S/N calculation signal-to-noise
+            ston_sp = signal/np.sqrt(spec_noise2 + len(ind)*sky_noise**2)
+            # The brightest pixel is at the peak of the profile
+            im_peak = sp_obj*profile.max() + sp_sky
+            if im_peak.ndim > 1:
+                satur = mod.checkforsaturation(im_peak, axis=-1)
+            else:
+                satur = mod.checkforsaturation(im_peak)
+
+        elif self.ff['source_type'] == 'Extended':
+            im_noise = np.sqrt((mod.getnoise(sp_obj + sp_sky, texp)/
+                                np.sqrt(nobj))**2 +
+                               (mod.getnoise(sp_sky, texp)/np.sqrt(nsky))**2)
+
+            if sp_obj.ndim > 1:
+                satur = mod.checkforsaturation(sp_obj + sp_sky, axis=-1)
+            else:
+                satur = mod.checkforsaturation(sp_obj + sp_sky)
+            ston_sp = sp_obj/im_noise
+
+        obj_cnts = sp_obj/params['gain']
+        sky_cnts = sp_sky/params['gain']
+        return ston_sp, obj_cnts, sky_cnts, satur
+
+    def getPhotSton(self, texp=1, nobj=1, nsky=1):
+        """For Photometry"""
+        return self.getPhotNoise(self.getPhotRates(), texp, nobj, nsky)
+
+    def getPhotRates(self):
+        """
+        Exposure time independent part of getPhotSton: object and sky
+        photons per second through the filter (see getSpecRates)
+        """
+        params = con.get_params()
+        self.mag_sky = con.get_skymag(self.filtname)
+
+        #    1.- Scale object & sky with Vega
+
+        trans_to_scale = self.filt_hr*self.trans
+        # no=(10**(-1*self.mag/2.5))*mod.vega(self.obj,self.vega,trans_to_scale)\
+        #     *params['area']*float(self.ldo_hr[1]-self.ldo_hr[0])
+        #
+        #######################################################################
+        #
+        # CGF 02/12/16
+        #
+        if self.ff['template'] == 'Emission line':
+            no = self.obj*params['area']*float(self.ldo_hr[1] - self.ldo_hr[0])
+        elif (self.ff['template'] == 'Model file') & \
+                (self.obj_units != 'normal_photon'):
+            no = self.obj*params['area']*float(self.ldo_hr[1] - self.ldo_hr[0])
+        else:
+            no = (10**(-1*self.mag/2.5))\
+                *self.scaleToVega(trans_to_scale, True)\
+                *params['area']*float(self.ldo_hr[1] - self.ldo_hr[0])
+
+        #######################################################################
+        ns = (10**(-1*self.mag_sky/2.5))*\
+            mod.vega(self.sky_e, self.vega, trans_to_scale)\
+            *params['area']*float(self.ldo_hr[1]-self.ldo_hr[0])
+
+        if self.ff['template'] == 'Emission line':
+            no = no + self.obj*params['area']*float(self.ldo_hr[1] -
+                                                    self.ldo_hr[0])
+
+        #  2.- Calculate total fluxes through passbands.
+        #  The filter appears here and in step 1 because there is used
+        #  to calculate the flux under it in order to normalize the
+        #  spectra with Vega. Here is used to calculate total fluxes.
+
+        return {'obj': (no*self.filt_hr*self.sky_t).sum(),
+                'sky': (ns*self.filt_hr).sum(), 'params': params}
+
+    def getPhotNoise(self, rates, texp=1, nobj=1, nsky=1):
+        """
+        Exposure time dependent part of getPhotSton: S/N, counts and
+        saturation for the rates given by getPhotRates
+        """
+        params = rates['params']
+        texp = np.asarray(texp, dtype=float)
+        fl_obj = texp*rates['obj']
+        fl_sky = texp*rates['sky']*params['scale']**2
+
+        # In case of point-like source, we need to estimate the aperture
+        # to properly account for the effect of the RON and sky.
+        # In the case of extended sources, the estimated values are per pixel
+
+        # No sky frames: it is assumed that the reduction is as good as
+        # taking a single sky frame.
+        if nsky == 0:
+            nsky_t = 1
+        else:
+            nsky_t = nsky
+
+        # All the exposure times are computed at once, (texp x pixels)
+        # arrays are built by broadcasting
+        sky_noise = mod.getnoise(fl_sky, texp)/np.sqrt(nsky_t)
+
+        if self.ff['source_type'] == 'Point':
+            # 3.- Synthethic image generation
+            # An "image" of radii values from the center is used to see how
+            # many pixels fall inside the seeing ring.
+            # From Peter: a good guesstimate of the aperture is 1.2*seeing
+
+            ind = mod.getaperture(0.5*1.2*self.seeing/params['scale'])
+            psf = mod.getprofile(self.seeing, 1)
+
+            #    The actual STON calculation
+
+            im_obj = fl_obj[:, None]*psf[ind] + fl_sky[:, None]
+            obj_noise = mod.getnoise(im_obj, texp[:, None])/np.sqrt(nobj)
+            signal = fl_obj*psf[ind].sum()
+            ston = signal/np.sqrt((obj_noise**2).sum(1) +
+                                  len(ind[0])*sky_noise**2)
+            # The brightest pixel of the image is the peak of the PSF
+            satur = mod.checkforsaturation(
+                (fl_obj*psf.max() + fl_sky)[:, None], axis=1)
+
+            # Added by LRP from MBC's ETC
+            # MBC added 2016-11-28
+            # total counts from source and sky in aperture
+            signal_obj = signal/params['gain']
+            signal_sky = len(ind[0])*fl_sky/params['gain']
+
+        elif self.ff['source_type'] == 'Extended':
+            # For an extended sources calculate the flux per pixel
+            fl_obj = fl_obj*params['scale']**2
+            im_obj = fl_obj + fl_sky
+            obj_noise = mod.getnoise(im_obj, texp)/np.sqrt(nobj)
+            ston = fl_obj/np.sqrt(sky_noise**2 + obj_noise**2)
+            satur = mod.checkforsaturation(im_obj[:, None], axis=1)
+            # Added by LRP from MBC's ETC
+            # MBC added 2016-11-28
+            signal_obj = fl_obj/params['gain']
+            signal_sky = fl_sky/params['gain']
+
+        return ston, signal_obj, signal_sky, satur, params
+
+    def scaleToVega(self, weight, trans):
+        """
+        The SED scaled to magnitude zero under weight, the filter alone or
+        times the instrument transmission (trans), as mod.vega does.
+        Library models take the factor from the table of the bundle
+        """
+        if self.ff['template'] == 'Model library':
+            scale = vega_scales([self.model_file], self.filt_file, trans,
+                                self.full['ldo_hr'])[0]
+            if not np.isnan(scale):
+                return self.obj*scale
+        return mod.vega(self.obj, self.vega, weight)
+
+    def buildObj(self):
+        """Build the SED from the input parameters"""
+        # CGF 05/12/16
+        # Default catchall so that the units are always defined
+        self.obj_units = 'normal_photon'
+        if self.ff['template'] == 'Model library':
+            # CGF 05/12/16
+            self.model_file = 'libs/' + self.available[self.ff['model']]
+            self.obj, self.obj_units = load_curve(self.model_file,
+                                                  self.full['ldo_hr'])
+            self.obj = self.obj[self.window]
+        elif self.ff['template'] == 'Black body':
+            self.bbteff = float(self.ff['body_temp'])
+            self.obj = mod.bbody(self.ldo_hr, self.bbteff)
+            # CGF 05/12/16
+            self.obj_units = 'normal_photon'
+        elif self.ff['template'] == 'Model file':
+            # User loaded model
+            # CGF 02/12/16
+            self.obj, self.obj_units = load_curve(self.ff['model_file'],
+                                                  self.full['ldo_hr'])
+            self.obj = self.obj[self.window]
+        elif self.ff['template'] == 'Emission line':
+            # LRP: I don't understand this temp buisness
+            # ... Why do we have 3 loops that seem to do nothing???
+            # It seems to think we can have multiple emission line inputs but
+            # the php wrapper doesn't support this.
+            #
+            # The input can be several lines separated by commas
+            #
+            temp = self.ff['line_center'].split(',')
+            self.lcenter = []
+            for i in temp:
+                self.lcenter.append(float(i))
+            temp = self.ff['line_fwhm'].split(',')
+            self.lwidth = []
+            for i in temp:
+                self.lwidth.append(float(i)*1e-4)
+            temp = self.ff['line_peakf'].split(',')
+            self.lflux = []
+            for i in temp:
+                self.lflux.append(float(i)*1e-16)
+
+            # In case the number of inputs is different in any section
+
+            n_valid = np.min([len(self.lcenter), len(self.lwidth),
+                             len(self.lflux)])
+            self.lcenter = self.lcenter[0:n_valid]
+            self.lwidth = self.lwidth[0:n_valid]
+            self.lflux = self.lflux[0:n_valid]
+            # On the full grid, so that a line cut by the window keeps only
+            # the flux falling in it
+            self.obj = np.zeros_like(self.full['ldo_hr'])
+            for i in range(len(self.lflux)):
+                self.obj += mod.emline(self.full['ldo_hr'], self.lcenter[i],
+                                       self.lwidth[i], self.lflux[i])
+            self.obj = self.obj[self.window]
+            ###################################################################
+            # CGF 05/12/16
+            self.obj_units = 'photon/s/m2/micron'
+            # mod.emline outputs in photon/s/m2/micron
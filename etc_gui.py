@@ -54,618 +54,104 @@ Updated to add the Y filter as an option in photometry
 Added version numer as v1.0
 
 """
-import numpy as np
 import sys
 import xml.etree.ElementTree as ET
 from optparse import OptionParser
 
 import emir_guy
-import etc_config as con
-import etc_modules as mod
-from etc_classes import SpecCurve
-
-import matplotlib
-matplotlib.use('Agg')  # Do we actually need agg?
-import matplotlib.pylab as plt
+import etc_cache
+import etc_plot
+from etc_engine import SPEC_THREADS, Engine, EtcError
 
 description = ">> Exposure Time Calculator for EMIR. Contact Lee Patrick"
-usage = "%prog [options]"
+usage = "%prog [options] fname"
 
-if len(sys.argv) == 1:
-    print(help)
-    sys.exit()
-parser = OptionParser(usage=usage, description=description)
-parser.add_option("-d", "--directory", dest="directory",
-                  default='', help='Path of the xml file \n  [%default]')
-option, args = parser.parse_args()
 
+def seconds(texp):
+    """
+    Exposure time for the output, to the precision of the solved ones
+    (Engine.solveTarget): 0.1 s, or 3 significant digits below 10 s
+    """
+    if texp >= 10:
+        return '{0:.1f}'.format(texp)
+    return '{0:#.3g}'.format(texp)
 
-class EmirGui:
-    """GUI for the ETC"""
 
-    def __init__(self):
-        """Initialise"""
-        # When the application is loaded, all the fixed elements of the system
-        # (optics, etc.) plus the sky curves are loaded
-        global ff
-        config_files = con.get_config()
-        # Changed to 80000 by LRP on 04-04-2017
-        self.ldo_hr = (8000 + np.arange(100001)*0.2)*1e-4
+class EmirGui(Engine):
+    """GUI for the ETC: the results of the Engine as XML and figures"""
 
-        # Fixed elements of the system
+    def __init__(self, fname=None):
+        """
+        Initialise
 
-        qe = SpecCurve(config_files['qe'])
-        optics = SpecCurve(config_files['optics'])
-        tel = SpecCurve(config_files['telescope'])
+        Only the instrument state is built here, so that a resident process
+        (see etc_server.py) can keep it warm and serve many requests with
+        run(). For backwards compatibility, giving fname runs that request.
+        """
+        super(EmirGui, self).__init__()
 
-        # Addition from MCB's ETC by LRP
-        self.qe_hr = qe.interpolate(self.ldo_hr)
-        self.optics_hr = optics.interpolate(self.ldo_hr)
-        self.tel_hr = tel.interpolate(self.ldo_hr)
-        self.trans = self.qe_hr*self.optics_hr*self.tel_hr
-        # End addition
+        # Identical requests are served from the result cache (etc_cache.py)
+        self.use_cache = True
 
-        # Vega spectrum for normalizations
-        self.vega = SpecCurve(config_files['vega']).interpolate(self.ldo_hr)
+        if fname is not None:
+            self.run(fname)
 
+    def run(self, fname):
+        """
+        Process one request: read fname.xml and write fname_out.xml plus the
+        figures. Errors are reported through the output XML, as emir_guy does.
+        """
+        self.fname = fname
         try:
-            ff = emir_guy.readxml(args[0] + '.xml')
+            try:
+                self.ff = emir_guy.readxml(self.fname + '.xml')
+            except:
+                print("ERROR opening XML file")
+                exit()
+
+            emir_guy.check_inputs(self.ff, self.fname)
+
+            key = None
+            if self.use_cache:
+                key = etc_cache.request_key(self.ff)
+                if key is not None and etc_cache.fetch(key, self.fname):
+                    return
+
+            # Functions for options:
+            if self.ff['operation'] == 'Photometry':
+                self.doPhotometry()
+            elif self.ff['operation'] == 'Spectroscopy':
+                self.doSpectroscopy()
+
+            # Only successful results are kept: errors exit above
+            if key is not None:
+                etc_cache.store(key, self.fname)
+        except SystemExit:
+            pass
         except:
-            print("ERROR opening XML file")
-            exit()
-
-        emir_guy.load(self)
-        emir_guy.check_inputs(ff, args[0])
-
-        # Functions for options:
-        if ff['operation'] == 'Photometry':
-            self.doPhotometry()
-        elif ff['operation'] == 'Spectroscopy':
-            self.doSpectroscopy()
+            emir_guy.generic_error(self.fname)
 
     def doPhotometry(self):
-        """Photometry initialisations"""
-        self.mode_oper = 'ph'
-
-        # Obtaining configuration parameters from GUI
-        self.mag = float(ff['magnitude'])
-        self.seeing = float(ff['seeing'])
-        self.airmass = float(ff['airmass'])
-        self.sky_t, self.sky_e = mod.interpolatesky(self.airmass, self.ldo_hr)
-        self.filtname = ff['photo_filter']
-
-        self.buildObj()
-        # We have to break the texp into its bits
-        temp = ff['photo_exp_time'].split('-')
-        if len(temp) == 1:
-            # This creates a one length array, so that len(texp) doesn't crash
-            self.texp = np.array([float(temp[0])])
-            self.timerange = 'Single'
-        else:
-            tmin = float(temp[0])
-            tmax = float(temp[1])
-            self.texp = tmin + (tmax - tmin)*np.arange(100)/99.
-            self.timerange = 'Range'
-
-        # Number of frames
-        self.nobj = float(ff['photo_nf_obj'])
-        self.nsky = float(ff['photo_nf_sky'])
-
-        # Filter transmission curve
-        self.filt = con.get_filter(self.filtname)
-        self.filt_hr = self.filt.interpolate(self.ldo_hr)
-
-        # Calling the function that calculates the STON
-        ston, signal_obj, signal_sky, saturated,\
-            params = self.getPhotSton(self.texp, self.nobj, self.nsky)
-        if self.timerange == 'Range':
-            # self.printResults(self.texp,ston,saturated)
-            self.printXML(self.texp, signal_obj, signal_sky,
-                          ston, saturated, **params)
-            plt.plot(self.texp*self.nobj, ston)  # Update by LRP 28-11-2016
-            plt.xlabel('Exposure time (seconds)')
-            if ff['source_type'] == 'Point':
-                plt.ylabel('S/N')
-            if ff['source_type'] == 'Extended':
-                plt.ylabel('S/N per pixel')
-            plt.savefig(args[0] + '_photo.png')
-        else:
-            self.printXML(self.texp, signal_obj, signal_sky,
-                          ston, saturated, **params)
-            # TODO: Create some meaniningful graphic output!
+        """Photometry: output XML and figure"""
+        try:
+            res = self.photometry(self.ff)
+        except EtcError as err:
+            emir_guy.solution_error(str(err), self.fname)
+        self.printXML(res)
+        if res.timerange == 'Range':
+            etc_plot.photometry_figure(res, self.fname + '_photo.png')
+        # TODO: Create some meaniningful graphic output for 'Single'!
 
     def doSpectroscopy(self):
-        """Spectroscopy initialisations"""
-        self.mode_oper = 'sp'
-
-        # Obtaining configuration parameters from GUI
-        self.mag = float(ff['magnitude'])
-        self.seeing = float(ff['seeing'])
-        self.airmass = float(ff['airmass'])
-        self.slitwidth = float(ff['spec_slit_width'])
-        self.slitloss = mod.slitpercent(self.seeing, self.slitwidth)
-
-        self.sky_t, self.sky_e = mod.interpolatesky(self.airmass, self.ldo_hr)
-        self.grismname = ff['spec_grism']
-        self.buildObj()
-
-        #    We have to break the texp into its bits
-        temp = ff['spec_exp_time'].split('-')
-        if len(temp) == 1:
-            # This creates a one length array, so that len(texp) does't crash
-            self.texp = np.array([float(temp[0])])
-            self.timerange = 'Single'
-        else:
-            tmin = float(temp[0])
-            tmax = float(temp[1])
-            self.texp = tmin + (tmax - tmin)*np.arange(10)/9.
-            self.timerange = 'Range'
-
-        # Number of frames
-        self.nobj = float(ff['spec_nf_obj'])
-        self.nsky = float(ff['spec_nf_sky'])
-
-        # The filter transmission curve
-        #
-        self.specres, self.grism, self.filt = con.get_grism(self.grismname)
-        self.filt_hr = self.filt.interpolate(self.ldo_hr)
-        self.grism_hr = self.grism.interpolate(self.ldo_hr)
-        self.dispersive = self.filt_hr*self.grism_hr
-        # Addition from MCB's ETC by LRP
-        self.efftotal_hr = self.tel_hr*self.optics_hr*self.filt_hr*\
-            self.grism_hr*self.qe_hr
-        #
-        #    Calling the function that calculates the STON
-        #
-        if self.timerange == 'Single':
-            ston, src_cnts, sky_cnts, sp,\
-                saturated, params = self.getSpecSton(self.texp, self.nobj,
-                                                     self.nsky)
-            if ff['template'] == 'Emission line':
-                self.printXML(self.texp, [np.max(src_cnts)],
-                              [np.median(sky_cnts[np.nonzero(sky_cnts)])],
-                              [np.max(ston)],
-                              saturated, **params)
-            else:
-                self.printXML(self.texp,
-                              [np.median(src_cnts[np.nonzero(src_cnts)])],
-                              [np.median(sky_cnts[np.nonzero(sky_cnts)])],
-                              [np.median(ston[np.nonzero(ston)])],
-                              saturated, **params)
-
-            # Create some figures:
-            plt.figure(1, figsize=(15., 10.))
-            plt.subplot(321)
-            plt.plot(self.ldo_px, ston, color='b')
-            med_spec = np.median(ston[np.nonzero(ston)])
-            x_med = np.linspace(self.ldo_px[0], self.ldo_px[-1])
-            plt.plot(x_med, np.linspace(med_spec, med_spec), color='r')
-            plt.xlim(self.ldo_px[0], self.ldo_px[-1])
-            plt.xlabel('Wavelength (micron)')
-            if ff['source_type'] == 'Point':
-                plt.ylabel('S/N')
-            if ff['source_type'] == 'Extended':
-                plt.ylabel('S/N per pixel')
-
-            plt.subplot(323)
-            plt.plot(self.ldo_px, src_cnts)
-            plt.plot(self.ldo_px, sky_cnts)
-            plt.xlim(self.ldo_px[0], self.ldo_px[-1])
-            plt.xlabel('Wavelength (micron)')
-            plt.ylabel('Source ADU/pixel')
-            plt.grid()
-
-            plt.subplot(325)
-            plt.plot(self.ldo_px, sp)
-            plt.xlim(self.ldo_px[0], self.ldo_px[-1])
-            plt.xlabel('Wavelength (micron)')
-            plt.ylabel('Normalized src flux')
-
-            plt.subplot(322)
-            plt.plot(self.ldo_hr, self.qe_hr, '-r', label='Det')
-            plt.plot(self.ldo_hr, self.grism_hr, '--c', label='Grism')
-            plt.plot(self.ldo_hr, self.filt_hr, '-c', label='Filter')
-            plt.plot(self.ldo_hr, self.optics_hr, '-b', label='Optics')
-            plt.plot(self.ldo_hr, self.tel_hr, '--b', label='Tel')
-            plt.plot(self.ldo_hr, self.efftotal_hr, '-k', label='Qtot')
-            plt.xlim(self.ldo_px[0], self.ldo_px[-1])
-            plt.legend(bbox_to_anchor=(1.3, 1.05))
-            plt.xlabel('Wavelength (micron)')
-            plt.ylabel('efficiency / band')
-
-            plt.subplot(324)
-            plt.plot(self.ldo_hr, self.efftotal_hr, '-k', label='Qtot')
-            plt.xlim(self.ldo_px[0], self.ldo_px[-1])
-            plt.legend(bbox_to_anchor=(1.3, 1.05))
-            plt.xlabel('Wavelength (micron)')
-            plt.ylabel('Eff Tel to Det')
-
-            plt.subplot(326)
-            plt.plot(self.ldo_hr, self.qe_hr, '-r', label='Det')
-            plt.plot(self.ldo_hr, self.grism_hr, '--c', label='Grism')
-            plt.plot(self.ldo_hr, self.filt_hr, '-c', label='Filter')
-            plt.plot(self.ldo_hr, self.optics_hr, '-b', label='Optics')
-            plt.plot(self.ldo_hr, self.tel_hr, '--b', label='Tel')
-            plt.plot(self.ldo_hr, self.efftotal_hr, '-k', label='Qtot')
-            plt.legend(bbox_to_anchor=(1.3, 1.05))
-            plt.xlabel('Wavelength (micron)')
-            plt.ylabel('Efficiency full EMIR range')
-            # End of figures
-
-        if self.timerange == 'Range':
-
-            ston = np.zeros_like(self.texp)
-            saturated = np.zeros_like(self.texp)
-            src_med_cnts = np.zeros_like(self.texp)
-            sky_med_cnts = np.zeros_like(self.texp)
-            for i in range(len(self.texp)):
-                temp, src_cnts, sky_cnts, sp, satur, params\
-                    = self.getSpecSton(self.texp[i], self.nobj, self.nsky)
-                ston[i] = np.median(temp[np.nonzero(temp)])
-                saturated[i] = satur
-                src_med_cnts[i] = np.median(src_cnts[np.nonzero(src_cnts)])
-                sky_med_cnts[i] = np.median(sky_cnts[np.nonzero(sky_cnts)])
-                self.printXML(self.texp, src_med_cnts, sky_med_cnts,
-                              ston, saturated, **params)
-                # self.printXML(self.texp,src_cnts,sky_cnts,ston,saturated,params)
-
-            temp, src_cnts, sky_cnts, sp, temp2, params\
-                = self.getSpecSton(self.texp[i], self.nobj, self.nsky)
-            # Additional figure for an inputed range of exposure times
-            plt.figure(1)
-            plt.subplot(211)
-            plt.plot(self.ldo_px, temp)
-            plt.xlabel('Wavelength (micron)')
-            if ff['source_type'] == 'Point':
-                plt.ylabel('S/N at texp = {0:.1f}'.format(self.texp[-1]))
-            if ff['source_type'] == 'Extended':
-                plt.ylabel('S/N per pixel at texp = {0:.1f}'
-                           .format(self.texp[-1]))
-
-            plt.subplot(212)
-            plt.plot(self.ldo_px, sp)
-            plt.xlabel('Wavelength (micron)')
-            plt.ylabel('Normalized src flux')
-        plt.savefig(args[0]+'_spec.png')
-
-    def getSpecSton(self, texp=1, nobj=1, nsky=1):
-        """For Spectroscopy Get SignaltoNoise (Ston)"""
-        params = con.get_params()
-
-        # The skymagnitude works because the catchall is Ks, and
-        # the other grisms have the same name as their respective filters
-        self.mag_sky = con.get_skymag(self.grismname)
-
-        # 1.- Calculate the wavelengths visible in the detector
-        self.cenwl = (self.ldo_hr*self.dispersive).sum()/(self.dispersive).sum()
-        self.dpx = (self.cenwl/self.specres)/3.
-        self.res_ele = self.dpx*(self.slitwidth/(params['scale']))
-        self.ldo_px = (np.arange(2048) - 1024)*self.dpx + self.cenwl
-
-        # 2.- Scale object & sky with Vega. Note: the per angstrom dependence
-        # of the SED is removed later, when the ldo per pixel is calculated
-
-        # In case of an emission line, there is no need to re-normalize
-
-        # CGF 02/12/16
-        if ff['template'] == 'Emission line':
-            no = self.obj*params['area']
-        elif (ff['template'] == 'Model file') & \
-                (self.obj_units != 'normal_photon'):
-            no = self.obj*params['area']
-        else:
-            no = (10**(-1*self.mag/2.5))*\
-                mod.vega(self.obj, self.vega, self.filt_hr)*params['area']
-
-        # 3.- Convolve the SEDs with the proper resolution
-        #     Delta(lambda) is evaluated at the central wavelength
-
-        con_obj = mod.convolres(self.ldo_hr,
-                                texp*self.slitloss*(no*self.dispersive*
-                                                    self.trans*self.sky_t),
-                                self.res_ele)
-        # Added by LRP from FGL's code:
-        # Get this working for the HK grism then we can tune it up and add the
-        # YJ girms
-        if self.grismname == 'HK':
-            # Split spectra into two parts:
-            # lambda:
-            lhr_b = np.arange(12000, 18998, .2)*1e-4
-            lhr_r = np.arange(19000, 27000, .2)*1e-4
-            # Vega:
-            vflux_b = mod.spec_int(self.ldo_hr, self.vega, lhr_b)
-            vflux_r = mod.spec_int(self.ldo_hr, self.vega, lhr_r)
-            # Sky:
-            sflux_b = mod.spec_int(self.ldo_hr, self.sky_e, lhr_b)
-            sflux_r = mod.spec_int(self.ldo_hr, self.sky_e, lhr_r)
-            # Filter transmission:
-            ftr_b = mod.spec_int(self.ldo_hr, self.filt_hr, lhr_b).clip(0, 1)
-            ftr_r = mod.spec_int(self.ldo_hr, self.filt_hr, lhr_r).clip(0, 1)
-            # Dispersion (fliter*grism)
-            disp_b = mod.spec_int(self.ldo_hr, self.dispersive, lhr_b).clip(0, 1)
-            disp_r = mod.spec_int(self.ldo_hr, self.dispersive, lhr_r).clip(0, 1)
-            # Telescope optics:
-            otr_b = mod.spec_int(self.ldo_hr, self.trans, lhr_b).clip(0, 1)
-            otr_r = mod.spec_int(self.ldo_hr, self.trans, lhr_r).clip(0, 1)
-            # Calculate ns -- sky spectrum for each filter scaled to vega
-            ns_b = (10**(-1*con.get_skymag('H')/2.5))*\
-                mod.vega(sflux_b, vflux_b, ftr_b)*params['area']
-
-            ns_r = (10**(-1*con.get_skymag('K')/2.5))*\
-                mod.vega(sflux_r, vflux_r, ftr_r)*params['area']
-            # import pdb; pdb.set_trace()
-
-            # Sky spectra for ETC parameters
-            # scale sky spectrum by ETC parameters for:
-            # time exposed, optics, filter and grirms
-            # disp = (filt*grism)
-            sky_hr_b = texp*(ns_b*otr_b*disp_b)  # *self.slitloss*0.2
-            sky_hr_r = texp*(ns_r*otr_r*disp_r)  # *self.slitloss*0.2
-            # Sky spectra at correct resolution
-            con_sky_b = mod.convolres(lhr_b, sky_hr_b, self.res_ele)
-            con_sky_r = mod.convolres(lhr_r, sky_hr_r, self.res_ele)
-            sp_sky_blue = self.dpx*mod.spec_int(lhr_b,
-                                                con_sky_b*params['scale']**2,
-                                                self.ldo_px)
-            sp_sky_red = self.dpx*mod.spec_int(lhr_r,
-                                               con_sky_r*params['scale']**2,
-                                               self.ldo_px)
-            # Cheap fix to an interpolation problem:
-            sp_sky_blue[np.where(self.ldo_px > 1.9)] = 0.0
-            sp_sky_red[np.where(self.ldo_px < 1.9)] = 0.0
-            sp_sky = sp_sky_blue + sp_sky_red
-        else:
-            # Sky
-            ns = (10**(-1*self.mag_sky/2.5))*\
-                mod.vega(self.sky_e, self.vega, self.filt_hr)*params['area']
-
-            con_sky = mod.convolres(self.ldo_hr,
-                                    texp*(ns*self.dispersive*self.trans),
-                                    self.res_ele)
-
-            #    4.- Interpolate SEDs over the observed wavelengths
-            #    and estimate the Signal to Noise (STON)
-
-            sp_sky = self.dpx*mod.spec_int(self.ldo_hr,
-                                           con_sky*params['scale']**2,
-                                           self.ldo_px)
-
-        if ff['source_type'] == 'Point':
-            sp_obj = self.dpx*mod.spec_int(self.ldo_hr, con_obj, self.ldo_px)
-            im_spec = np.zeros((len(sp_obj), 100))
-            im_sky = np.zeros((len(sp_obj), 100))
-            total_noise = np.zeros((len(sp_obj), 100))
-
-            # No sky frame implies that reduction is as good
-            # as taking one single sky frame
+        """Spectroscopy: output XML and figures"""
+        try:
+            res = self.spectroscopy(self.ff)
+        except EtcError as err:
+            emir_guy.solution_error(str(err), self.fname)
+        self.printXML(res)
+        etc_plot.spectroscopy_figure(res, self.fname + '_spec.png')
 
-            if nsky == 0:
-                nsky_t = 1
-            else:
-                nsky_t = nsky
-
-            for i in range(len(sp_obj)):
-                im_spec[i, :] = mod.getspread(sp_obj[i], self.seeing, 0) + sp_sky[i]
-                im_sky[i, :] = sp_sky[i]
-
-                spec_noise = mod.getnoise(im_spec[i, :], texp)/np.sqrt(nobj)
-                sky_noise = mod.getnoise(im_sky[i, :], texp)/np.sqrt(nsky_t)
-                total_noise[i, :] = np.sqrt(spec_noise**2 + sky_noise**2)
-
-            r = np.abs(np.arange(100) - 50)
-            # Receta de Peter
-            ind = np.where(r <= 1.2*self.seeing/params['scale'])[0]
-
-            # S/N calculation signal-to-noise
-            ston_sp = (im_spec - im_sky)[:, ind].sum(1)/\
-                np.sqrt((total_noise[:, ind]**2).sum(1))
-            satur = mod.checkforsaturation(im_spec[:, ind])
-
-        elif ff['source_type'] == 'Extended':
-            sp_obj = self.dpx*mod.spec_int(self.ldo_hr,
-                                           con_obj*params['scale']**2,
-                                           self.ldo_px)
-            im_noise = np.sqrt((mod.getnoise(sp_obj + sp_sky, texp)/
-                                np.sqrt(nobj))**2 +
-                               (mod.getnoise(sp_sky, texp)/np.sqrt(nsky))**2)
-
-            satur = mod.checkforsaturation(sp_obj + sp_sky)
-            ston_sp = sp_obj/im_noise
-
-        # Calculate original spectrum for display
-
-        con_0 = mod.convolres(self.ldo_hr, self.slitloss*texp*no, self.dpx)
-        # con_0 = mod.convolres(self.ldo_hr, self.slitloss*texp*no,
-        #                       self.cenwl/self.specres)
-        if ff['source_type'] == 'Point':
-            sp_0 = mod.spec_int(self.ldo_hr, con_0, self.ldo_px)*self.dpx
-
-        elif ff['source_type'] == 'Extended':
-            sp_0 = self.dpx*mod.spec_int(self.ldo_hr, con_0*params['scale']**2,
-                                         self.ldo_px)
-        # Update by LRP from MBC, this function now returns more parameters
-        # MB 2016-09-29 return source counts as well
-        # return ston_sp, sp_0/sp_0.max(), satur
-
-        obj_cnts = sp_obj/params['gain']
-        sky_cnts = sp_sky/params['gain']
-        return ston_sp, obj_cnts, sky_cnts, sp_0/sp_0.max(), satur, params
-
-    def getPhotSton(self, texp=1, nobj=1, nsky=1):
-        """For Photometry"""
-        params = con.get_params()
-        self.mag_sky = con.get_skymag(self.filtname)
-        ston = np.zeros_like(texp)
-        satur = np.zeros_like(texp)
-        # Added by LRP from MBC's ETC
-        signal_obj = np.zeros_like(texp)
-        signal_sky = np.zeros_like(texp)
-
-        #    1.- Scale object & sky with Vega
-
-        trans_to_scale = self.filt_hr*self.trans
-        # no=(10**(-1*self.mag/2.5))*mod.vega(self.obj,self.vega,trans_to_scale)\
-        #     *params['area']*float(self.ldo_hr[1]-self.ldo_hr[0])
-        #
-        #######################################################################
-        #
-        # CGF 02/12/16
-        #
-        if ff['template'] == 'Emission line':
-            no = self.obj*params['area']*float(self.ldo_hr[1] - self.ldo_hr[0])
-        elif (ff['template'] == 'Model file') & \
-                (self.obj_units != 'normal_photon'):
-            no = self.obj*params['area']*float(self.ldo_hr[1] - self.ldo_hr[0])
-        else:
-            no = (10**(-1*self.mag/2.5))\
-                *mod.vega(self.obj, self.vega, trans_to_scale)\
-                *params['area']*float(self.ldo_hr[1] - self.ldo_hr[0])
-
-        #######################################################################
-        ns = (10**(-1*self.mag_sky/2.5))*\
-            mod.vega(self.sky_e, self.vega, trans_to_scale)\
-            *params['area']*float(self.ldo_hr[1]-self.ldo_hr[0])
-
-        if ff['template'] == 'Emission line':
-            no = no + self.obj*params['area']*float(self.ldo_hr[1] -
-                                                    self.ldo_hr[0])
-
-        #  2.- Calculate total fluxes through passbands.
-        #  The filter appears here and in step 1 because there is used
-        #  to calculate the flux under it in order to normalize the
-        #  spectra with Vega. Here is used to calculate total fluxes.
-
-        fl_obj = texp*(no*self.filt_hr*self.sky_t).sum()
-        fl_sky = texp*(ns*self.filt_hr).sum()*params['scale']**2
-
-        # In case of point-like source, we need to estimate the aperture
-        # to properly account for the effect of the RON and sky.
-        # In the case of extended sources, the estimated values are per pixel
-
-        if ff['source_type'] == 'Point':
-            # 3.- Synthethic image generation
-            # An "image" of radii values from the center is used to see how
-            # many pixels fall inside the seeing ring.
-
-            im_r = np.zeros((100, 100))
-            x = np.arange(100)
-            for i in range(0, 100):
-                im_r[i, ] = np.sqrt((float(i) - 50.0)**2 + (x - 50.0)**2)
-
-            # From Peter: a good guesstimate of the aperture is 1.2*seeing
-
-            ind = np.where(im_r <= 0.5*1.2*self.seeing / params['scale'])
-
-            #    The actual STON calculation
-
-            for i in range(len(texp)):
-                im_obj = mod.getspread(fl_obj[i], self.seeing, 1) + fl_sky[i]
-                im_sky = np.zeros_like(im_obj) + fl_sky[i]
-
-                if nsky == 0:
-                    # For no sky frames is assumed that the reduction
-                    # is as good as taking a single sky frame.
-                    sky_noise = mod.getnoise(im_sky, texp[i])
-                else:
-                    sky_noise = mod.getnoise(im_sky, texp[i]) / np.sqrt(nsky)
-
-                obj_noise = mod.getnoise(im_obj, texp[i]) / np.sqrt(nobj)
-                total_noise = np.sqrt(sky_noise**2 + obj_noise**2)
-                ston[i] = (im_obj - im_sky)[ind].sum()\
-                    / np.sqrt((total_noise[ind]**2).sum())
-                satur[i] = mod.checkforsaturation(im_obj)
-
-                # Added by LRP from MBC's ETC
-                # MBC added 2016-11-28
-                # total counts from source and sky in aperture
-                signal_obj[i] = (im_obj - im_sky)[ind].sum() / params['gain']
-                signal_sky[i] = im_sky[ind].sum() / params['gain']
-                # print('Signal_obj[i] {}'.format(signal_obj[i]))
-                # print('Signal_sky[i] {}'.format(signal_sky[i]))
-
-        elif ff['source_type'] == 'Extended':
-            # For an extended sources calculate the flux per pixel
-            fl_obj = fl_obj*params['scale']**2
-            for i in range(len(texp)):
-                im_obj = np.ones(1)*(fl_obj[i] + fl_sky[i])
-                im_sky = np.ones(1)*fl_sky[i]
-
-                if nsky == 0:
-                    # For no sky frames is assumed that the reduction
-                    # is as good as taking a single sky frame.
-                    sky_noise = mod.getnoise(im_sky, texp[i])
-                else:
-                    sky_noise = mod.getnoise(im_sky, texp[i])/ np.sqrt(nsky)
-                obj_noise = mod.getnoise(im_obj, texp[i])/ np.sqrt(nobj)
-                total_noise = np.sqrt(sky_noise**2 + obj_noise**2)
-                ston[i] = (im_obj-im_sky) / total_noise
-                satur[i] = mod.checkforsaturation(im_obj)
-                # Added by LRP from MBC's ETC
-                # MBC added 2016-11-28
-                signal_obj[i] = (im_obj - im_sky) / params['gain']
-                signal_sky[i] = im_sky / params['gain']
-
-        return ston, signal_obj, signal_sky, satur, params
-
-    def buildObj(self):
-        """Build the SED from the input parameters"""
-        # CGF 05/12/16
-        # Default catchall so that the units are always defined
-        self.obj_units = 'normal_photon'
-        if ff['template'] == 'Model library':
-            # CGF 05/12/16
-            temp_curve = SpecCurve('libs/' + self.available[ff['model']])
-            self.obj = temp_curve.interpolate(self.ldo_hr)
-            self.obj_units = temp_curve.unity
-        elif ff['template'] == 'Black body':
-            self.bbteff = float(ff['body_temp'])
-            self.obj = mod.bbody(self.ldo_hr, self.bbteff)
-            # CGF 05/12/16
-            self.obj_units = 'normal_photon'
-        elif ff['template'] == 'Model file':
-            # User loaded model
-            # CGF 02/12/16
-            temp_curve = SpecCurve(ff['model_file'])
-            self.obj = temp_curve.interpolate(self.ldo_hr)
-            self.obj_units = temp_curve.unity
-        elif ff['template'] == 'Emission line':
-            # LRP: I don't understand this temp buisness
-            # ... Why do we have 3 loops that seem to do nothing???
-            # It seems to think we can have multiple emission line inputs but
-            # the php wrapper doesn't support this.
-            #
-            # The input can be several lines separated by commas
-            #
-            temp = ff['line_center'].split(',')
-            self.lcenter = []
-            for i in temp:
-                self.lcenter.append(float(i))
-            temp = ff['line_fwhm'].split(',')
-            self.lwidth = []
-            for i in temp:
-                self.lwidth.append(float(i)*1e-4)
-            temp = ff['line_peakf'].split(',')
-            self.lflux = []
-            for i in temp:
-                self.lflux.append(float(i)*1e-16)
-
-            # In case the number of inputs is different in any section
-
-            n_valid = np.min([len(self.lcenter), len(self.lwidth),
-                             len(self.lflux)])
-            self.lcenter = self.lcenter[0:n_valid]
-            self.lwidth = self.lwidth[0:n_valid]
-            self.lflux = self.lflux[0:n_valid]
-            self.obj = np.zeros_like(self.ldo_hr)
-            for i in range(len(self.lflux)):
-                self.obj += mod.emline(self.ldo_hr, self.lcenter[i],
-                                       self.lwidth[i], self.lflux[i])
-            ###################################################################
-            # CGF 05/12/16
-            self.obj_units = 'photon/s/m2/micron'
-            # mod.emline outputs in photon/s/m2/micron
-
-    def printXML(self, texp, signal_obj, signal_sky, ston, satur, **params):
+    def printXML(self, res):
         """
         A function to create the output XML files
         Updated to inlucde more output by LRP 08-12-2016
@@ -674,44 +160,46 @@ class EmirGui:
         Would this would be quicker if we just had a few if statements and put
         output for each case together -- also may cause fewer errors!
         """
+        texp, signal_obj, signal_sky = res.texp, res.signal_obj, res.signal_sky
+        ston, satur, params = res.ston, res.saturated, res.params
         output = ET.Element("output")
 
-        if ff['operation'] == 'Photometry':
-            fig_name = args[0] + "_photo.png"
+        if res.config['operation'] == 'Photometry':
+            fig_name = self.fname + "_photo.png"
         else:
-            fig_name = args[0] + "_spec.png"
+            fig_name = self.fname + "_spec.png"
 
         ET.SubElement(output, "fig").text = fig_name
 
         ET.SubElement(output, "text").text = "SOURCE:"
         ET.SubElement(output, "text").text = "{0:s} Source (Vega Mag) = {1:.3f}".\
-            format(ff['source_type'], self.mag)
-        if ff['template'] == 'Model library':
+            format(res.config['source_type'], res.mag)
+        if res.config['template'] == 'Model library':
             ET.SubElement(output, "text").text = "Template: Model library"
-            ET.SubElement(output, "text").text= "Spectral Type: {0:s}".format(ff['model'])
-        elif ff['template'] == 'Black body':
+            ET.SubElement(output, "text").text= "Spectral Type: {0:s}".format(res.config['model'])
+        elif res.config['template'] == 'Black body':
             ET.SubElement(output, "text").text = "Template: Black Body"
-            ET.SubElement(output, "text").text = "Temperature = {0:.1f} K".format(float(ff['body_temp']))
-        elif ff['template'] == 'Emission line':
+            ET.SubElement(output, "text").text = "Temperature = {0:.1f} K".format(float(res.config['body_temp']))
+        elif res.config['template'] == 'Emission line':
             ET.SubElement(output, "text").text = "Template: Emission Line"
             ET.SubElement(output, "text").text = "Center = {0:s}, FWHM = {1:s}, Total line flux = {2:s}"\
-                .format(ff['line_center'], ff['line_fwhm'], ff['line_peakf'])
-        elif ff['template'] == 'Model file':
+                .format(res.config['line_center'], res.config['line_fwhm'], res.config['line_peakf'])
+        elif res.config['template'] == 'Model file':
             ET.SubElement(output, "text").text = "Template: Model file"
-            ET.SubElement(output, "text").text = "Model file = {0:s}".format(ff['model_file'])
+            ET.SubElement(output, "text").text = "Model file = {0:s}".format(res.config['model_file'])
 
         ET.SubElement(output, "text").text = "----------------------------------------------------------------"
         ET.SubElement(output, "text").text = "OBSERVATION:"
-        ET.SubElement(output, "text").text = "Operation: {0:s}".format(ff['operation'])
-        ET.SubElement(output, "text").text = "Exposure time(s) = {0:s}".format(ff['spec_exp_time'])
-        ET.SubElement(output, "text").text = "Number of exposures: Object {0:d}, Sky {1:d}".format(int(self.nobj), int(self.nsky))
+        ET.SubElement(output, "text").text = "Operation: {0:s}".format(res.config['operation'])
+        ET.SubElement(output, "text").text = "Exposure time(s) = {0:s}".format(res.config['spec_exp_time'])
+        ET.SubElement(output, "text").text = "Number of exposures: Object {0:d}, Sky {1:d}".format(int(res.nobj), int(res.nsky))
         ET.SubElement(output, "text").text = "----------------------------------------------------------------"
         ET.SubElement(output, "text").text = "TELESCOPE AND INSTRUMENT:"
-        if ff['operation'] == 'Photometry':
-            ET.SubElement(output, "text").text = "Filter: {0:s} ".format(self.filtname)
+        if res.config['operation'] == 'Photometry':
+            ET.SubElement(output, "text").text = "Filter: {0:s} ".format(res.filtname)
         else:
-            ET.SubElement(output, "text").text = "Grism: {0:s}".format(self.grismname)
-            ET.SubElement(output, "text").text = "Slit width = {0:.2f} arcsec".format(self.slitwidth)
+            ET.SubElement(output, "text").text = "Grism: {0:s}".format(res.grismname)
+            ET.SubElement(output, "text").text = "Slit width = {0:.2f} arcsec".format(res.slitwidth)
         ET.SubElement(output, "text").text = "Telescope collecting area = {0:.1f} m<sup>2</sup>".format(params['area'])
 
         # ET.SubElement(output, "text").text = "----------------------------------------------------------------"
@@ -723,73 +211,119 @@ class EmirGui:
         ET.SubElement(output, "text").text = "Gain = {0:.2f} e<sup>-</sup>/ADU".format(params['gain'])
         ET.SubElement(output, "text").text = "----------------------------------------------------------------"
         ET.SubElement(output, "text").text = "OBSERVING CONDITIONS:"
-        ET.SubElement(output, "text").text = "Airmass = {0:.2f}".format(self.airmass)
-        ET.SubElement(output, "text").text = "Seeing = {0:.2f} arcsec FWHM".format(self.seeing)
-        ET.SubElement(output, "text").text = "Sky brightness = {0:.2f} Vega mag / arcsec<sup>2</sup>".format(self.mag_sky)
+        ET.SubElement(output, "text").text = "Airmass = {0:.2f}".format(res.airmass)
+        ET.SubElement(output, "text").text = "Seeing = {0:.2f} arcsec FWHM".format(res.seeing)
+        ET.SubElement(output, "text").text = "Sky brightness = {0:.2f} Vega mag / arcsec<sup>2</sup>".format(res.mag_sky)
         ET.SubElement(output, "text").text = " "
         ET.SubElement(output, "text").text = "----------------------------------------------------------------"
         ET.SubElement(output, "text").text= "RESULTS:"
 
         tabletext = ""
-        if ff['operation']=='Spectroscopy':
-            ET.SubElement(output, "text").text = "Wavelength coverage: {0:.2f} - {1:.2f} &mu;".format(self.ldo_px[0],self.ldo_px[-1])
-            ET.SubElement(output, "text").text = "Dispersion {0:.2f} &Aring;/pix".format(self.dpx*1e4)
-            # ET.SubElement(output, "text").text = "Resolution element {0:.2f} &Aring;".format(self.cenwl*1e4/self.specres) 
-            ET.SubElement(output, "text").text = "Resolution element {0:.2f} &Aring;".format(self.res_ele*1e4) 
-            ET.SubElement(output, "text").text = "In-slit fraction {0:.4f} ".format(self.slitloss)
+        if res.config['operation']=='Spectroscopy':
+            ET.SubElement(output, "text").text = "Wavelength coverage: {0:.2f} - {1:.2f} &mu;".format(res.ldo_px[0],res.ldo_px[-1])
+            ET.SubElement(output, "text").text = "Dispersion {0:.2f} &Aring;/pix".format(res.dpx*1e4)
+            # ET.SubElement(output, "text").text = "Resolution element {0:.2f} &Aring;".format(res.cenwl*1e4/res.specres) 
+            ET.SubElement(output, "text").text = "Resolution element {0:.2f} &Aring;".format(res.res_ele*1e4) 
+            ET.SubElement(output, "text").text = "In-slit fraction {0:.4f} ".format(res.slitloss)
             # Diagnostics:
-            ET.SubElement(output, "text").text = "Nominal Spectral resolution {0:.4f} ".format(self.specres)
-            ET.SubElement(output, "text").text = "Achieved Spectral resolution {0:.4f} ".format(self.cenwl/self.res_ele)
-            # ET.SubElement(output, "text").text = "Central lambda {0:.4f} ".format(self.cenwl)
-        if self.timerange != 'Range':
-            ET.SubElement(output, "text").text = "For {0:d} exposure(s) of {1:.1f} s: ".format(int(self.nobj),texp[0])
+            ET.SubElement(output, "text").text = "Nominal Spectral resolution {0:.4f} ".format(res.specres)
+            ET.SubElement(output, "text").text = "Achieved Spectral resolution {0:.4f} ".format(res.cenwl/res.res_ele)
+            # ET.SubElement(output, "text").text = "Central lambda {0:.4f} ".format(res.cenwl)
+        if res.config['calculation'] != 'Signal to noise':
+            if res.config['operation'] == 'Photometry':
+                where = ""
+            elif res.target_wvl is not None:
+                where = " at {0:.4f} &mu;".format(res.target_wvl)
+            elif res.config['template'] == 'Emission line':
+                where = " (maximum)"
+            else:
+                where = " (median)"
+            ET.SubElement(output, "text").text = "Target S/N{0:s} = {1:.1f}".format(where, res.solution['target'])
+            if res.config['calculation'] == 'Exposure time':
+                ET.SubElement(output, "text").text = "Required exposure time = {0:s} s per frame, {1:s} s in total".format(seconds(texp[0]), seconds(texp[0]*res.nobj))
+            elif res.config['calculation'] == 'Limiting magnitude':
+                ET.SubElement(output, "text").text = "Limiting magnitude = {0:.2f} (Vega)".format(res.mag)
+            else:
+                ET.SubElement(output, "text").text = "Required number of frames: Object {0:d}, Sky {1:d}".format(int(res.nobj), int(res.nsky))
+            ET.SubElement(output, "text").text = "Achieved S/N{0:s} = {1:.1f}".format(where, res.solution['ston'])
+        if res.timerange != 'Range':
+            ET.SubElement(output, "text").text = "For {0:d} exposure(s) of {1:s} s: ".format(int(res.nobj), seconds(texp[0]))
 
-            if ff['template'] == 'Emission line':
+            if res.config['template'] == 'Emission line':
                 ET.SubElement(output, "text").text = "Maximum counts from object {0:.1f}, median from sky: {1:.1f}".format(signal_obj[0],signal_sky[0])
                 ET.SubElement(output, "text").text = "Maximum S/N = {0:.1f}".format(ston[0])
-                ET.SubElement(output, "text").text = "Effective gain = {0:.2f} ".format(params['gain']*self.nobj)
-                # ET.SubElement(output, "text").text = "For time {0:.1f} s the expected S/N is {1:.1f}".format(texp[0]*self.nobj,ston[0])
+                ET.SubElement(output, "text").text = "Effective gain = {0:.2f} ".format(params['gain']*res.nobj)
+                # ET.SubElement(output, "text").text = "For time {0:.1f} s the expected S/N is {1:.1f}".format(texp[0]*res.nobj,ston[0])
             else:
                 ET.SubElement(output, "text").text = "Median counts per pixel: from object = {0:.1f}, from sky = {1:.1f}".format(signal_obj[0],signal_sky[0])
                 ET.SubElement(output, "text").text = "Median S/N per pixel = {0:.1f}".format(ston[0])
-                ET.SubElement(output, "text").text = "Effective gain = {0:.2f} ".format(params['gain']*self.nobj)
-                ET.SubElement(output, "text").text = "For time {0:.1f} s the expected median S/N is {1:.1f}".format(texp[0]*self.nobj, ston[0])
+                ET.SubElement(output, "text").text = "Effective gain = {0:.2f} ".format(params['gain']*res.nobj)
+                ET.SubElement(output, "text").text = "For time {0:.1f} s the expected median S/N is {1:.1f}".format(texp[0]*res.nobj, ston[0])
             if satur:
-                ET.SubElement(output, "warning").text = "for time {0:.1f} s some pixels are saturated".format(texp[0]*self.nobj)
+                ET.SubElement(output, "warning").text = "for time {0:.1f} s some pixels are saturated".format(texp[0]*res.nobj)
         else:
             tabletext += "\n\tFor the selected time range, the expected S/N per pixel are:"
             tabletext += "\n\t    t(s)\t     S/N\tSaturation?"
             tabletext += "\n\t----------------------"
-            if ff['operation'] == 'Photometry':
-                for i in range(0, 99, 10):
+            if res.config['operation'] == 'Photometry':
+                for i in range(0, len(texp) - 1, max(1, len(texp)//10)):
                     flags = 'No'
                     if satur[i]:
                         flags = 'Yes'
                     tabletext += '\n\t{0:8.1f}\t{1:8.1f}\t'\
-                        .format(texp[i]*self.nobj, ston[i]) + flags
+                        .format(texp[i]*res.nobj, ston[i]) + flags
                 flags = 'No'
                 if satur[-1]:
                     flags = 'Yes'
                 tabletext += '\n\t{0:8.1f}\t{1:8.1f}\t'\
-                    .format(texp[-1]*self.nobj, ston[-1]) + flags
+                    .format(texp[-1]*res.nobj, ston[-1]) + flags
             else:
                 for i in range(0, 9):
                     flags = 'No'
                     if satur[i]:
                         flags = 'Yes'
                     tabletext += '\n\t{0:8.1f}\t{1:8.1f}\t'\
-                        .format(texp[i]*self.nobj, ston[i]) + flags
+                        .format(texp[i]*res.nobj, ston[i]) + flags
+
+        if res.config['calculation'] == 'Limiting magnitude' and \
+                res.solution['magnitudes']:
+            tabletext += "\n\tFor the selected magnitudes, the expected S/N{0:s} are:".format(where)
+            tabletext += "\n\t     mag\t     S/N"
+            tabletext += "\n\t----------------------"
+            for mag, ston_mag in zip(res.solution['magnitudes'],
+                                     res.solution['ston_mags']):
+                tabletext += '\n\t{0:8.2f}\t{1:8.1f}'.format(mag, ston_mag)
 
         tabletext += "\n"
         ET.SubElement(output, "table").text = tabletext
         emir_guy.indent(output)
         tree = ET.ElementTree(output)
-        tree.write(args[0] + "_out.xml")
-
-try:
-    EmirGui()
-except SystemExit:
-    pass
-except:
-    emir_guy.generic_error(args[0])
-exit()
+        tree.write(self.fname + "_out.xml")
+
+
+def main():
+    """Command line entry point: process a single request"""
+    parser = OptionParser(usage=usage, description=description)
+    parser.add_option("-d", "--directory", dest="directory",
+                      default='', help='Path of the xml file \n  [%default]')
+    parser.add_option("--no-cache", dest="cache", action="store_false",
+                      default=True, help='Do not use the result cache')
+    parser.add_option("-t", "--threads", dest="threads", type="int",
+                      default=SPEC_THREADS,
+                      help='Threads for the stages of a spectroscopy '
+                      'request, 1 to run them in turn [%default]')
+    option, args = parser.parse_args()
+    if len(args) == 0:
+        parser.print_help()
+        sys.exit()
+    try:
+        gui = EmirGui()
+    except:
+        emir_guy.generic_error(args[0])
+    gui.use_cache = option.cache
+    gui.threads = option.threads
+    gui.run(args[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -8,11 +8,48 @@ Author: LRP
 Date: 28-11-2016 and 12-12-2016
 """
 
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
 import numpy as np
 from etc_config import get_params
 from scipy.interpolate import InterpolatedUnivariateSpline as Inter
+from scipy.optimize import brentq
+from scipy.sparse import csr_matrix
 import astropy.io.fits as pyfits
 
+# Number of airmass values whose interpolated sky is kept by interpolatesky
+SKY_CACHE_SIZE = 8
+_sky_cache = OrderedDict()
+
+# Sky cube written by pack_skytables, one .npy file per quantity
+SKYCUBE_FILES = {'airmass': 'skycube_airmass.npy', 'lam': 'skycube_lam.npy',
+                 'trans': 'skycube_trans.npy', 'flux': 'skycube_flux.npy'}
+# Size, mtime and sha1 of the FITS tables the sky cube was built from
+SKYCUBE_INDEX = 'skycube_index.json'
+# Airmasses of the SkyCalc tables
+SKY_AIRMASSES = [1.0, 1.5, 2.0, 2.5]
+_skycube = {}
+
+# Kernel length (samples) from which convolve_same switches to FFTs
+CONV_DIRECT_MAX = 64
+# Fraction of the samples left near zero by the FFTs above which
+# convolve_same computes them all directly instead of only those (each
+# one recomputed costs about 5 times a sample of np.convolve)
+CONV_REDO_FRACTION = 0.2
+# Samples of the kernel windows taken at a time to recompute them
+CONV_REDO_CHUNK = 2**20
+
+# Number of pixel integration operators kept by pixel_operator
+PIXOP_CACHE_SIZE = 16
+_pixop_cache = OrderedDict()
+# Requests may integrate spectra from several threads (etc_engine)
+_pixop_lock = threading.Lock()
+
 
 def bbody(wvl, teff):
     """Compute bb radiation for wavelength in microns and t in kelvin"""
@@ -32,16 +69,25 @@ def bbody(wvl, teff):
     return ibb
 
 
-def checkforsaturation(data):
-    """Check whether any element of the array is saturated"""
+def checkforsaturation(data, axis=None):
+    """
+    Check whether any element of the array is saturated.
+    With axis, one flag per position along the other axes
+    """
     param = get_params()
+    if axis is not None:
+        return np.any(data >= param['well'], axis=axis)
     return True if np.any(data >= param['well']) else False
 
 
-def convolres(ldo, fl, res_el):
+def convolres(ldo, fl, res_el, method='auto'):
     """
     Convolve the given spectra at config resolution.
     The resolution element is assumed to be the FWHM
+
+    fl can also be a stack of spectra (one per row) on the same wavelengths,
+    that are convolved with the same kernel in a single call.
+    See convolve_same for method.
     """
     # params = get_params()
     # Sigma in pixels, res el taken to be FWHM
@@ -52,9 +98,97 @@ def convolres(ldo, fl, res_el):
     # Pad at the sides to avoid windowing
     # MB 2016-10-30 make window_len integer to avoid deprecation warning
     window_len = int(np.round(sigma))
-    s = np.r_[fl[window_len - 1:0:-1], fl, fl[-1:-window_len:-1]]
-    y = np.convolve(kernel/kernel.sum(), s, mode='same')
-    return y[len(fl[window_len - 1:0:-1]):len(y) - len(fl[-1:-window_len:-1])]
+    fl = np.asarray(fl)
+    left = fl[..., window_len - 1:0:-1]
+    right = fl[..., -1:-window_len:-1]
+    s = np.concatenate((left, fl, right), axis=-1)
+    y = convolve_same(kernel/kernel.sum(), s, method)
+    return y[..., left.shape[-1]:y.shape[-1] - right.shape[-1]]
+
+
+def convolve_same(kernel, data, method='auto'):
+    """
+    Equivalent to np.convolve(kernel, row, mode='same') for every row of
+    data (last axis). Methods:
+        'direct'   np.convolve, best for short kernels
+        'oa'       overlap-add of FFT blocks a few times the kernel length
+        'fft'      a single FFT of the whole row, for long kernels
+        'auto'     chosen from the kernel and data lengths
+    The FFT methods agree with 'direct' to rounding (~1e-15 relative), and
+    give the same exact zeros.
+    """
+    data = np.asarray(data, dtype=float)
+    nker = len(kernel)
+    ndat = data.shape[-1]
+    if method == 'auto':
+        if nker < CONV_DIRECT_MAX:
+            method = 'direct'
+        elif 8*nker < ndat:
+            method = 'oa'
+        else:
+            method = 'fft'
+    if method == 'direct' or nker > ndat:
+        # np.convolve returns max(nker, ndat) samples, keep its behaviour
+        if data.ndim == 1:
+            return np.convolve(kernel, data, mode='same')
+        return np.array([np.convolve(kernel, i, mode='same')
+                         for i in data.reshape(-1, ndat)])\
+            .reshape(data.shape[:-1] + (-1,))
+
+    nfull = ndat + nker - 1
+    if method == 'fft':
+        nfft = 1 << (nfull - 1).bit_length()
+        full = np.fft.irfft(np.fft.rfft(data, nfft)*np.fft.rfft(kernel, nfft),
+                            nfft)
+    elif method == 'oa':
+        # Blocks of nblk samples, so each block overlaps only the next one
+        nfft = 1 << (8*nker - 1).bit_length()
+        nblk = nfft - nker + 1
+        nbl = -(-ndat//nblk)
+        temp = np.zeros(data.shape[:-1] + (nbl*nblk,))
+        temp[..., :ndat] = data
+        blocks = temp.reshape(data.shape[:-1] + (nbl, nblk))
+        conv = np.fft.irfft(np.fft.rfft(blocks, nfft)*
+                            np.fft.rfft(kernel, nfft), nfft)
+        full = np.zeros(data.shape[:-1] + (nbl + 1, nblk))
+        full[..., :nbl, :] += conv[..., :nblk]
+        full[..., 1:, :nker - 1] += conv[..., nblk:]
+        full = full.reshape(data.shape[:-1] + ((nbl + 1)*nblk,))
+    else:
+        raise ValueError("Unknown convolution method: {0}".format(method))
+    first = (nker - 1)//2
+    full = full[..., first:first + ndat]
+
+    # FFT rounding leaves residuals of ~1e-16 of the row maximum everywhere.
+    # Samples below that level are recomputed as direct sums, so that exact
+    # zeros (e.g. out of the filter band) and tiny tails are kept as they
+    # were: callers select the non-zero pixels. If they are many (sparse
+    # data) the whole convolution is done directly.
+    rows = data.reshape(-1, ndat)
+    full = full.reshape(-1, ndat)
+    # Number of non-zero samples under the kernel at each position
+    count = np.cumsum(rows != 0, axis=-1)
+    count = np.concatenate((np.zeros((len(rows), 1), dtype=count.dtype),
+                            count, np.repeat(count[:, -1:], nker, axis=-1)),
+                           axis=-1)
+    last = np.arange(ndat) + first + 1
+    inside = count[:, last] != count[:, np.clip(last - nker, 0, None)]
+    full[~inside] = 0.
+    limit = 1e-11*np.abs(rows).max(axis=-1)[:, None]
+    row, col = np.nonzero(inside & (np.abs(full) < limit))
+    if len(row) > CONV_REDO_FRACTION*full.size:
+        return convolve_same(kernel, data, 'direct')
+    if len(row):
+        temp = np.zeros((len(rows), ndat + nker - 1))
+        temp[:, nker - 1 - first:nker - 1 - first + ndat] = rows
+        windows = np.lib.stride_tricks.as_strided(
+            temp, shape=(len(rows), ndat, nker),
+            strides=(temp.strides[0], temp.strides[1], temp.strides[1]))
+        step = max(1, CONV_REDO_CHUNK//nker)
+        for i in range(0, len(row), step):
+            index = row[i:i + step], col[i:i + step]
+            full[index] = windows[index].dot(kernel[::-1])
+    return full.reshape(data.shape)
 
 
 def emline(wvl, cen, width, flx):
@@ -144,10 +278,8 @@ def getspread(flux=1., seeing=0.6, photo=0):
 
     if photo == 1:
         # Generating 2D image of seeing as gaussian
-        image = np.zeros((100, 100))
-        for i in range(0, 100):
-            image[i, :] = np.exp(-0.5*(x_t/sigma)**2)*\
-                np.exp(-0.5*(param['scale']*float(i-50)/sigma)**2)
+        profile = np.exp(-0.5*(x_t/sigma)**2)
+        image = np.outer(profile, profile)
 
     if photo == 0:
         # Generating 1D image of seeing as gaussian
@@ -158,59 +290,244 @@ def getspread(flux=1., seeing=0.6, photo=0):
     return image
 
 
+@lru_cache(maxsize=32)
+def getaperture(radius):
+    """
+    Indices of the pixels of a 100x100 image (as in getspread) within
+    radius pixels of its center
+    """
+    x = np.arange(100) - 50.0
+    im_r = np.sqrt(x[:, None]**2 + x**2)
+    return np.where(im_r <= radius)
+
+
+@lru_cache(maxsize=32)
+def getprofile(seeing=0.6, photo=0):
+    """
+    Seeing profile (photo=0) or image (photo=1) normalized to unit flux, as
+    getspread(1., seeing, photo). Memoized per seeing, the array is read-only
+    """
+    image = getspread(1., seeing, photo)
+    image.flags.writeable = False
+    return image
+
+
+def getsupport(wvl, curve):
+    """Wavelength range where curve (e.g. a filter) is not zero"""
+    ind = np.nonzero(curve)[0]
+    if len(ind) == 0:
+        return wvl[0], wvl[-1]
+    return wvl[ind[0]], wvl[ind[-1]]
+
+
+def getwindow(wvl, lo, hi):
+    """Slice of the sorted wvl array covering [lo, hi]"""
+    first = max(np.searchsorted(wvl, lo) - 1, 0)
+    return slice(first, np.searchsorted(wvl, hi, side='right') + 1)
+
+
 def interpolatesky(airmass, wvl):
     """
     Interpolate sky curves with airmass and generate fit to be used by ETC
     Sky tables generated using ESO's SkyCalc tool
     Sky tables contain all parameters used
+
+    The airmass interpolation is linear and done for all the wavelengths at
+    once; it matches the old per-wavelength k=1 splines to rounding
+    (relative differences below 1e-12, or 1e-6 when the tables are read from
+    the float32 sky cube). Results are memoized per airmass and output grid,
+    the returned arrays are read-only.
     """
-    sky25 = pyfits.open('sky/skytable_25.fits')
-    sky20 = pyfits.open('sky/skytable_20.fits')
-    sky15 = pyfits.open('sky/skytable_15.fits')
-    sky10 = pyfits.open('sky/skytable_10.fits')
-
-    t25 = sky25[1].data.field('trans')
-    t20 = sky20[1].data.field('trans')
-    t15 = sky15[1].data.field('trans')
-    t10 = sky10[1].data.field('trans')
-
-    e25 = sky25[1].data.field('flux')
-    e20 = sky20[1].data.field('flux')
-    e15 = sky15[1].data.field('flux')
-    e10 = sky10[1].data.field('flux')
-
-    am = np.array([1.0, 1.5, 2.0, 2.5])
-    wvl_ori = sky25[1].data.field('lam')
-
-    t_inter = np.zeros(len(wvl_ori))
-    a_inter = np.zeros(len(wvl_ori))
-    for i in range(len(wvl_ori)):
-        trans = np.array([t10[i], t15[i], t20[i], t25[i]])
-        rad = np.array([e10[i], e15[i], e20[i], e25[i]])
-        inter_func = Inter(am, trans, k=1)
-        t_inter[i] = inter_func(airmass)
-        inter_func = Inter(am, rad, k=1)
-        a_inter[i] = inter_func(airmass)
-
-    inter_func = Inter(wvl_ori, t_inter, k=3)
+    key = (float(airmass), len(wvl), float(wvl[0]), float(wvl[-1]))
+    if key in _sky_cache:
+        _sky_cache[key] = _sky_cache.pop(key)  # most recently used
+        return _sky_cache[key]
+
+    sky = load_skycube()
+    am = sky['airmass']
+
+    # Linear in airmass between the two closest tables (extrapolated out of
+    # the tabulated range, as the k=1 spline did). Only those two rows of
+    # the cube are read.
+    i = np.clip(np.searchsorted(am, airmass), 1, len(am) - 1)
+    weight = (airmass - am[i - 1])/(am[i] - am[i - 1])
+    t_inter = (1 - weight)*np.asarray(sky['trans'][i - 1], dtype=float) +\
+        weight*np.asarray(sky['trans'][i], dtype=float)
+    a_inter = (1 - weight)*np.asarray(sky['flux'][i - 1], dtype=float) +\
+        weight*np.asarray(sky['flux'][i], dtype=float)
+
+    inter_func = Inter(sky['lam'], t_inter, k=3)
     trans_final = inter_func(wvl)
-    inter_func = Inter(wvl_ori, a_inter, k=3)
+    inter_func = Inter(sky['lam'], a_inter, k=3)
     rad_final = inter_func(wvl)
 
+    trans_final.flags.writeable = False
+    rad_final.flags.writeable = False
+    _sky_cache[key] = (trans_final, rad_final)
+    while len(_sky_cache) > SKY_CACHE_SIZE:
+        _sky_cache.pop(next(iter(_sky_cache)))
     return trans_final, rad_final
 
 
+def load_skycube(directory='sky'):
+    """
+    Return the SkyCalc tables as a dictionary of arrays: 'airmass' (n_am),
+    'lam' (n_wvl) and the (n_am, n_wvl) cubes 'trans' and 'flux'.
+
+    The cubes are memory-mapped from the files written by pack_skytables,
+    so no FITS parsing is done per request and parallel workers share the
+    pages. If they have not been generated, or the FITS tables changed
+    since, the tables are read.
+    """
+    if directory in _skycube:
+        return _skycube[directory]
+    sky = None
+    if skycube_fresh(directory):
+        try:
+            sky = dict((i, np.load(os.path.join(directory, SKYCUBE_FILES[i]),
+                                   mmap_mode='r')) for i in SKYCUBE_FILES)
+        except (IOError, ValueError):
+            pass
+    if sky is None:
+        sky = read_skytables(directory)
+    _skycube[directory] = sky
+    return sky
+
+
+def pack_skytables(directory='sky'):
+    """
+    Convert the per-airmass FITS tables into the memory-mappable cubes read
+    by load_skycube: float32 transmission and emission, with the
+    wavelength (float64, it is the spline abscissa) and airmass axes
+    """
+    # Recorded before reading them, so a table changed meanwhile is seen
+    index = dict((os.path.basename(fil), table_entry(fil))
+                 for fil in skytable_files(directory))
+    sky = read_skytables(directory)
+    for i in SKYCUBE_FILES:
+        if i in ('trans', 'flux'):
+            data = np.ascontiguousarray(sky[i], dtype=np.float32)
+        else:
+            data = np.asarray(sky[i], dtype=np.float64)
+        temp = os.path.join(directory, SKYCUBE_FILES[i] + '.tmp')
+        with open(temp, 'wb') as arch:
+            np.save(arch, data)
+        os.replace(temp, os.path.join(directory, SKYCUBE_FILES[i]))
+    temp = os.path.join(directory, SKYCUBE_INDEX + '.tmp')
+    with open(temp, 'w') as arch:
+        json.dump(index, arch, indent=1, sort_keys=True)
+    os.replace(temp, os.path.join(directory, SKYCUBE_INDEX))
+    _skycube.pop(directory, None)
+
+
+def skytable_files(directory='sky'):
+    """The SkyCalc FITS tables, in the order of SKY_AIRMASSES"""
+    return [os.path.join(directory, 'skytable_{0:d}.fits'.format(
+        int(round(10*i)))) for i in SKY_AIRMASSES]
+
+
+def table_entry(fil):
+    """Size, mtime and sha1 of a file"""
+    stat = os.stat(fil)
+    with open(fil, 'rb') as arch:
+        sha1 = hashlib.sha1(arch.read()).hexdigest()
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1}
+
+
+def skycube_fresh(directory='sky'):
+    """
+    Whether the sky cube was built from the FITS tables there are now (as
+    etc_bundle does for the curves: same size, and same mtime or sha1)
+    """
+    try:
+        with open(os.path.join(directory, SKYCUBE_INDEX)) as arch:
+            index = json.load(arch)
+        for fil in skytable_files(directory):
+            entry = index[os.path.basename(fil)]
+            stat = os.stat(fil)
+            if stat.st_size != entry['size'] or \
+                    (stat.st_mtime != entry['mtime'] and
+                     table_entry(fil)['sha1'] != entry['sha1']):
+                return False
+    except (IOError, OSError, ValueError, KeyError):
+        return False
+    return True
+
+
+def read_skytables(directory='sky'):
+    """Read the SkyCalc FITS tables, one per airmass"""
+    am = np.array(SKY_AIRMASSES)
+    tables = [pyfits.open(fil) for fil in skytable_files(directory)]
+    sky = {'airmass': am,
+           'lam': np.array(tables[0][1].data.field('lam'), dtype=float),
+           'trans': np.array([i[1].data.field('trans') for i in tables]),
+           'flux': np.array([i[1].data.field('flux') for i in tables])}
+    for i in tables:
+        i.close()
+    return sky
+
+
+def pixel_int(wvl0, fl0, wvl1):
+    """
+    Integrate a spectrum sampled on wvl0 over the pixels centred on wvl1.
+    fl0 can hold several spectra, one per row
+    """
+    fl0 = np.asarray(fl0)
+    return pixel_operator(wvl0, wvl1).dot(fl0.T).T.clip(0)
+
+
+def pixel_operator(wvl0, wvl1):
+    """
+    Sparse (len(wvl1) x len(wvl0)) matrix that integrates a spectrum sampled
+    on wvl0 over the pixels centred on wvl1 (evenly spaced). Each sample
+    stands for the cell between the mid-points to its neighbours and is
+    weighted by its overlap with the pixel, so the flux is conserved.
+    The operators of the last grids/dispersions are kept
+    """
+    key = (float(wvl0[0]), float(wvl0[-1]), len(wvl0),
+           float(wvl1[0]), float(wvl1[-1]), len(wvl1))
+    with _pixop_lock:
+        if key in _pixop_cache:
+            _pixop_cache.move_to_end(key)
+            return _pixop_cache[key]
+
+    mid = 0.5*(wvl0[1:] + wvl0[:-1])
+    edges = np.concatenate([[2*wvl0[0] - mid[0]], mid,
+                            [2*wvl0[-1] - mid[-1]]])
+    dpx = (wvl1[-1] - wvl1[0])/(len(wvl1) - 1.)
+    lo = wvl1 - 0.5*dpx
+    hi = wvl1 + 0.5*dpx
+    # First and last cells overlapping each pixel
+    first = np.clip(np.searchsorted(edges, lo, side='right') - 1, 0, None)
+    last = np.clip(np.searchsorted(edges, hi, side='left') - 1, None,
+                   len(wvl0) - 1)
+    nel = (last - first + 1).clip(0)
+    cols = first[:, None] + np.arange(max(nel.max(), 1))
+    valid = np.arange(cols.shape[1]) < nel[:, None]
+    cols = np.where(valid, cols, 0)
+    weight = (np.minimum(edges[cols + 1], hi[:, None]) -
+              np.maximum(edges[cols], lo[:, None])).clip(0)
+    rows = np.repeat(np.arange(len(wvl1)), cols.shape[1]).reshape(cols.shape)
+    operator = csr_matrix((weight[valid], (rows[valid], cols[valid])),
+                          shape=(len(wvl1), len(wvl0)))
+
+    with _pixop_lock:
+        _pixop_cache[key] = operator
+        if len(_pixop_cache) > PIXOP_CACHE_SIZE:
+            _pixop_cache.popitem(last=False)
+    return operator
+
+
 def rebinwvl(wvl0, flux, wvl1):
     """Rebin a spectrum onto a coarser wavelength sampling"""
-    flux1 = np.zeros_like(wvl1)
-    n_el = np.zeros_like(wvl1)
     delta1 = wvl1[1] - wvl1[0]
-    for i in range(len(wvl1)):
-        ind = np.where((wvl0 >= wvl1[i] - 0.5*delta1) &
-                       (wvl0 < wvl1[i] + 0.5*delta1))
-        if len(ind) > 0:
-            flux1[i] = flux[ind[0]].sum()
-            n_el[i] = float(len(ind[0]))
+    # Bin of each sample, bins are [wvl1 - delta1/2, wvl1 + delta1/2)
+    ind = np.searchsorted(wvl1 - 0.5*delta1, wvl0, side='right') - 1
+    ind[wvl0 >= wvl1[-1] + 0.5*delta1] = -1
+    inside = ind >= 0
+    flux1 = np.bincount(ind[inside], weights=flux[inside],
+                        minlength=len(wvl1))
+    n_el = np.bincount(ind[inside], minlength=len(wvl1)).astype(float)
     # Corrige que hay pixeles con 10 muestras en lugar de 9
     return flux1/n_el*n_el.mean()
 
@@ -230,6 +547,33 @@ def slitpercent(seeing, slitwd):
     return perone
 
 
+def solvetarget(func, target, x0=1., xmin=1e-3, xmax=1e7, rtol=1e-6):
+    """
+    Smallest x at which func(x), increasing with x (e.g. S/N against
+    exposure time or number of frames), reaches target.
+    The root is bracketed by factors of 2 around x0 and refined with brentq.
+    Returns None if target is not reached for x <= xmax
+    """
+    def diff(x):
+        # Empty spectra give nan statistics: count them as no signal
+        return np.nan_to_num(func(x)) - target
+
+    lo = hi = float(x0)
+    if diff(hi) < 0:
+        while diff(hi) < 0:
+            lo = hi
+            hi = 2*hi
+            if hi > xmax:
+                return None
+    else:
+        while diff(lo) >= 0:
+            hi = lo
+            lo = 0.5*lo
+            if lo < xmin:
+                return hi
+    return brentq(diff, lo, hi, rtol=rtol)
+
+
 def spec_int(wvl0, fl0, wvl1):
     """Interpolation to a given wvl array."""
     inter_func = Inter(wvl0, fl0, k=3)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Date: 17-10-2026
+Description:
+Figures of the EMIR ETC web form (etc_gui.EmirGui), drawn fast.
+
+Curves are decimated to the resolution of the PNG before they are drawn
+(decimate): of the samples falling in each column of pixels only the
+first, the last, the minimum and the maximum are kept, which cover the same
+pixels as all of them. The efficiency curves go from 100001 samples to a
+few thousand, and so do the costs of clipping them and of placing the
+legends.
+
+Each kind of figure is built once per process (template), outside of
+pyplot: its axes, labels and legends are kept, and a request only sets the
+data of the lines, the limits and the labels that change. etc_server.py
+builds them before forking its workers (build_templates).
+"""
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+# Size (inches) of the figures, at the default dpi
+SPEC_FIGSIZE = (15., 10.)
+RANGE_FIGSIZE = (6.4, 4.8)
+
+# Throughput curves of the efficiency panels: (key, style, label)
+EFFICIENCY_CURVES = [('qe', '-r', 'Det'), ('grism', '--c', 'Grism'),
+                     ('filter', '-c', 'Filter'), ('optics', '-b', 'Optics'),
+                     ('tel', '--b', 'Tel'), ('total', '-k', 'Qtot')]
+
+_templates = {}
+
+
+def decimate(x, y, lo, hi, ncols):
+    """
+    Samples of the curve (x, y), x increasing, drawn as all of them on
+    ncols columns of pixels from lo to hi: the first, last, minimum and
+    maximum of each column. Out of [lo, hi] the samples next to it (where
+    the line leaves the axes) and the extremes (for the autoscaling of y)
+    are kept
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(x) <= 4*ncols or not hi > lo:
+        return x, y
+    col = np.floor((x - lo)*(ncols/(hi - lo))).clip(-1, ncols)
+    # x is sorted, so each column (and each side out of it) is one run
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(col)) + 1])
+    ends = np.concatenate([starts[1:], [len(x)]]) - 1
+    keep = np.unique(np.concatenate([starts, ends,
+                                     _extreme(y, starts, np.minimum),
+                                     _extreme(y, starts, np.maximum)]))
+    return x[keep], y[keep]
+
+
+def _extreme(y, starts, reduce):
+    """Index of the first sample at the extreme of each run of y"""
+    counts = np.diff(np.concatenate([starts, [len(y)]]))
+    index = np.flatnonzero(y == np.repeat(reduce.reduceat(y, starts),
+                                          counts))
+    runs = np.repeat(np.arange(len(starts)), counts)[index]
+    return index[np.unique(runs, return_index=True)[1]]
+
+
+def set_line(line, x, y, xlim=None):
+    """
+    Set the data of line, decimated to the pixels of its axes over xlim
+    (by default the range of x)
+    """
+    lo, hi = xlim if xlim is not None else (x[0], x[-1])
+    ncols = int(np.ceil(line.axes.bbox.width))
+    line.set_data(*decimate(x, y, lo, hi, ncols))
+
+
+def new_figure(figsize):
+    """A figure drawn with Agg, not managed by pyplot"""
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def build_single():
+    """Template of the spectroscopy figure in 'Single' mode"""
+    fig = new_figure(SPEC_FIGSIZE)
+    axes = dict((i, fig.add_subplot(i)) for i in
+                [321, 323, 325, 322, 324, 326])
+    lines = {}
+    lines['ston'], = axes[321].plot([], [], color='b')
+    lines['median'], = axes[321].plot([], [], color='r')
+    axes[321].set_xlabel('Wavelength (micron)')
+
+    lines['obj'], = axes[323].plot([], [])
+    lines['sky'], = axes[323].plot([], [])
+    axes[323].set_xlabel('Wavelength (micron)')
+    axes[323].set_ylabel('Source ADU/pixel')
+    axes[323].grid()
+
+    lines['sp'], = axes[325].plot([], [])
+    axes[325].set_xlabel('Wavelength (micron)')
+    axes[325].set_ylabel('Normalized src flux')
+
+    for i, ylabel, curves in [
+            (322, 'efficiency / band', EFFICIENCY_CURVES),
+            (324, 'Eff Tel to Det', EFFICIENCY_CURVES[-1:]),
+            (326, 'Efficiency full EMIR range', EFFICIENCY_CURVES)]:
+        for key, style, label in curves:
+            lines[i, key], = axes[i].plot([], [], style, label=label)
+        axes[i].legend(bbox_to_anchor=(1.3, 1.05))
+        axes[i].set_xlabel('Wavelength (micron)')
+        axes[i].set_ylabel(ylabel)
+    return fig, axes, lines
+
+
+def build_range():
+    """Template of the spectroscopy figure in 'Range' mode"""
+    fig = new_figure(RANGE_FIGSIZE)
+    axes = {211: fig.add_subplot(211), 212: fig.add_subplot(212)}
+    lines = {}
+    lines['ston'], = axes[211].plot([], [])
+    axes[211].set_xlabel('Wavelength (micron)')
+    lines['sp'], = axes[212].plot([], [])
+    axes[212].set_xlabel('Wavelength (micron)')
+    axes[212].set_ylabel('Normalized src flux')
+    return fig, axes, lines
+
+
+def build_photometry():
+    """Template of the photometry figure in 'Range' mode"""
+    fig = new_figure(RANGE_FIGSIZE)
+    axes = {111: fig.add_subplot(111)}
+    lines = {}
+    lines['ston'], = axes[111].plot([], [])
+    axes[111].set_xlabel('Exposure time (seconds)')
+    return fig, axes, lines
+
+
+BUILDERS = {'single': build_single, 'range': build_range,
+            'photometry': build_photometry}
+
+
+def template(name):
+    """The figure, axes and lines of the template name, built once"""
+    if name not in _templates:
+        _templates[name] = BUILDERS[name]()
+    return _templates[name]
+
+
+def build_templates():
+    """Build every template, e.g. before forking workers that share them"""
+    for name in BUILDERS:
+        template(name)
+
+
+def save(fig, axes, fil):
+    """Rescale the axes to their new data and write the figure"""
+    for ax in axes.values():
+        ax.relim()
+        ax.autoscale_view()
+    fig.savefig(fil)
+
+
+def ston_label(res, suffix=''):
+    if res.config['source_type'] == 'Point':
+        return 'S/N' + suffix
+    return 'S/N per pixel' + suffix
+
+
+def photometry_figure(res, fil):
+    """Figure of a photometry request in 'Range' mode: S/N vs exp. time"""
+    fig, axes, lines = template('photometry')
+    # Update by LRP 28-11-2016
+    lines['ston'].set_data(res.texp*res.nobj, res.ston)
+    axes[111].set_ylabel(ston_label(res))
+    save(fig, axes, fil)
+
+
+def spectroscopy_figure(res, fil):
+    """Figure of a spectroscopy request"""
+    ldo_px = res.ldo_px
+    xlim = (ldo_px[0], ldo_px[-1])
+    if res.timerange == 'Single':
+        fig, axes, lines = template('single')
+        set_line(lines['ston'], ldo_px, res.ston_px)
+        med_spec = np.median(res.ston_px[np.nonzero(res.ston_px)])
+        lines['median'].set_data(np.linspace(ldo_px[0], ldo_px[-1]),
+                                 np.linspace(med_spec, med_spec))
+        axes[321].set_ylabel(ston_label(res))
+        set_line(lines['obj'], ldo_px, res.obj_px)
+        set_line(lines['sky'], ldo_px, res.sky_px)
+        set_line(lines['sp'], ldo_px, res.sp)
+        for i in [321, 323, 325, 322, 324]:
+            axes[i].set_xlim(*xlim)
+
+        wvl, eff = res.wvl_full, res.efficiency
+        for i, curves in [(322, EFFICIENCY_CURVES),
+                          (324, EFFICIENCY_CURVES[-1:])]:
+            for key, style, label in curves:
+                set_line(lines[i, key], wvl, eff[key], xlim)
+        for key, style, label in EFFICIENCY_CURVES:
+            set_line(lines[326, key], wvl, eff[key])
+    else:
+        # Additional figure for an inputed range of exposure times
+        fig, axes, lines = template('range')
+        set_line(lines['ston'], ldo_px, res.ston_px)
+        axes[211].set_ylabel(ston_label(
+            res, ' at texp = {0:.1f}'.format(res.texp[-1])))
+        set_line(lines['sp'], ldo_px, res.sp)
+    save(fig, axes, fil)
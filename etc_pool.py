@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Date: 17-10-2026
+Description:
+Process pool for the batches and sweeps of the EMIR ETC.
+
+As in etc_server.py, the instrument state (an etc_engine.Engine with the
+ldo_hr grid and the QE, optics, telescope and Vega curves, plus the SkyCalc
+tables) is built once in the parent and the workers are forked from it, so
+they share its arrays copy-on-write instead of each loading a private copy.
+The bundled curves and the sky cubes are memory-mapped (etc_bundle.py,
+etc_modules.load_skycube), so their pages are shared in any case. Where
+fork is not available the workers build their own Engine.
+
+    pool = etc_pool.EnginePool(8)
+    for record in pool.batch(configs):     # etc_batch records, in order
+        ...
+    res = pool.sweep(config, axes)         # as Engine.sweep
+    pool.close()
+
+Results are gathered in input order.
+"""
+import multiprocessing
+import os
+
+import numpy as np
+
+import etc_batch
+import etc_engine
+import etc_modules as mod
+
+# Requests sent to a worker at a time by batch()
+BATCH_CHUNK = 4
+
+# Engine of the worker processes, set in the parent before forking
+_worker = {'engine': None}
+
+
+def _start():
+    """Initializer of the workers: spawned ones need their own Engine"""
+    if _worker['engine'] is None:
+        _worker['engine'] = etc_engine.Engine()
+    # The cores are already taken by the workers
+    _worker['engine'].threads = 1
+
+
+def _evaluate(args):
+    config, spectra = args
+    return etc_batch.evaluate(_worker['engine'], config, spectra)
+
+
+def _sweep(args):
+    config, axes = args
+    return _worker['engine'].sweep(config, axes)
+
+
+def split_axis(axes, nparts):
+    """
+    Index of the axis to share among nparts workers: the first one in the
+    order of etc_engine.SWEEP_AXES with enough values, as the work per value
+    is largest for the outer loops of Engine.sweep, else the longest one
+    """
+    names = [name for name, values in axes]
+    sizes = [len(np.atleast_1d(values)) for name, values in axes]
+    for name in etc_engine.SWEEP_AXES:
+        if name in names and sizes[names.index(name)] >= nparts:
+            return names.index(name)
+    return int(np.argmax(sizes))
+
+
+class EnginePool(object):
+    """Pool of processes evaluating requests with a shared Engine"""
+
+    def __init__(self, processes=None, engine=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+            if engine is None:
+                engine = etc_engine.Engine()
+            # Loaded before forking, so no worker reads them again
+            if os.path.isdir('sky'):
+                mod.load_skycube()
+            _worker['engine'] = engine
+        else:
+            context = multiprocessing.get_context()
+        self.pool = context.Pool(processes, _start)
+
+    def batch(self, configs, spectra=False):
+        """Yield the etc_batch record of each request, in input order"""
+        return self.pool.imap(_evaluate,
+                              ((config, spectra) for config in configs),
+                              BATCH_CHUNK)
+
+    def sweep(self, config, axes):
+        """Engine.sweep, with one of the axes divided among the workers"""
+        axes = [(name, np.atleast_1d(np.asarray(values, dtype=float)))
+                for name, values in axes]
+        k = split_axis(axes, self.processes)
+        parts = [i for i in np.array_split(axes[k][1], self.processes)
+                 if len(i)]
+        tasks = [(config, axes[:k] + [(axes[k][0], i)] + axes[k + 1:])
+                 for i in parts]
+        results = self.pool.map(_sweep, tasks, 1)
+        res = results[0]
+        for name in ['ston', 'signal_obj', 'signal_sky', 'saturated']:
+            setattr(res, name, np.concatenate([getattr(i, name)
+                                               for i in results], axis=k))
+        res.axes = axes
+        return res
+
+    def close(self):
+        """Stop the workers once their tasks are done"""
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.pool.terminate()
+        self.pool.join()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+Date: 17-10-2026
+Description:
+Resident worker service for the EMIR ETC.
+
+Running etc_gui.py once per web request means that every request pays for
+importing numpy/scipy/astropy/matplotlib and for rebuilding the instrument
+state (the ldo_hr grid plus the QE, optics, telescope and Vega curves).
+This service builds that state once, then forks a fixed number of workers
+that share it (copy-on-write) and serve requests on a local Unix socket.
+
+The protocol is one line per connection: the client sends the same fname
+that etc_gui.py takes on the command line and the worker answers 'OK' once
+fname_out.xml and the figures are written, or 'ERROR <message>'.
+The line 'STATS' is answered with 'OK <json>', the counters of the curve
+cache (etc_bundle.curve_cache) of the worker that takes it.
+See etc_client.py for the client used by body_emir.php.
+
+    python3 etc_server.py -w 4
+
+Workers exit after a number of requests (-m) and are replaced by the parent,
+which bounds the memory that a long-lived matplotlib process can pick up.
+SIGTERM or SIGINT stop the service and remove the socket.
+"""
+import errno
+import json
+import os
+import signal
+import socket
+import sys
+from optparse import OptionParser
+
+import etc_gui
+import etc_plot
+from etc_bundle import curve_cache
+from etc_client import SOCKET_FILE
+
+description = ">> Resident worker service for the EMIR ETC"
+usage = "%prog [options]"
+
+
+class Shutdown(Exception):
+    """Raised in the parent process by the termination signals"""
+    pass
+
+
+def _shutdown(signum, frame):
+    raise Shutdown()
+
+
+def handle(conn, gui):
+    """Process a single connection"""
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    fname = data.decode('utf-8').strip()
+    if fname == 'STATS':
+        conn.sendall('OK {0}\n'.format(json.dumps(curve_cache.stats()))
+                     .encode('utf-8'))
+        return
+    if not fname or not os.path.isfile(fname + '.xml'):
+        conn.sendall(b'ERROR no input file\n')
+        return
+    try:
+        gui.run(fname)
+    except SystemExit:
+        # emir_guy reports the errors in the output xml and calls exit()
+        pass
+    except Exception as err:
+        conn.sendall('ERROR {0}\n'.format(err).encode('utf-8'))
+        return
+    conn.sendall(b'OK\n')
+
+
+def worker(sock, gui, max_requests):
+    """Loop of a forked worker. Never returns"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    status = 0
+    try:
+        served = 0
+        while max_requests <= 0 or served < max_requests:
+            try:
+                conn, _ = sock.accept()
+            except InterruptedError:
+                continue
+            try:
+                handle(conn, gui)
+            except socket.error:
+                # Client went away, nothing to report to
+                pass
+            finally:
+                conn.close()
+            served += 1
+    except:
+        status = 1
+    os._exit(status)
+
+
+def spawn(sock, gui, max_requests):
+    """Fork a new worker and return its pid"""
+    pid = os.fork()
+    if pid == 0:
+        worker(sock, gui, max_requests)
+    return pid
+
+
+def serve(socket_file=SOCKET_FILE, nworkers=4, max_requests=500,
+          mode=0o660):
+    """Build the instrument state, fork the workers and supervise them"""
+    # Data files are given relative to the ETC directory
+    os.chdir(os.path.dirname(os.path.abspath(etc_gui.__file__)))
+    gui = etc_gui.EmirGui()
+    # Shared by the workers, which only set the data of their lines
+    etc_plot.build_templates()
+
+    if os.path.exists(socket_file):
+        os.unlink(socket_file)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(socket_file)
+    os.chmod(socket_file, mode)
+    sock.listen(max(16, 4*nworkers))
+
+    signal.signal(signal.SIGTERM, _shutdown)
+    signal.signal(signal.SIGINT, _shutdown)
+    children = set()
+    try:
+        for i in range(nworkers):
+            children.add(spawn(sock, gui, max_requests))
+        while True:
+            try:
+                pid, status = os.wait()
+            except InterruptedError:
+                continue
+            if pid in children:
+                children.discard(pid)
+                children.add(spawn(sock, gui, max_requests))
+    except Shutdown:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as err:
+                if err.errno != errno.ESRCH:
+                    raise
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        sock.close()
+        if os.path.exists(socket_file):
+            os.unlink(socket_file)
+
+
+def main():
+    """Command line entry point"""
+    parser = OptionParser(usage=usage, description=description)
+    parser.add_option("-s", "--socket", dest="socket", default=SOCKET_FILE,
+                      help='Unix socket to listen on \n  [%default]')
+    parser.add_option("-w", "--workers", dest="workers", type="int",
+                      default=4, help='Number of worker processes [%default]')
+    parser.add_option("-m", "--max-requests", dest="max_requests",
+                      type="int", default=500,
+                      help='Requests served by a worker before it is '
+                      'replaced, 0 for no limit [%default]')
+    parser.add_option("--mode", dest="mode", default='660',
+                      help='Permissions of the socket file [%default]')
+    option, args = parser.parse_args()
+    if option.workers < 1:
+        parser.error("at least one worker is needed")
+    serve(os.path.abspath(option.socket), option.workers,
+          option.max_requests, int(option.mode, 8))
+    sys.exit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+"""
+Date: 17-10-2026
+Description:
+Sharded sweeps and batches of the EMIR ETC, for several nodes sharing a
+filesystem and no scheduler.
+
+    python3 etc_shard.py init DIR request.xml -n 64 -a magnitude=14:24:201 \\
+        -a texp=10:3600:360 -a seeing=0.4:2:17 -a airmass=1:2:11
+    python3 etc_shard.py work DIR [-j 8]        (on every node, any number)
+    python3 etc_shard.py merge DIR -o sweep.npz
+
+init writes DIR/plan.json with the request and its division into shards:
+for a sweep (as etc_sweep.py) the values of one axis are divided, for a
+batch (--batch, requests as in etc_batch.py) the list of requests. The
+shards are thus the same for every worker. A worker claims a shard by
+creating DIR/shard_<n>.lock (O_EXCL), writes its results to
+DIR/shard_<n>.npz or .jsonl through a temporary file renamed into place and
+then removes the lock. Shards with results are never computed again, so an
+interrupted run is resumed by starting the workers again. Locks of dead
+workers are taken over: at once on the same host, after LOCK_AGE seconds
+from other hosts. The lock holds a token of its worker (host, pid and a
+random nonce); the worker refreshes its time while the shard runs and only
+removes it if it still holds its token. merge gathers the shards into the
+etc_sweep.py cube, or the etc_batch.py records in input order.
+"""
+import binascii
+import errno
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+import emir_guy
+import etc_batch
+import etc_engine
+import etc_pool
+import etc_sweep
+
+description = ">> Sharded sweeps and batches of the EMIR ETC"
+usage = """%prog init DIR request [options]
+       %prog work DIR [options]
+       %prog merge DIR -o output"""
+
+PLAN_FILE = 'plan.json'
+# Age after which the lock of a shard held by another host is taken over
+LOCK_AGE = 3600.  # s
+# Times per LOCK_AGE the lock of a running shard is refreshed
+LOCK_REFRESHES = 4
+
+
+def shard_file(directory, plan, n):
+    """File of the results of the shard n"""
+    suffix = 'npz' if plan['kind'] == 'sweep' else 'jsonl'
+    return os.path.join(directory, 'shard_{0:05d}.{1:s}'.format(n, suffix))
+
+
+def sweep_plan(config, axes, nshards):
+    """Plan of a sweep, dividing one axis (etc_pool.split_axis)"""
+    axes = [(name, np.atleast_1d(np.asarray(values, dtype=float)))
+            for name, values in axes]
+    k = etc_pool.split_axis(axes, nshards)
+    return {'kind': 'sweep', 'config': config, 'split': k,
+            'nshards': min(nshards, len(axes[k][1])),
+            'axes': [[name, values.tolist()] for name, values in axes]}
+
+
+def batch_plan(configs, nshards):
+    """Plan of a batch, dividing the list of requests"""
+    configs = list(configs)
+    return {'kind': 'batch', 'configs': configs,
+            'nshards': max(1, min(nshards, len(configs)))}
+
+
+def shard_tasks(plan):
+    """Work of each shard: the axes of a sweep, the requests of a batch"""
+    if plan['kind'] == 'sweep':
+        k = plan['split']
+        axes = [(name, np.array(values)) for name, values in plan['axes']]
+        return [axes[:k] + [(axes[k][0], i)] + axes[k + 1:]
+                for i in np.array_split(axes[k][1], plan['nshards'])]
+    index = np.array_split(np.arange(len(plan['configs'])), plan['nshards'])
+    return [[(int(i), plan['configs'][i]) for i in part] for part in index]
+
+
+def replace(fil, write):
+    """Write fil with write(file object) through a temporary file"""
+    temp = '{0:s}.tmp-{1:s}-{2:d}'.format(fil, socket.gethostname(),
+                                          os.getpid())
+    try:
+        with open(temp, 'wb') as arch:
+            write(arch)
+        os.rename(temp, fil)
+    finally:
+        if os.path.exists(temp):
+            os.unlink(temp)
+
+
+def write_plan(directory, plan):
+    """
+    Write the plan of directory. An identical plan is left as it is, so init
+    may be run again; a different one is an error
+    """
+    fil = os.path.join(directory, PLAN_FILE)
+    text = json.dumps(plan, sort_keys=True)
+    if os.path.exists(fil):
+        with open(fil) as arch:
+            if arch.read() != text:
+                raise ValueError('{0} holds a different plan'.format(fil))
+        return
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    replace(fil, lambda arch: arch.write(text.encode('utf-8')))
+
+
+def read_plan(directory):
+    with open(os.path.join(directory, PLAN_FILE)) as arch:
+        return json.load(arch)
+
+
+def claim(lock, max_age=LOCK_AGE):
+    """
+    Create the lock file of a shard, holding a token of this worker.
+    Returns the token, or None if the lock is held
+    """
+    nonce = binascii.hexlify(os.urandom(8)).decode('ascii')
+    token = '{0:s} {1:d} {2:s}'.format(socket.gethostname(), os.getpid(),
+                                       nonce)
+    for attempt in range(2):
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as err:
+            if err.errno != errno.EEXIST or attempt or \
+                    not stale(lock, max_age):
+                return None
+            # Only one of the workers seeing it stale can move it away
+            moved = '{0:s}.stale-{1:s}-{2:d}'.format(
+                lock, socket.gethostname(), os.getpid())
+            try:
+                os.rename(lock, moved)
+                os.unlink(moved)
+            except OSError:
+                return None
+            continue
+        os.write(fd, (token + '\n').encode('utf-8'))
+        os.close(fd)
+        return token
+    return None
+
+
+def holds(lock, token):
+    """Whether lock still holds token, i.e. was not taken over"""
+    try:
+        with open(lock) as arch:
+            return arch.read().strip() == token
+    except (IOError, OSError):
+        return False
+
+
+def release(lock, token):
+    """
+    Remove lock if it still holds token. It is first moved to a name of
+    this worker, so that it is checked and removed as one step; a lock
+    taken over meanwhile is put back
+    """
+    moved = '{0:s}.release-{1:s}-{2:d}'.format(
+        lock, socket.gethostname(), os.getpid())
+    try:
+        os.rename(lock, moved)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return
+    if not holds(moved, token):
+        try:
+            # Not over a lock made since, which is then the valid one
+            os.link(moved, lock)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    os.unlink(moved)
+
+
+def keep_alive(lock, token, max_age=LOCK_AGE):
+    """
+    Refresh the time of lock LOCK_REFRESHES times per max_age while it
+    holds token, so that it is not taken as stale while its shard runs.
+    Returns the threading.Event that stops it
+    """
+    stop = threading.Event()
+
+    def refresh():
+        while not stop.wait(max_age/LOCK_REFRESHES):
+            if holds(lock, token):
+                try:
+                    os.utime(lock, None)
+                except OSError:
+                    pass
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+    return stop
+
+
+def stale(lock, max_age=LOCK_AGE):
+    """Whether the worker holding lock is gone"""
+    try:
+        with open(lock) as arch:
+            host, pid = arch.read().split()[:2]
+        age = time.time() - os.stat(lock).st_mtime
+    except (IOError, OSError, ValueError):
+        # Removed meanwhile, or still being written
+        return False
+    if host == socket.gethostname():
+        try:
+            os.kill(int(pid), 0)
+        except OSError as err:
+            return err.errno == errno.ESRCH
+        return False
+    return age > max_age
+
+
+def run_shard(plan, task, engine=None, pool=None):
+    """Results of a shard: a sweep Result, or the batch records"""
+    if plan['kind'] == 'sweep':
+        if pool is not None:
+            return pool.sweep(plan['config'], task)
+        return engine.sweep(plan['config'], task)
+    if pool is not None:
+        records = pool.batch([config for index, config in task])
+    else:
+        records = (etc_batch.evaluate(engine, config) for index, config
+                   in task)
+    return [dict(record, index=index)
+            for (index, config), record in zip(task, records)]
+
+
+def write_shard(plan, results, fil):
+    if plan['kind'] == 'sweep':
+        replace(fil, lambda arch: etc_sweep.save_sweep(results, arch))
+    else:
+        replace(fil, lambda arch: arch.write(''.join(
+            json.dumps(record, sort_keys=True) + '\n'
+            for record in results).encode('utf-8')))
+
+
+def work(directory, processes=1, max_age=LOCK_AGE):
+    """
+    Compute the shards of directory not done nor held by other workers.
+    Returns the number of shards computed
+    """
+    directory = os.path.abspath(directory)
+    plan = read_plan(directory)
+    # Data files are read relative to the ETC directory
+    os.chdir(os.path.dirname(os.path.abspath(etc_engine.__file__)))
+    engine = pool = None
+    done = 0
+    try:
+        for n, task in enumerate(shard_tasks(plan)):
+            fil = shard_file(directory, plan, n)
+            lock = fil + '.lock'
+            if os.path.exists(fil):
+                continue
+            token = claim(lock, max_age)
+            if token is None:
+                continue
+            stop = None
+            try:
+                # Finished by another worker between the check and the claim
+                if os.path.exists(fil):
+                    continue
+                if engine is None and pool is None:
+                    if processes > 1:
+                        pool = etc_pool.EnginePool(processes)
+                    else:
+                        engine = etc_engine.Engine()
+                # Started once the pool is forked
+                stop = keep_alive(lock, token, max_age)
+                write_shard(plan, run_shard(plan, task, engine, pool), fil)
+                done += 1
+            finally:
+                if stop is not None:
+                    stop.set()
+                release(lock, token)
+    finally:
+        if pool is not None:
+            pool.close()
+    return done
+
+
+def merge(directory, output):
+    """
+    Gather the shards of directory into output. Returns the numbers of the
+    shards not done yet, in which case nothing is written
+    """
+    plan = read_plan(directory)
+    files = [shard_file(directory, plan, n) for n in range(plan['nshards'])]
+    missing = [n for n, fil in enumerate(files) if not os.path.exists(fil)]
+    if missing:
+        return missing
+    if plan['kind'] == 'sweep':
+        parts = [np.load(fil) for fil in files]
+        arrays = dict((name, np.concatenate([i[name] for i in parts],
+                                            axis=plan['split']))
+                      for name in etc_sweep.CUBE_FIELDS)
+        axes = [(name, np.array(values)) for name, values in plan['axes']]
+        etc_sweep.save_sweep(etc_engine.Result(axes=axes, **arrays), output)
+    else:
+        with open(output, 'w') as out:
+            for fil in files:
+                with open(fil) as arch:
+                    out.write(arch.read())
+    return []
+
+
+def main():
+    """Command line entry point"""
+    parser = OptionParser(usage=usage, description=description)
+    parser.add_option("-n", "--shards", dest="shards", type="int",
+                      default=16, help='init: number of shards [%default]')
+    parser.add_option("-a", "--axis", dest="axes", action="append",
+                      default=[],
+                      help='init: axis of the sweep, as in etc_sweep.py')
+    parser.add_option("--batch", dest="batch", action="store_true",
+                      default=False,
+                      help='init: the file is a batch of requests')
+    parser.add_option("-f", "--format", dest="format", default=None,
+                      choices=etc_batch.FORMATS,
+                      help='init: format of the requests, {0} [from the '
+                      'extension]'.format(', '.join(etc_batch.FORMATS)))
+    parser.add_option("-j", "--processes", dest="processes", type="int",
+                      default=1,
+                      help='work: worker processes, 0 for one per core '
+                      '[%default]')
+    parser.add_option("--lock-age", dest="lock_age", type="float",
+                      default=LOCK_AGE,
+                      help='work: age in s of the locks of other hosts '
+                      'taken as stale [%default]')
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help='merge: file of the results')
+    option, args = parser.parse_args()
+    if len(args) < 2 or args[0] not in ['init', 'work', 'merge']:
+        parser.print_help()
+        sys.exit(1)
+    command, directory = args[0], os.path.abspath(args[1])
+
+    if command == 'init':
+        if len(args) < 3:
+            parser.error('init needs the file of the request')
+        if option.shards < 1:
+            parser.error('at least one shard is needed')
+        configs = etc_batch.resolve_files(
+            etc_batch.read_configs(os.path.abspath(args[2]), option.format),
+            os.getcwd())
+        if option.batch:
+            plan = batch_plan(configs, option.shards)
+        else:
+            if len(option.axes) == 0:
+                parser.error('a sweep needs at least one axis')
+            try:
+                axes = [etc_sweep.parse_axis(i) for i in option.axes]
+            except ValueError as err:
+                parser.error(str(err))
+            config = next(configs, None)
+            if config is None:
+                parser.error('No request in {0}'.format(args[2]))
+            ff = dict((name, value if value is None or
+                       isinstance(value, str) else str(value))
+                      for name, value in config.items())
+            errors = emir_guy.validate_inputs(ff)
+            if errors:
+                sys.exit('\n'.join(errors))
+            plan = sweep_plan(ff, axes, option.shards)
+        try:
+            write_plan(directory, plan)
+        except ValueError as err:
+            sys.exit(str(err))
+    elif command == 'work':
+        if option.processes < 0:
+            parser.error("the number of processes can not be negative")
+        processes = option.processes or multiprocessing.cpu_count()
+        try:
+            done = work(directory, processes, option.lock_age)
+        except etc_engine.EtcError as err:
+            sys.exit(str(err))
+        sys.stderr.write("{0:d} shard(s) computed\n".format(done))
+    else:
+        if option.output is None:
+            parser.error('merge needs the output file (-o)')
+        missing = merge(directory, os.path.abspath(option.output))
+        if missing:
+            sys.exit('{0:d} shard(s) not done yet: {1}'.format(
+                len(missing), ', '.join(str(n) for n in missing)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Date: 17-10-2026
+Description:
+Parameter sweeps of the EMIR ETC: the S/N over a grid of airmass, seeing,
+magnitude and exposure time, for the other fields of one request.
+
+The request is read as in etc_batch.py (its first element) and validated as
+the web form ones. Each axis is given as
+
+    name=start:stop:num     num values from start to stop, both included
+    name=v1,v2,...          the values given
+
+with name one of etc_engine.SWEEP_AXES, and is a dimension of the cube in
+the order given. The cube is computed by etc_engine.Engine.sweep and written
+as a compressed NumPy archive (np.load) with
+
+    axes                        the names of the axes, in order
+    axis_<name>                 the values of each axis
+    ston, signal_obj,           arrays with one dimension per axis
+    signal_sky, saturated
+
+With -j the grid is divided among a pool of processes (etc_pool.py).
+
+    python3 etc_sweep.py request.xml -a magnitude=16:22:61 -a texp=10,60,300
+"""
+import multiprocessing
+import os
+import sys
+from optparse import OptionParser
+
+import numpy as np
+
+import emir_guy
+import etc_batch
+import etc_engine
+import etc_pool
+
+description = ">> Parameter sweeps of the EMIR ETC"
+usage = "%prog [options] request.(xml|jsonl|csv)"
+
+# Arrays of the Result written to the archive
+CUBE_FIELDS = ['ston', 'signal_obj', 'signal_sky', 'saturated']
+
+
+def parse_axis(text):
+    """(name, values) of an axis given as name=start:stop:num or name=v1,..."""
+    try:
+        name, values = text.split('=', 1)
+        if ':' in values:
+            start, stop, num = values.split(':')
+            values = np.linspace(float(start), float(stop), int(num))
+        else:
+            values = np.array([float(i) for i in values.split(',')])
+    except ValueError:
+        raise ValueError("Axis '{0}' is not name=start:stop:num nor "
+                         "name=v1,v2,...".format(text))
+    return name.strip(), values
+
+
+def save_sweep(res, fil):
+    """Write the cube of the Result of Engine.sweep to fil"""
+    arrays = dict((name, getattr(res, name)) for name in CUBE_FIELDS)
+    arrays['axes'] = np.array([name for name, values in res.axes])
+    for name, values in res.axes:
+        arrays['axis_' + name] = values
+    np.savez_compressed(fil, **arrays)
+
+
+def main():
+    """Command line entry point"""
+    parser = OptionParser(usage=usage, description=description)
+    parser.add_option("-a", "--axis", dest="axes", action="append",
+                      default=[],
+                      help='Axis of the sweep, name=start:stop:num or '
+                      'name=v1,v2,... with name in {0}; may be repeated'
+                      .format(', '.join(etc_engine.SWEEP_AXES)))
+    parser.add_option("-o", "--output", dest="output", default='sweep.npz',
+                      help='File of the cube [%default]')
+    parser.add_option("-f", "--format", dest="format", default=None,
+                      choices=etc_batch.FORMATS,
+                      help='Format of the request, {0} [from the extension]'
+                      .format(', '.join(etc_batch.FORMATS)))
+    parser.add_option("-j", "--processes", dest="processes", type="int",
+                      default=1,
+                      help='Worker processes, 0 for one per core [%default]')
+    option, args = parser.parse_args()
+    if len(args) == 0 or len(option.axes) == 0:
+        parser.print_help()
+        sys.exit(1)
+    try:
+        axes = [parse_axis(i) for i in option.axes]
+    except ValueError as err:
+        parser.error(str(err))
+    if option.processes < 0:
+        parser.error("the number of processes can not be negative")
+    processes = option.processes or multiprocessing.cpu_count()
+
+    fil = os.path.abspath(args[0])
+    output = os.path.abspath(option.output)
+    configs = etc_batch.resolve_files(etc_batch.read_configs(fil,
+                                                             option.format),
+                                      os.getcwd())
+    config = next(configs, None)
+    if config is None:
+        parser.error('No request in {0}'.format(args[0]))
+    ff = dict((name, value if value is None or isinstance(value, str)
+               else str(value)) for name, value in config.items())
+    errors = emir_guy.validate_inputs(ff)
+    if errors:
+        sys.exit('\n'.join(errors))
+
+    # Data files are read relative to the ETC directory
+    os.chdir(os.path.dirname(os.path.abspath(etc_engine.__file__)))
+    try:
+        if processes > 1:
+            with etc_pool.EnginePool(processes) as pool:
+                res = pool.sweep(ff, axes)
+        else:
+            res = etc_engine.Engine().sweep(ff, axes)
+    except etc_engine.EtcError as err:
+        sys.exit(str(err))
+    save_sweep(res, output)
+
+
+if __name__ == '__main__':
+    main()
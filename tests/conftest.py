@@ -0,0 +1,94 @@
+"""
+Date: 17-10-2026
+Description:
+Fixtures of the pytest checks of the EMIR ETC.
+
+The SkyCalc tables are not distributed with the ETC (see sky/README), so
+the checks run in a copy of the ETC directory (etc_dir) with synthetic ones:
+a continuum with a few hundred emission lines and two absorption bands,
+deterministic for each airmass. The expected values in baseline.json were
+computed with the original etc_gui.py on these same tables.
+"""
+import json
+import os
+import sys
+
+import astropy.io.fits as pyfits
+import numpy as np
+import pytest
+
+ETC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ETC_DIR not in sys.path:
+    sys.path.insert(0, ETC_DIR)
+
+# Data directories of the ETC used by the checks
+DATA_DIRS = ['components', 'filters', 'grisms', 'libs']
+# Airmasses (x10) of the SkyCalc tables
+SKY_AIRMASSES = [10, 15, 20, 25]
+
+
+def write_sky(directory):
+    """Synthetic sky/skytable_*.fits in directory"""
+    rng = np.random.default_rng(1)
+    lam = np.arange(0.70, 3.0, 0.00005)
+    lines = rng.uniform(0.8, 2.9, 400)
+    amps = rng.lognormal(0, 1.5, 400)
+    emission = 1e3*np.exp((lam - 1.0)*2.0)
+    for center, amp in zip(lines, amps):
+        emission += 5e4*amp*np.exp(-0.5*((lam - center)/0.00008)**2)
+    absorption = 0.3*np.sin(lam*40)**8 + \
+        0.9*np.exp(-0.5*((lam - 1.87)/0.04)**2) + \
+        0.9*np.exp(-0.5*((lam - 1.38)/0.04)**2)
+    sky = os.path.join(directory, 'sky')
+    os.makedirs(sky)
+    for am in SKY_AIRMASSES:
+        x = am/10.
+        trans = np.exp(-absorption*x)
+        flux = emission*(1 + 0.3*(x - 1))*(1.0 + 0.1*np.sin(lam*30*x))
+        cols = [pyfits.Column(name='lam', format='D', array=lam),
+                pyfits.Column(name='flux', format='D', array=flux),
+                pyfits.Column(name='trans', format='D', array=trans)]
+        pyfits.BinTableHDU.from_columns(cols).writeto(
+            os.path.join(sky, 'skytable_{0:d}.fits'.format(am)))
+
+
+@pytest.fixture(scope='session')
+def etc_dir(tmp_path_factory):
+    """ETC directory with synthetic sky tables, the working directory"""
+    directory = str(tmp_path_factory.mktemp('etc'))
+    for name in DATA_DIRS:
+        os.symlink(os.path.join(ETC_DIR, name),
+                   os.path.join(directory, name))
+    write_sky(directory)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    yield directory
+    os.chdir(cwd)
+
+
+@pytest.fixture(scope='session')
+def engine(etc_dir):
+    import etc_engine
+    return etc_engine.Engine()
+
+
+@pytest.fixture
+def config():
+    """Fields of a photometry request of a point source, as in the form"""
+    return {'magnitude': '16.', 'source_type': 'Point',
+            'template': 'Black body', 'model': 'a0v', 'body_temp': '10000.',
+            'line_center': '2.166', 'line_fwhm': '5.0', 'line_peakf': '1.0',
+            'airmass': '1.5', 'seeing': '0.8', 'operation': 'Photometry',
+            'photo_exp_time': '10', 'photo_nf_obj': '10.',
+            'photo_nf_sky': '10.', 'photo_filter': 'Ks',
+            'spec_slit_width': '0.8', 'spec_grism': 'K',
+            'spec_exp_time': '100.', 'spec_nf_obj': '12.',
+            'spec_nf_sky': '12.'}
+
+
+@pytest.fixture(scope='session')
+def baseline():
+    """Requests and the results of the original etc_gui.py for them"""
+    with open(os.path.join(os.path.dirname(__file__),
+                           'baseline.json')) as arch:
+        return json.load(arch)
@@ -0,0 +1,27 @@
+"""
+Date: 17-10-2026
+Description:
+Checks of the in-memory curve cache of etc_bundle.py
+"""
+import numpy as np
+
+import etc_bundle
+
+
+def test_curve_cache_counts(etc_dir, tmp_path, monkeypatch):
+    """Each lookup is counted once per kind of entry"""
+    monkeypatch.setattr(etc_bundle, 'curve_cache', etc_bundle.CurveCache())
+    fil = 'filters/K_trans.dat'
+    # No bundle, the file is parsed
+    directory = str(tmp_path)
+    grid = np.linspace(1.9, 2.4, 1001)
+    etc_bundle.load_curve(fil, grid, directory)
+    stats = etc_bundle.curve_cache.stats()
+    assert stats['hits'] == {}
+    assert stats['misses'] == {'array': 1, 'curve': 1}
+
+    etc_bundle.load_curve(fil, grid, directory)
+    etc_bundle.load_curve(fil, np.linspace(1.9, 2.4, 501), directory)
+    stats = etc_bundle.curve_cache.stats()
+    assert stats['hits'] == {'array': 1, 'curve': 1}
+    assert stats['misses'] == {'array': 2, 'curve': 1}
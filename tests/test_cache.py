@@ -0,0 +1,84 @@
+"""
+Date: 17-10-2026
+Description:
+Checks of the keys and entries of the result cache (etc_cache.py)
+"""
+import os
+import time
+
+import etc_cache
+
+OUTPUT = """<output>
+  <fig>{0}_photo.png</fig>
+  <text>Model file = {0}.xml.dat</text>
+  <text>Exposure time(s) = 10</text>
+  <table>
+\t     10.0\t    1.1\t    10.0\t    101.0\tNo
+</table>
+</output>
+"""
+
+
+def test_request_key(etc_dir, config, tmp_path, monkeypatch):
+    key = etc_cache.request_key(config)
+    assert etc_cache.request_key(dict(config, magnitude=' 16. ')) == key
+    assert etc_cache.request_key(dict(config, magnitude='17.')) != key
+    # Not used by the template
+    assert etc_cache.request_key(dict(config, model_file='x.dat')) == key
+
+    # Uploaded models count by their contents
+    models = []
+    for name, text in [('a.dat', '1 1\n2 1\n'), ('b.dat', '1 1\n2 1\n'),
+                       ('c.dat', '1 1\n2 2\n')]:
+        models.append(str(tmp_path / name))
+        with open(models[-1], 'w') as arch:
+            arch.write(text)
+    keys = [etc_cache.request_key(dict(config, template='Model file',
+                                       model_file=i)) for i in models]
+    assert keys[0] == keys[1] != keys[2]
+
+    # Changes of the data files and of the code
+    extra = os.path.join(etc_dir, 'sky', 'extra.txt')
+    with open(extra, 'w') as arch:
+        arch.write('sky\n')
+    try:
+        assert etc_cache.request_key(config) != key
+    finally:
+        os.unlink(extra)
+    assert etc_cache.request_key(config) == key
+    monkeypatch.setitem(etc_cache._code, 'version', 'other')
+    assert etc_cache.request_key(config) != key
+
+
+def test_store_fetch(tmp_path, monkeypatch):
+    """The request name is only changed where it names files"""
+    monkeypatch.chdir(tmp_path)
+    # A name that also is a number of the output
+    with open('10_out.xml', 'w') as arch:
+        arch.write(OUTPUT.format('10'))
+    with open('10_photo.png', 'wb') as arch:
+        arch.write(b'png')
+    etc_cache.store('key', '10', 'cache')
+    assert not etc_cache.fetch('other', 'new', 'cache')
+    assert etc_cache.fetch('key', 'new', 'cache')
+    with open('new_out.xml') as arch:
+        assert arch.read() == OUTPUT.format('new')
+    with open('new_photo.png', 'rb') as arch:
+        assert arch.read() == b'png'
+
+
+def test_prune_interval(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pruned = []
+    monkeypatch.setattr(etc_cache, 'prune', pruned.append)
+    with open('a_out.xml', 'w') as arch:
+        arch.write(OUTPUT.format('a'))
+    for key in ['1', '2', '3']:
+        etc_cache.store(key, 'a', 'cache')
+    assert pruned == ['cache']
+    old = time.time() - 2*etc_cache.PRUNE_INTERVAL
+    os.utime(os.path.join('cache', etc_cache.PRUNE_MARK), (old, old))
+    etc_cache.store('4', 'a', 'cache')
+    assert pruned == ['cache', 'cache']
+    assert sorted(os.listdir('cache')) == [etc_cache.PRUNE_MARK, '1', '2',
+                                           '3', '4']
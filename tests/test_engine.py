@@ -0,0 +1,112 @@
+"""
+Date: 17-10-2026
+Description:
+Checks of etc_engine.Engine against the original etc_gui.py
+"""
+import numpy as np
+import pytest
+
+import etc_engine
+import etc_modules as mod
+
+# Relative tolerance against the original results: the flux conserving
+# pixel integration and the per segment sky of the HK grism move some of
+# them by a few per cent
+BASELINE_RTOL = 0.05
+
+
+def run(engine, config):
+    if config['operation'] == 'Photometry':
+        return engine.photometry(config)
+    return engine.spectroscopy(config)
+
+
+def test_baseline(engine, baseline):
+    for name, case in sorted(baseline.items()):
+        res = run(engine, case['config'])
+        # One flag per exposure time, whatever the mode
+        assert res.saturated.dtype == bool
+        assert res.saturated.shape == res.texp.shape
+        for key, expected in sorted(case['expected'].items()):
+            np.testing.assert_allclose(getattr(res, key), expected,
+                                       rtol=BASELINE_RTOL,
+                                       err_msg='{0} {1}'.format(name, key))
+
+
+@pytest.mark.parametrize('center', [2.125, 2.2249])
+def test_line_cut_by_window(engine, baseline, center):
+    """A line straddling the filter support keeps only the flux inside it"""
+    config = dict(baseline['ph_line_edge_blue']['config'],
+                  line_center=str(center))
+    engine.preparePhotometry(config)
+    engine.buildObj()
+    full = engine.full['ldo_hr']
+    line = mod.emline(full, center, 50e-4, 1e-16)
+    np.testing.assert_allclose(engine.obj, line[engine.window])
+    assert engine.obj.sum() < 0.9*line.sum()
+
+
+@pytest.mark.parametrize('target', [20., 200.])
+def test_solve_texp(engine, config, target):
+    """The exposure time reported reaches the target S/N, hardly more"""
+    res = engine.photometry(dict(config, calculation='Exposure time',
+                                 target_ston=str(target)))
+    assert target <= res.solution['ston'] < 1.01*target
+    forward = engine.photometry(dict(config,
+                                     photo_exp_time=repr(float(res.texp[0]))))
+    np.testing.assert_allclose(forward.ston, res.solution['ston'])
+
+
+@pytest.mark.parametrize('name', ['ph_pt_single', 'sp_pt_single',
+                                  'sp_hk_single'])
+def test_sweep(engine, baseline, name):
+    """Each point of a sweep is the request with its parameters"""
+    config = baseline[name]['config']
+    axes = [('airmass', [1.2, 1.8]), ('seeing', [0.6, 1.1]),
+            ('magnitude', [15., 19.]), ('texp', [30., 300.])]
+    res = engine.sweep(config, axes)
+    field = 'photo_exp_time' if config['operation'] == 'Photometry' \
+        else 'spec_exp_time'
+    for index in np.ndindex(res.ston.shape):
+        point = dict(config)
+        for (axis, values), i in zip(axes, index):
+            point[field if axis == 'texp' else axis] = repr(values[i])
+        single = run(engine, point)
+        for key in ['ston', 'signal_obj', 'signal_sky', 'saturated']:
+            np.testing.assert_allclose(getattr(res, key)[index],
+                                       getattr(single, key)[0], rtol=1e-10,
+                                       err_msg='{0} {1}'.format(index, key))
+
+
+@pytest.mark.parametrize('axis', [('airmass', [1.5, 2.5]),
+                                  ('seeing', [0., 1.]),
+                                  ('texp', [-10., 10.]),
+                                  ('magnitude', [16., np.nan])])
+def test_sweep_range(engine, config, axis):
+    with pytest.raises(etc_engine.EtcError):
+        engine.sweep(config, [axis])
+
+
+def test_sweep_magnitude_line(engine, baseline):
+    """The magnitude does not change emission lines"""
+    config = baseline['ph_line']['config']
+    with pytest.raises(etc_engine.EtcError):
+        engine.sweep(config, [('magnitude', [15., 16.])])
+    res = engine.sweep(config, [('seeing', [0.6, 1.2])])
+    assert res.ston.shape == (2,)
+
+
+def test_display_products(engine, baseline):
+    """The products of the figures are only computed if read"""
+    config = baseline['sp_pt_single']['config']
+    res = run(engine, config)
+    assert set(res._lazy) == set(['sp', 'efficiency'])
+    assert res.sp.shape == res.ldo_px.shape
+    assert 'sp' not in res._lazy
+    assert res.efficiency['total'].shape == res.wvl_full.shape
+    engine.display = False
+    try:
+        res = run(engine, config)
+    finally:
+        engine.display = True
+    assert not hasattr(res, 'sp') and not hasattr(res, 'efficiency')
@@ -0,0 +1,97 @@
+"""
+Date: 17-10-2026
+Description:
+Checks of the numerical helpers of etc_modules.py
+"""
+import os
+import shutil
+
+import astropy.io.fits as pyfits
+import numpy as np
+import pytest
+
+import etc_modules as mod
+
+
+def spectra(kind, n=20001):
+    """Rows of test data: dense, a few lines, or a band between zeros"""
+    rng = np.random.default_rng(2)
+    if kind == 'dense':
+        return rng.random((3, n))
+    if kind == 'sparse':
+        return np.where(rng.random((3, n)) < 0.002, rng.random((3, n)), 0.)
+    data = np.zeros((3, n))
+    data[:, n//3:2*n//3] = rng.random((3, 2*n//3 - n//3))
+    return data
+
+
+@pytest.mark.parametrize('method', ['direct', 'oa', 'fft', 'auto'])
+@pytest.mark.parametrize('kind', ['dense', 'sparse', 'band'])
+@pytest.mark.parametrize('nker', [5, 64, 301, 2001])
+def test_convolve_same(method, kind, nker):
+    # Tails below the level of the FFT residuals
+    kernel = np.exp(-0.5*np.linspace(-9, 9, nker)**2)
+    data = spectra(kind)
+    expected = np.array([np.convolve(kernel, i, mode='same') for i in data])
+    conv = mod.convolve_same(kernel, data, method)
+    np.testing.assert_allclose(conv, expected, rtol=0,
+                               atol=1e-13*expected.max())
+    assert ((conv == 0) == (expected == 0)).all()
+    np.testing.assert_allclose(mod.convolve_same(kernel, data[0], method),
+                               conv[0])
+
+
+def test_convolve_same_fallback(monkeypatch):
+    """With many samples to recompute, all are computed directly"""
+    monkeypatch.setattr(mod, 'CONV_REDO_FRACTION', 0.)
+    kernel = np.exp(-0.5*np.linspace(-9, 9, 301)**2)
+    data = spectra('sparse')
+    expected = np.array([np.convolve(kernel, i, mode='same') for i in data])
+    np.testing.assert_array_equal(mod.convolve_same(kernel, data, 'fft'),
+                                  expected)
+
+
+@pytest.mark.parametrize('shift', [0., 0.3, 0.77])
+def test_pixel_operator(shift):
+    """The integration over the pixels conserves the flux"""
+    wvl0 = 1.0 + np.arange(20001)*2e-5
+    # Pixels of 13.7 samples, covering the grid
+    dpx = 13.7*2e-5
+    wvl1 = wvl0[0] - dpx + (np.arange(1465) + shift)*dpx
+    # Width of the cell of each sample
+    cells = np.full(len(wvl0), 2e-5)
+    line = mod.emline(wvl0, 1.2, 5e-4, 1e-16)
+    rows = np.array([line, np.ones_like(wvl0), spectra('band')[0]])
+    integral = mod.pixel_int(wvl0, rows, wvl1)
+    np.testing.assert_allclose(integral.sum(axis=-1), rows.dot(cells),
+                               rtol=1e-12)
+    operator = mod.pixel_operator(wvl0, wvl1)
+    np.testing.assert_allclose(np.asarray(operator.sum(axis=0))[0], cells,
+                               rtol=1e-9)
+
+
+def test_skycube(etc_dir, tmp_path, monkeypatch):
+    """The sky cube is only used while it matches the FITS tables"""
+    directory = str(tmp_path)
+    for fil in mod.skytable_files(os.path.join(etc_dir, 'sky')):
+        shutil.copy2(fil, directory)
+    monkeypatch.setattr(mod, '_skycube', {})
+    tables = mod.read_skytables(directory)
+    mod.pack_skytables(directory)
+    sky = mod.load_skycube(directory)
+    assert isinstance(sky['flux'], np.memmap)
+    np.testing.assert_allclose(sky['flux'], tables['flux'], rtol=1e-6)
+
+    # Same contents, new mtime
+    fil = mod.skytable_files(directory)[1]
+    os.utime(fil, (0, 0))
+    mod._skycube.clear()
+    assert isinstance(mod.load_skycube(directory)['flux'], np.memmap)
+
+    with pyfits.open(fil) as hdus:
+        hdus[1].data['flux'] *= 2
+        hdus.writeto(fil, overwrite=True)
+    mod._skycube.clear()
+    sky = mod.load_skycube(directory)
+    assert not isinstance(sky['flux'], np.memmap)
+    np.testing.assert_allclose(sky['flux'][1], 2*tables['flux'][1])
@@ -0,0 +1,78 @@
+"""
+Date: 17-10-2026
+Description:
+Checks of the locks and the merge of etc_shard.py
+"""
+import os
+import time
+
+import numpy as np
+
+import etc_engine
+import etc_shard
+
+
+def test_claim(tmp_path):
+    lock = str(tmp_path / 'shard_00000.npz.lock')
+    token = etc_shard.claim(lock)
+    assert token is not None
+    # Held by this (running) process
+    assert etc_shard.claim(lock) is None
+    etc_shard.release(lock, 'other token')
+    # Put back as it was, with nothing left beside it
+    assert etc_shard.holds(lock, token)
+    assert os.listdir(str(tmp_path)) == [os.path.basename(lock)]
+    etc_shard.release(lock, token)
+    assert not os.path.exists(lock)
+    # Released twice, e.g. after a takeover
+    etc_shard.release(lock, token)
+
+
+def test_takeover(tmp_path):
+    """A lock taken over is not removed by its former owner"""
+    lock = str(tmp_path / 'shard_00000.npz.lock')
+    with open(lock, 'w') as arch:
+        arch.write('otherhost 1 0123456789abcdef\n')
+    assert etc_shard.claim(lock, 60.) is None
+    old = time.time() - 120.
+    os.utime(lock, (old, old))
+    token = etc_shard.claim(lock, 60.)
+    assert token is not None
+    etc_shard.release(lock, 'otherhost 1 0123456789abcdef')
+    assert etc_shard.holds(lock, token)
+
+
+def test_keep_alive(tmp_path):
+    lock = str(tmp_path / 'shard_00000.npz.lock')
+    token = etc_shard.claim(lock)
+    old = time.time() - 120.
+    os.utime(lock, (old, old))
+    stop = etc_shard.keep_alive(lock, token, 0.2)
+    try:
+        time.sleep(0.3)
+        assert time.time() - os.stat(lock).st_mtime < 60.
+    finally:
+        stop.set()
+
+
+def test_work_merge(tmp_path, monkeypatch, engine, config):
+    """A sweep computed in shards is the sweep computed at once"""
+    # work() reads the data files from the directory of etc_engine
+    monkeypatch.setattr(etc_engine, '__file__',
+                        os.path.join(os.getcwd(), 'etc_engine.py'))
+    axes = [('magnitude', np.linspace(14., 20., 7)),
+            ('texp', np.array([10., 100.]))]
+    directory = str(tmp_path / 'sweep')
+    etc_shard.write_plan(directory, etc_shard.sweep_plan(config, axes, 3))
+    output = str(tmp_path / 'sweep.npz')
+    assert etc_shard.merge(directory, output) == [0, 1, 2]
+    assert etc_shard.work(directory) == 3
+    assert etc_shard.work(directory) == 0
+    assert not [i for i in os.listdir(directory) if i.endswith('.lock')]
+    assert etc_shard.merge(directory, output) == []
+
+    res = engine.sweep(config, axes)
+    with np.load(output) as cube:
+        for name in ['ston', 'signal_obj', 'signal_sky', 'saturated']:
+            np.testing.assert_allclose(cube[name], getattr(res, name),
+                                       rtol=1e-12)